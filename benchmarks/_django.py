@@ -0,0 +1,83 @@
+# coding=utf-8
+"""Shared setup for benchmark scripts: configures Django with the settings
+used by the test runner and creates a throwaway database.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from hashlib import md5
+import os
+import sys
+import time
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+
+def setup(**overrides):
+    from django.conf import settings
+    from yandex_cash_register.tests.runtests import SETTINGS_DICT
+
+    options = dict(SETTINGS_DICT)
+    options['DATABASES'] = {
+        'default': {'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': ':memory:'},
+    }
+    options.update(overrides)
+    settings.configure(**options)
+
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0, interactive=False)
+
+
+def create_payment(order_id, **kwargs):
+    from decimal import Decimal
+    from yandex_cash_register.models import Payment
+    from yandex_cash_register import conf
+
+    params = dict(order_sum=Decimal('1000.00'), order_id=order_id,
+                  cps_email='test@test.com', cps_phone='79991234567',
+                  payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY)
+    params.update(kwargs)
+    return Payment.objects.create(**params)
+
+
+def notification(payment, action, **kwargs):
+    """Signed checkOrder/paymentAviso POST data for a payment"""
+    from yandex_cash_register.forms import PaymentProcessingForm
+    from yandex_cash_register import conf
+
+    data = {
+        'shopId': str(conf.SHOP_ID), 'orderNumber': payment.order_id,
+        'customerNumber': str(payment.customer_id),
+        'paymentType': conf.PAYMENT_TYPE_YANDEX_MONEY, 'action': action,
+        'invoiceId': '123456', 'orderSumAmount': '1000.00',
+        'orderSumCurrencyPaycash': '643', 'orderSumBankPaycash': '1001',
+        'shopSumAmount': '975.30', 'shopSumCurrencyPaycash': '643',
+        'paymentPayerCode': '12345678901234567890',
+    }
+    data.update(kwargs)
+    if 'md5' not in data:
+        base = ';'.join(data[key]
+                        for key in PaymentProcessingForm.MD5_KEY_ORDER)
+        base = '{};{}'.format(base, conf.SHOP_PASSWORD).encode('utf-8')
+        data['md5'] = md5(base).hexdigest().upper()
+    return data
+
+
+def timeit(func, repeat):
+    started = time.time()
+    for i in range(repeat):
+        func(i)
+    return time.time() - started
+
+
+def report(title, rows):
+    print(title)
+    width = max(len(name) for name, _ in rows)
+    for name, value in rows:
+        print('  {}  {}'.format(name.ljust(width), value))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Compares insert throughput of payments with random keys (uuid4
+customer_id, random order_id) and time-ordered ones (uuid7 customer_id,
+monotonic order_id). Uses an on-disk SQLite database, so the unique indexes
+actually have to be paged in and out.
+
+    python benchmarks/ids.py [rows] [batch]
+"""
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import _django
+
+
+def main(count, batch):
+    directory = tempfile.mkdtemp()
+    try:
+        _django.setup(DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(directory, 'ids.sqlite3'),
+        }})
+        run(count, batch)
+    finally:
+        shutil.rmtree(directory)
+
+
+def run(count, batch):
+    from decimal import Decimal
+    from django.db import transaction
+    from yandex_cash_register.ids import make_order_id, uuid7
+    from yandex_cash_register.models import Payment
+
+    cases = (
+        ('uuid4', uuid.uuid4, lambda: uuid.uuid4().hex),
+        ('uuid7', uuid7, make_order_id),
+    )
+    rows = []
+    for title, customer_id, order_id in cases:
+        Payment.objects.all().delete()
+
+        def insert(i):
+            with transaction.atomic():
+                Payment.objects.bulk_create(
+                    Payment(customer_id=customer_id(), order_id=order_id(),
+                            order_sum=Decimal('1000.00'))
+                    for j in range(batch))
+
+        elapsed = _django.timeit(insert, count // batch)
+        rows.append((title, '{:10.0f} rows/s'.format(count / elapsed)))
+    _django.report('{} rows in batches of {}:'.format(count, batch), rows)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 500)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Compares how long a payment row stays locked while serving checkOrder and
+paymentAviso notifications with the time spent on the whole request, which
+is how long the lock was held when the transaction wrapped the entire view.
+
+    python benchmarks/lock_hold.py [requests]
+"""
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import sys
+
+import _django
+
+
+def main(count):
+    _django.setup(ALLOWED_HOSTS=['testserver'])
+
+    from django.test import Client
+    from yandex_cash_register import metrics
+
+    payments = [_django.create_payment('lock-hold-{}'.format(i))
+                for i in range(count)]
+    client = Client()
+    metrics.registry.reset()
+
+    for payment in payments:
+        client.post('/kassa/order-check/',
+                    _django.notification(payment, 'checkOrder'))
+        client.post('/kassa/payment-aviso/',
+                    _django.notification(payment, 'paymentAviso'))
+
+    _, histograms = metrics.registry.collect()
+    rows = []
+    for view in ('CheckOrderView', 'PaymentAvisoView'):
+        request = histograms[(metrics.REQUEST_DURATION, (('view', view),))]
+        hold = histograms[(metrics.LOCK_HOLD, (('source', view),))]
+        request_ms = 1000 * request['sum'] / request['count']
+        hold_ms = 1000 * hold['sum'] / hold['count']
+        rows.append((view, 'request {:.3f} ms, lock held {:.3f} ms '
+                           '({:.0%} of request)'
+                     .format(request_ms, hold_ms, hold_ms / request_ms)))
+    _django.report('Mean per request over {} payments:'.format(count), rows)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
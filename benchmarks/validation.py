@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Compares PaymentProcessingForm with NotificationValidator on a valid
+notification and on one with a wrong signature.
+
+    python benchmarks/validation.py [iterations]
+"""
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import sys
+
+import _django
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def allocated(func):
+    """Peak memory allocated by a single call, in bytes"""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func(0)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main(count):
+    _django.setup()
+
+    from django.http import QueryDict
+    from yandex_cash_register.forms import PaymentProcessingForm
+    from yandex_cash_register.validators import NotificationValidator
+
+    payment = _django.create_payment('validation')
+    cases = (
+        ('valid', _django.notification(payment, 'checkOrder')),
+        ('wrong signature', _django.notification(payment, 'checkOrder',
+                                                 md5='A' * 32)),
+    )
+
+    for title, data in cases:
+        query = QueryDict('', mutable=True)
+        query.update(data)
+        rows = []
+        for cls in (PaymentProcessingForm, NotificationValidator):
+            def validate(i):
+                cls(query).is_valid()
+
+            validate(0)
+            elapsed = _django.timeit(validate, count)
+            memory = allocated(validate)
+            rows.append((cls.__name__, '{:8.1f} us/request{}'.format(
+                1e6 * elapsed / count,
+                '' if memory is None else ', peak {} bytes'.format(memory))))
+        _django.report('{} notification, {} iterations:'.format(title, count),
+                       rows)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
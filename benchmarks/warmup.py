@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Compares the first requests served by a fresh process with and without
+YANDEX_CR_WARMUP: a checkOrder notification and a checkout page (payment
+form rendered with finish_payment.html). Every measurement runs in a new
+process, since warm-up state is per process.
+
+    python benchmarks/warmup.py [runs]
+"""
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import _django
+
+
+def measure(warm):
+    """First request timings of this process, in seconds"""
+    started = time.time()
+    # Any installed model will do as the order model
+    _django.setup(ALLOWED_HOSTS=['testserver'], YANDEX_CR_WARMUP=warm,
+                  YANDEX_CR_ORDER_MODEL='auth.User')
+    startup = time.time() - started
+
+    from django.template.loader import render_to_string
+    from django.test import Client
+
+    payment = _django.create_payment('warmup')
+    data = _django.notification(payment, 'checkOrder')
+
+    started = time.time()
+    Client().post('/kassa/order-check/', data)
+    notification = time.time() - started
+
+    started = time.time()
+    render_to_string('yandex_cash_register/finish_payment.html',
+                     {'form': payment.form()})
+    checkout = time.time() - started
+    return {'startup': startup, 'notification': notification,
+            'checkout': checkout}
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(runs):
+    results = {}
+    for warm in (False, True):
+        samples = [json.loads(subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--child',
+             'warm' if warm else 'cold']).decode('utf-8'))
+            for _ in range(runs)]
+        results[warm] = dict((key, median([s[key] for s in samples]))
+                             for key in samples[0])
+
+    rows = []
+    for key in ('startup', 'notification', 'checkout'):
+        rows.append((key, '{:8.1f} ms cold, {:8.1f} ms warm'.format(
+            1000 * results[False][key], 1000 * results[True][key])))
+    _django.report('Median of {} processes:'.format(runs), rows)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        print(json.dumps(measure(sys.argv[2] == 'warm')))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -17,10 +17,13 @@ setup(
         'yandex_cash_register',
         'yandex_cash_register.tests',
         'yandex_cash_register.migrations',
+        'yandex_cash_register.management',
+        'yandex_cash_register.management.commands',
     ],
     package_data={
         'yandex_cash_register': [
             'templates/*/*.*',
+            'templates/*/*/*/*.*',
             'locale/*/LC_MESSAGES/*.po',
         ]
     },
@@ -47,4 +50,9 @@ setup(
         'django>=1.8',
         'lxml>=3.5,<=3.6.4',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'api': ['requests>=2.4.2'],
+        'fastjson': ['ujson'],
+    },
 )
@@ -1,8 +1,60 @@
 # coding=utf-8
 from __future__ import absolute_import, unicode_literals
 
+import json
+
+from django import forms
+from django.conf.urls import url
 from django.contrib import admin
-from .models import Payment
+from django.contrib.admin.views.main import SEARCH_VAR
+from django.core.exceptions import PermissionDenied
+from django.http import QueryDict
+from django.template.response import TemplateResponse
+from django.utils.html import format_html
+from django.utils.translation import ugettext_lazy as _
+
+from .models import NotificationJournal, Payment, Refund, Subscription
+from . import analytics, conf, routers
+
+
+class AnalyticsPeriodForm(forms.Form):
+    since = forms.DateField(label=_('Since'), required=False)
+    until = forms.DateField(label=_('Until'), required=False)
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    """Picks the shard to browse, shown only when sharding is enabled. The
+    changelist shows one shard at a time: the selected one, the one of the
+    searched order ID, or the first one. There is no "All" choice
+    """
+    title = _('shard')
+    parameter_name = 'shard'
+
+    def __init__(self, request, params, model, model_admin):
+        super(ShardListFilter, self).__init__(request, params, model,
+                                              model_admin)
+        self.shard = model_admin.get_shard(request) or \
+            routers.get_shards()[0]
+
+    def lookups(self, request, model_admin):
+        shards = routers.get_shards()
+        if len(shards) < 2:
+            return []
+        return [(alias, alias) for alias in shards]
+
+    def choices(self, changelist):
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': lookup == self.shard,
+                'query_string': changelist.get_query_string(
+                    {self.parameter_name: lookup}, [SEARCH_VAR]),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        # Applied in PaymentAdmin.get_queryset, so that the change view
+        # reads from the same shard
+        return queryset
 
 
 @admin.register(Payment)
@@ -10,19 +62,27 @@ class PaymentAdmin(admin.ModelAdmin):
     list_display = ('order_id', 'is_completed_status', 'is_payed_status',
                     'order_sum', 'shop_sum', 'shop_currency',
                     'created')
-    list_filter = ('state',)
+    list_filter = ('state', ShardListFilter)
+    # Exact, so that the search goes to the shard of the order
+    search_fields = ('=order_id',)
+    change_list_template = \
+        'admin/yandex_cash_register/payment/change_list.html'
     fields = (
-        'customer_id', 'order_id', 'invoice_id', 'state',
-        'payment_type', ('order_sum', 'order_currency'),
+        'customer_id', 'order_id', 'invoice_id', 'external_id', 'state',
+        'payment_type', 'payment_method_id', 'parent_order_id',
+        ('order_sum', 'order_currency'),
         ('shop_sum', 'shop_currency'),
         'payer_code', 'cps_email', 'cps_phone',
-        'created', 'performed', 'completed',
+        'created', 'performed', 'completed', 'hold_expires',
+        'capture_requested',
     )
     readonly_fields = (
-        'customer_id', 'order_id', 'invoice_id', 'state',
-        'payment_type', 'order_sum', 'order_currency', 'shop_sum',
+        'customer_id', 'order_id', 'invoice_id', 'external_id', 'state',
+        'payment_type', 'payment_method_id', 'parent_order_id',
+        'order_sum', 'order_currency', 'shop_sum',
         'shop_currency', 'payer_code', 'cps_email', 'cps_phone',
-        'created', 'performed', 'completed',
+        'created', 'performed', 'completed', 'hold_expires',
+        'capture_requested',
     )
 
     def is_completed_status(self, obj):
@@ -35,6 +95,85 @@ class PaymentAdmin(admin.ModelAdmin):
     is_payed_status.boolean = True
     is_payed_status.short_description = 'Оплачен'
 
+    def get_queryset(self, request):
+        queryset = super(PaymentAdmin, self).get_queryset(request)
+        shard = self.get_shard(request)
+        if shard is not None:
+            queryset = queryset.using(shard)
+
+        match = getattr(request, 'resolver_match', None)
+        if request.method == 'GET' and match is not None and \
+                match.url_name.endswith('_changelist'):
+            # Browsing may lag behind a bit, unlike actions and edits
+            replica = routers.replica_for(queryset.db)
+            if replica is not None and not routers.is_pinned():
+                queryset = queryset.using(replica)
+        return queryset
+
+    @staticmethod
+    def get_shard(request):
+        """Shard of the order ID searched for or, failing that, the one
+        selected in the changelist. Also for the change view opened from it
+        """
+        shards = routers.get_shards()
+        if len(shards) < 2:
+            return None
+        params = request.GET
+        if '_changelist_filters' in params:
+            params = QueryDict(params['_changelist_filters'])
+        order_id = params.get(SEARCH_VAR, '').strip()
+        if order_id:
+            return routers.shard_for(order_id)
+        shard = params.get(ShardListFilter.parameter_name)
+        if shard in shards:
+            return shard
+        return None
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            url(r'^analytics/$',
+                self.admin_site.admin_view(self.analytics_view),
+                name='{}_{}_analytics'.format(*info)),
+        ] + super(PaymentAdmin, self).get_urls()
+
+    def analytics_view(self, request):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+
+        form = AnalyticsPeriodForm(request.GET or None)
+        since = until = None
+        if form.is_valid():
+            since = form.cleaned_data['since']
+            until = form.cleaned_data['until']
+        since, until = analytics.get_period(since, until)
+        report = analytics.report(since, until)
+
+        timing_columns = ['count'] + [
+            'p{}'.format(q) for q in conf.ANALYTICS_PERCENTILES]
+        context = dict(
+            self.admin_site.each_context(request),
+            title=_('Payment analytics'),
+            opts=self.model._meta,
+            form=form,
+            since=since,
+            until=until,
+            funnel_columns=analytics.STAGES,
+            funnel=self._table(report['funnel'], analytics.STAGES),
+            timing_columns=timing_columns,
+            to_process=self._table(report['to_process'], timing_columns),
+            to_complete=self._table(report['to_complete'], timing_columns),
+        )
+        return TemplateResponse(
+            request, 'admin/yandex_cash_register/payment/analytics.html',
+            context)
+
+    @staticmethod
+    def _table(rows, columns):
+        keys = sorted(rows, key=lambda key: (key != analytics.TOTAL, key))
+        return [(key, [rows[key][column] for column in columns])
+                for key in keys]
+
     def get_actions(self, request):
         actions = super(PaymentAdmin, self).get_actions(request)
         del actions['delete_selected']
@@ -45,3 +184,60 @@ class PaymentAdmin(admin.ModelAdmin):
 
     def has_delete_permission(self, request, obj=None):
         return False
+
+
+@admin.register(NotificationJournal)
+class NotificationJournalAdmin(admin.ModelAdmin):
+    list_display = ('created', 'action', 'order_id', 'code', 'duration')
+    list_filter = ('action', 'code')
+    search_fields = ('order_id',)
+    fields = ('created', 'action', 'order_id', 'code', 'duration',
+              'payload_display')
+    readonly_fields = fields
+
+    def payload_display(self, obj):
+        return format_html('<pre>{}</pre>', json.dumps(
+            obj.get_payload(), indent=2, sort_keys=True, ensure_ascii=False))
+    payload_display.short_description = _('Request and response')
+
+    def get_actions(self, request):
+        actions = super(NotificationJournalAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(Refund)
+class RefundAdmin(admin.ModelAdmin):
+    list_display = ('order_id', 'amount', 'status', 'external_id', 'created',
+                    'updated')
+    list_filter = ('status',)
+    search_fields = ('order_id', 'external_id')
+    fields = ('order_id', 'external_id', 'amount', 'status', 'description',
+              'error', 'created', 'updated')
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(Subscription)
+class SubscriptionAdmin(admin.ModelAdmin):
+    list_display = ('order_id', 'amount', 'interval_months', 'state',
+                    'next_charge', 'failures', 'last_charged')
+    list_filter = ('state',)
+    search_fields = ('order_id',)
+    fields = ('order_id', 'payment_method_id', ('amount', 'currency'),
+              'description', 'interval_months', 'state', 'next_charge',
+              'retry_at', 'failures', 'last_charged', 'last_error',
+              'created', 'updated')
+    readonly_fields = ('order_id', 'last_charged', 'last_error', 'created',
+                       'updated')
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,321 @@
+# coding=utf-8
+"""Conversion funnel and payment timing reports.
+
+Counts are aggregated by the database, one grouped query per shard. Timings
+are streamed from the database as plain tuples into compact float arrays, so
+even large tables are processed without building model instances.
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+from array import array
+import datetime
+import math
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db.models import Case, Count, IntegerField, When
+from django.utils import six, timezone
+
+from . import cache, conf, routers
+from .models import Payment
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+STAGES = ('created', 'processed', 'success', 'fail')
+TOTAL = 'total'
+
+FEE_COLUMNS = ('order_id', 'payment_type', 'order_sum', 'shop_sum',
+               'order_currency', 'shop_currency')
+# Fee rates of a payment method are often exactly the same, which makes
+# their median absolute deviation zero. Deviations below 0.1 percentage
+# point are never outliers
+MIN_RATE_DEVIATION = 0.001
+
+
+def get_period(since=None, until=None, days=30):
+    """Turn dates into a ``[since, until)`` datetime range. ``until`` is
+    inclusive, defaults to today; ``since`` defaults to ``days`` before it
+
+    :type since: datetime.date
+    :type until: datetime.date
+    :rtype: tuple
+    """
+    if until is None:
+        if settings.USE_TZ:
+            until = timezone.localtime(timezone.now()).date()
+        else:
+            until = datetime.date.today()
+    since = since or until - datetime.timedelta(days=days - 1)
+
+    def start_of(date):
+        value = datetime.datetime.combine(date, datetime.time())
+        if settings.USE_TZ:
+            value = timezone.make_aware(value)
+        return value
+
+    return start_of(since), start_of(until + datetime.timedelta(days=1))
+
+
+def get_querysets(since, until):
+    """Payments created within ``[since, until)``, one queryset per shard,
+    read from replicas where configured
+
+    :rtype: list
+    """
+    querysets = []
+    for alias in routers.get_shards():
+        alias = routers.replica_for(alias) or alias
+        querysets.append(Payment.objects.using(alias).filter(
+            created__gte=since, created__lt=until).order_by())
+    return querysets
+
+
+def _count(**lookups):
+    return Count(Case(When(then=1, **lookups), output_field=IntegerField()))
+
+
+def funnel(querysets):
+    """Number of payments that reached each stage, in total and by payment
+    type
+
+    :rtype: dict
+    """
+    result = {}
+    for queryset in querysets:
+        rows = queryset.values('payment_type').annotate(
+            created=Count('pk'),
+            processed=_count(performed__isnull=False),
+            success=_count(state__in=Payment.PAID_STATES),
+            fail=_count(state=Payment.STATE_FAIL),
+        )
+        for row in rows:
+            for key in (TOTAL, row['payment_type']):
+                stages = result.setdefault(key, dict.fromkeys(STAGES, 0))
+                for stage in STAGES:
+                    stages[stage] += row[stage]
+    result.setdefault(TOTAL, dict.fromkeys(STAGES, 0))
+    return result
+
+
+def percentile(values, q):
+    """``q``-th percentile of sorted ``values`` with linear interpolation,
+    same as ``numpy.percentile`` does by default
+    """
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(values, percentiles=None):
+    """
+    :type values: array.array
+    :rtype: dict
+    """
+    percentiles = percentiles or conf.ANALYTICS_PERCENTILES
+    summary = {'count': len(values)}
+    if numpy is not None and len(values):
+        data = numpy.frombuffer(values, dtype=numpy.float64)
+        points = numpy.percentile(data, percentiles)
+        for q, point in zip(percentiles, points):
+            summary['p{}'.format(q)] = float(point)
+    else:
+        data = sorted(values)
+        for q in percentiles:
+            summary['p{}'.format(q)] = percentile(data, q)
+    return summary
+
+
+def timings(querysets):
+    """Percentiles of time to start a payment (``performed - created``) and
+    to complete a started one (``completed - performed``), in seconds
+
+    :rtype: dict
+    """
+    to_process = {}
+    to_complete = {}
+    for queryset in querysets:
+        rows = queryset.filter(performed__isnull=False).values_list(
+            'payment_type', 'created', 'performed', 'completed')
+        # iterator() streams rows in chunks (with a server-side cursor where
+        # the backend supports it) instead of caching the whole result
+        for payment_type, created, performed, completed in rows.iterator():
+            value = (performed - created).total_seconds()
+            for key in (TOTAL, payment_type):
+                to_process.setdefault(key, array('d')).append(value)
+            if completed is not None:
+                value = (completed - performed).total_seconds()
+                for key in (TOTAL, payment_type):
+                    to_complete.setdefault(key, array('d')).append(value)
+
+    return {
+        'to_process': dict((key, summarize(values))
+                           for key, values in to_process.items()),
+        'to_complete': dict((key, summarize(values))
+                            for key, values in to_complete.items()),
+    }
+
+
+def report(since, until, use_cache=True):
+    """Funnel and timings of payments created within ``[since, until)``.
+    Results are cached per period
+
+    :type since: datetime.datetime
+    :type until: datetime.datetime
+    :rtype: dict
+    """
+    key = cache.make_key('analytics', '{}:{}'.format(since.isoformat(),
+                                                     until.isoformat()))
+    if use_cache:
+        result = cache.get_cache().get(key)
+        if result is not None:
+            return result
+
+    querysets = get_querysets(since, until)
+    result = {
+        'since': since,
+        'until': until,
+        'funnel': funnel(querysets),
+    }
+    result.update(timings(querysets))
+    cache.get_cache().set(key, result, conf.ANALYTICS_CACHE_TIMEOUT)
+    return result
+
+
+def _raw_chunks(queryset, size):
+    """Rows of a ``values_list`` queryset as the database driver returns
+    them, skipping per-value conversion by Django. Uses a server-side cursor
+    where the backend supports it
+    """
+    compiler = queryset.query.get_compiler(using=queryset.db)
+    sql, params = compiler.as_sql()
+    connection = connections[queryset.db]
+    cursor = getattr(connection, 'chunked_cursor', connection.cursor)()
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        cursor.close()
+
+
+def load_fee_columns(querysets, chunk_size=50000):
+    """Stream sums of paid payments into NumPy arrays, one per column of
+    ``FEE_COLUMNS``. Refunded payments count too: Kassa keeps its fee. Missing
+    values become ``nan``
+
+    :rtype: dict
+    """
+    dtypes = (object, object, numpy.float64, numpy.float64, numpy.float64,
+              numpy.float64)
+    parts = dict((name, []) for name in FEE_COLUMNS)
+    for queryset in querysets:
+        # checkOrder fills shop_sum, so it is set for unpaid payments too
+        queryset = queryset.filter(
+            state__in=Payment.PAID_STATES,
+            shop_sum__isnull=False).values_list(*FEE_COLUMNS)
+        for chunk in _raw_chunks(queryset, chunk_size):
+            for name, dtype, values in zip(FEE_COLUMNS, dtypes, zip(*chunk)):
+                parts[name].append(numpy.array(values, dtype=dtype))
+    columns = dict(
+        (name, numpy.concatenate(parts[name]) if parts[name]
+         else numpy.array([], dtype=dtype))
+        for name, dtype in zip(FEE_COLUMNS, dtypes))
+
+    field = Payment._meta.get_field('payment_type')
+    if conf.COMPACT_STORAGE:
+        # Raw values are storage codes and minor units
+        columns['payment_type'] = numpy.array(field.codes, dtype=object)[
+            columns['payment_type'].astype(numpy.intp)]
+        for name in ('order_sum', 'shop_sum'):
+            columns[name] /= 10 ** Payment._meta.get_field(
+                name).decimal_places
+    # Fixed width strings are much faster to group than objects
+    columns['payment_type'] = columns['payment_type'].astype(
+        'U{}'.format(field.max_length))
+    return columns
+
+
+def _fee_summary(order, fee, rate, outliers):
+    known = ~numpy.isnan(rate)
+    return {
+        'count': int(len(order)),
+        'order_total': float(order.sum()),
+        'fee_total': float(fee.sum()),
+        'rate': float(fee.sum() / order.sum()) if order.sum() else None,
+        'median_rate': float(numpy.median(rate[known]))
+        if known.any() else None,
+        'outliers': int(outliers.sum()),
+    }
+
+
+def fee_report(since, until, threshold=3.5, limit=20, chunk_size=50000):
+    """Kassa fees (``order_sum - shop_sum``) of payments created within
+    ``[since, until)``, by payment method. Requires NumPy.
+
+    A fee rate is an outlier when its robust z-score (based on the median
+    absolute deviation of the payment method) exceeds ``threshold``. A
+    payment is a mismatch when more than the order sum was received or
+    currencies differ. Only paid (and refunded) payments are counted.
+
+    :rtype: dict
+    """
+    if numpy is None:
+        raise ImproperlyConfigured('NumPy is required for fee analysis')
+
+    columns = load_fee_columns(get_querysets(since, until), chunk_size)
+    order = columns['order_sum']
+    fee = order - columns['shop_sum']
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        rate = numpy.where(order > 0, fee / order, numpy.nan)
+
+    types = columns['payment_type']
+    payment_types = numpy.unique(types)
+    scores = numpy.zeros(len(order))
+    for payment_type in payment_types:
+        selected = (types == payment_type) & ~numpy.isnan(rate)
+        if not selected.any():
+            continue
+        rates = rate[selected]
+        median = numpy.median(rates)
+        deviation = max(numpy.median(numpy.abs(rates - median)),
+                        MIN_RATE_DEVIATION)
+        scores[selected] = 0.6745 * numpy.abs(rates - median) / deviation
+    outliers = scores > threshold
+
+    shop_currency = columns['shop_currency']
+    with numpy.errstate(invalid='ignore'):
+        mismatches = (fee < 0) | (
+            ~numpy.isnan(shop_currency) &
+            (columns['order_currency'] != shop_currency))
+
+    by_type = {TOTAL: _fee_summary(order, fee, rate, outliers)}
+    for payment_type in payment_types:
+        selected = types == payment_type
+        by_type[six.text_type(payment_type)] = _fee_summary(
+            order[selected], fee[selected], rate[selected],
+            outliers[selected])
+
+    # Largest deviations first
+    flagged = numpy.flatnonzero(outliers)
+    flagged = flagged[numpy.argsort(-scores[flagged])]
+    return {
+        'since': since,
+        'until': until,
+        'by_payment_type': by_type,
+        'outliers': [(columns['order_id'][i], float(rate[i]))
+                     for i in flagged[:limit]],
+        'mismatch_count': int(mismatches.sum()),
+        'mismatches': [columns['order_id'][i]
+                       for i in numpy.flatnonzero(mismatches)[:limit]],
+    }
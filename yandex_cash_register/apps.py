@@ -2,9 +2,21 @@
 from __future__ import absolute_import, unicode_literals
 
 from django.apps import AppConfig
+from django.core import checks
 from django.utils.translation import ugettext_lazy as _
 
 
 class YandexMoneyConfig(AppConfig):
     name = 'yandex_cash_register'
     verbose_name = _('Yandex.Kassa payments')
+
+    def ready(self):
+        from . import conf, logs, pubsub
+        from .checks import check_compact_storage
+        checks.register(check_compact_storage, checks.Tags.database)
+        pubsub.connect()
+        if conf.LOG_QUEUE:
+            logs.setup_queue_logging()
+        if conf.WARMUP:
+            from . import warmup
+            warmup.warm_up()
@@ -0,0 +1,32 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from django.db.models import Case, F, Value, When
+
+from . import conf
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def update_rows(queryset, rows, batch_size=None, **common):
+    """Save different field values of many rows with one ``UPDATE ... SET
+    field = CASE pk WHEN ...`` per batch, instead of a query per row
+
+    :param rows: ``{pk: {field: value}}``, fields may differ between rows
+    :param common: values set on every row, e.g. a timestamp
+    """
+    model = queryset.model
+    batch_size = batch_size or conf.BULK_BATCH_SIZE
+    for chunk in chunks(sorted(rows), batch_size):
+        values = dict(common)
+        fields = set(field for pk in chunk for field in rows[pk])
+        for field in fields:
+            values[field] = Case(
+                *[When(pk=pk, then=Value(rows[pk][field]))
+                  for pk in chunk if field in rows[pk]],
+                default=F(field),
+                output_field=model._meta.get_field(field))
+        queryset.filter(pk__in=chunk).update(**values)
@@ -0,0 +1,77 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from hashlib import md5
+
+from django.core.cache import caches
+
+from . import conf
+
+
+def get_cache():
+    return caches[conf.CACHE]
+
+
+def make_key(prefix, order_id):
+    # Order IDs are arbitrary strings and may contain characters not allowed
+    # in memcached keys
+    return 'yandex_cr:{}:{}'.format(
+        prefix, md5(order_id.encode('utf-8')).hexdigest())
+
+
+def get_final_redirect(order_id):
+    """Return ``(state, url)`` saved for a completed payment, or ``None``
+
+    :type order_id: basestring
+    """
+    return get_cache().get(make_key('finish', order_id))
+
+
+def set_final_redirect(order_id, state, url):
+    """Remember where to send customer of a completed payment. Completed
+    payments don't change, so the entry lives until it is invalidated
+    """
+    get_cache().set(make_key('finish', order_id), (state, url),
+                    conf.FINISH_CACHE_TIMEOUT)
+
+
+def invalidate_final_redirect(order_id):
+    get_cache().delete(make_key('finish', order_id))
+
+
+def get_status(order_id):
+    """Return status saved by ``set_status``, or ``None``
+
+    :type order_id: basestring
+    """
+    return get_cache().get(make_key('status', order_id))
+
+
+def set_status(status, overwrite=True):
+    """
+    :type status: dict
+    :param status: result of ``Payment.get_status()``
+    :param overwrite: if ``False``, keep status that is already cached
+    """
+    key = make_key('status', status['order_id'])
+    if overwrite:
+        get_cache().set(key, status, conf.STATUS_CACHE_TIMEOUT)
+    else:
+        get_cache().add(key, status, conf.STATUS_CACHE_TIMEOUT)
+
+
+def _receipt_key(order_id, version, contact):
+    return make_key('receipt', '{}:{}:{}'.format(order_id, version, contact))
+
+
+def get_receipt(order_id, version, contact):
+    """Return receipt JSON saved by ``set_receipt``, or ``None``"""
+    return get_cache().get(_receipt_key(order_id, version, contact))
+
+
+def set_receipt(order_id, version, contact, receipt):
+    """Save receipt JSON of an order version. Another version of the order
+    gets another key, so entries are never invalidated, only expire
+    """
+    get_cache().set(_receipt_key(order_id, version, contact), receipt,
+                    conf.RECEIPT_CACHE_TIMEOUT)
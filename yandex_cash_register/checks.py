@@ -0,0 +1,73 @@
+# coding=utf-8
+"""System checks, registered in ``YandexMoneyConfig.ready()``. Database
+ones run on ``migrate`` and on ``manage.py check --tag database``.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from django.core import checks
+from django.db import DatabaseError, connections
+from django.db.migrations.recorder import MigrationRecorder
+
+from . import conf, routers
+
+
+COMPACT_MIGRATION = ('yandex_cash_register', '0005_compact_storage')
+# Columns that are integers in compact storage only
+COMPACT_COLUMNS = ('state', 'order_sum')
+
+
+def _column_types(connection, table):
+    """Django field types of the columns of ``table``, ``None`` if there is
+    no such table
+    """
+    with connection.cursor() as cursor:
+        if table not in connection.introspection.table_names(cursor):
+            return None
+        return dict(
+            (column.name, connection.introspection.get_field_type(
+                column.type_code, column))
+            for column in connection.introspection.get_table_description(
+                cursor, table))
+
+
+def _is_compact(connection):
+    """Whether payments are stored compactly in the database, ``None`` if
+    the storage is not chosen yet, i.e. the migration is not applied
+    """
+    from .models import Payment
+
+    if COMPACT_MIGRATION not in \
+            MigrationRecorder(connection).applied_migrations():
+        return None
+    types = _column_types(connection, Payment._meta.db_table)
+    if types is None:
+        return None
+    return all('Integer' in types[Payment._meta.get_field(name).column]
+               for name in COMPACT_COLUMNS)
+
+
+def check_compact_storage(app_configs=None, **kwargs):
+    """``YANDEX_CR_COMPACT_STORAGE`` picks column types when
+    ``0005_compact_storage`` is applied. Changing it afterwards makes the
+    fields write and read values in the wrong format
+    """
+    errors = []
+    for alias in routers.get_shards():
+        connection = connections[alias]
+        try:
+            compact = _is_compact(connection)
+        except DatabaseError:
+            # Not reachable yet, e.g. during a build
+            continue
+        if compact is None or compact == conf.COMPACT_STORAGE:
+            continue
+        errors.append(checks.Error(
+            'YANDEX_CR_COMPACT_STORAGE is {} but payments in database "{}" '
+            'are stored {}'.format(conf.COMPACT_STORAGE, alias,
+                                   'compactly' if compact else 'as strings '
+                                   'and decimals'),
+            hint='Set it back to {}: the storage is chosen once, when '
+                 'migration 0005_compact_storage is applied'.format(compact),
+            id='yandex_cash_register.E001',
+        ))
+    return errors
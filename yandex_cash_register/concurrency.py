@@ -0,0 +1,112 @@
+# coding=utf-8
+"""Running blocking calls, such as Kassa API requests, in parallel"""
+from __future__ import absolute_import, division, unicode_literals
+
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+_STOP = object()
+
+
+class RateLimiter(object):
+    """Token bucket shared by threads: ``wait()`` returns at most ``rate``
+    times per second on average, ``burst`` times at once
+
+    :type rate: float
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until a call is allowed
+
+        :return: time waited, in seconds
+        """
+        with self._lock:
+            current = time.time()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (current - self._updated) * self.rate)
+            self._updated = current
+            # Taking a token in advance reserves a place in the queue
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+def run_bounded(func, items, workers, backlog=None):
+    """Call ``func`` for every item in ``workers`` threads.
+
+    Items are taken from the iterable lazily, at most ``backlog`` of them
+    (twice the number of workers by default) waiting for a worker, so a
+    generator of thousands of database rows is never loaded at once.
+    Results are yielded in the calling thread as they become available.
+
+    :param func: called with an item, must be thread-safe
+    :type items: collections.Iterable
+    :return: iterator of ``(item, result, exc_info)`` tuples, in completion
+        order; ``exc_info`` is ``None`` unless ``func`` raised
+    """
+    tasks = queue.Queue(backlog or workers * 2)
+    results = queue.Queue()
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is _STOP:
+                results.put(_STOP)
+                return
+            try:
+                results.put((item, func(item), None))
+            except Exception:
+                results.put((item, None, sys.exc_info()))
+
+    threads = [threading.Thread(target=work, name='yandex-cr-worker')
+               for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    running = len(threads)
+    stopping = False
+    try:
+        for item in items:
+            tasks.put(item)
+            while True:
+                try:
+                    yield results.get_nowait()
+                except queue.Empty:
+                    break
+        stopping = True
+        for _ in threads:
+            tasks.put(_STOP)
+        while running:
+            result = results.get()
+            if result is _STOP:
+                running -= 1
+            else:
+                yield result
+    finally:
+        if not stopping:
+            # Iteration was stopped early: drop pending items
+            while True:
+                try:
+                    tasks.get_nowait()
+                except queue.Empty:
+                    break
+            for _ in threads:
+                tasks.put(_STOP)
@@ -53,6 +53,13 @@ BASE_PAYMENT_TYPE_CHOICES = (
     (PAYMENT_TYPE_QIWI_WALLET, _('QiWi wallet')),
 )
 
+# Storage codes of payment types for compact storage, append only
+PAYMENT_TYPE_CODES = ('', PAYMENT_TYPE_ALFA_CLICK, PAYMENT_TYPE_CARD,
+                      PAYMENT_TYPE_TERMINAL_CACHE, PAYMENT_TYPE_MASTER_PASS,
+                      PAYMENT_TYPE_MOBILE_ACCOUNT, PAYMENT_TYPE_PROMSVYASBANK,
+                      PAYMENT_TYPE_YANDEX_MONEY, PAYMENT_TYPE_SBERBANK,
+                      PAYMENT_TYPE_WEBMONEY, PAYMENT_TYPE_QIWI_WALLET)
+
 PAYMENT_TYPES = getattr(settings, 'YANDEX_CR_PAYMENT_TYPE',
                         ['AB', 'AC', 'GP', 'PB', 'PC', 'WM'])
 PAYMENT_TYPES = [str(x).upper() for x in PAYMENT_TYPES]
@@ -60,3 +67,125 @@ PAYMENT_TYPE_CHOICES = [c for c in BASE_PAYMENT_TYPE_CHOICES
                         if c[0] in PAYMENT_TYPES]
 
 MODEL = getattr(settings, 'YANDEX_CR_ORDER_MODEL').split('.')
+
+METRICS = getattr(settings, 'YANDEX_CR_METRICS', False)
+METRICS_DIR = getattr(settings, 'YANDEX_CR_METRICS_DIR', None)
+METRICS_FLUSH_INTERVAL = getattr(settings, 'YANDEX_CR_METRICS_FLUSH_INTERVAL',
+                                 5)
+
+FAST_VALIDATION = getattr(settings, 'YANDEX_CR_FAST_VALIDATION', False)
+
+CACHE = getattr(settings, 'YANDEX_CR_CACHE', 'default')
+FINISH_CACHE_TIMEOUT = getattr(settings, 'YANDEX_CR_FINISH_CACHE_TIMEOUT',
+                               60 * 60 * 24 * 7)
+STATUS_CACHE_TIMEOUT = getattr(settings, 'YANDEX_CR_STATUS_CACHE_TIMEOUT',
+                               60 * 60)
+RECEIPT_CACHE_TIMEOUT = getattr(settings, 'YANDEX_CR_RECEIPT_CACHE_TIMEOUT',
+                                60 * 60 * 24)
+
+# Long-poll wait/ endpoint holds a worker thread per waiting request
+WAIT = getattr(settings, 'YANDEX_CR_WAIT', False)
+PUBSUB_BACKEND = getattr(settings, 'YANDEX_CR_PUBSUB_BACKEND',
+                         'yandex_cash_register.pubsub.CachePubSub')
+PUBSUB_POLL_INTERVAL = getattr(settings, 'YANDEX_CR_PUBSUB_POLL_INTERVAL',
+                               0.5)
+WAIT_TIMEOUT = getattr(settings, 'YANDEX_CR_WAIT_TIMEOUT', 25)
+
+COMPACT_STORAGE = getattr(settings, 'YANDEX_CR_COMPACT_STORAGE', False)
+
+# 'yandex_cash_register.ids.uuid7' gives time-ordered customer IDs
+CUSTOMER_ID_FACTORY = getattr(settings, 'YANDEX_CR_CUSTOMER_ID_FACTORY',
+                              'uuid.uuid4')
+
+PRIMARY_DB = getattr(settings, 'YANDEX_CR_PRIMARY_DB', 'default')
+# Alias of the replica, or a dict of replicas by shard alias
+REPLICA_DB = getattr(settings, 'YANDEX_CR_REPLICA_DB', None)
+SHARDS = getattr(settings, 'YANDEX_CR_SHARDS', None)
+READ_YOUR_WRITES_WINDOW = getattr(settings,
+                                  'YANDEX_CR_READ_YOUR_WRITES_WINDOW', 5)
+
+ANALYTICS_PERCENTILES = getattr(settings, 'YANDEX_CR_ANALYTICS_PERCENTILES',
+                                (50, 90, 99))
+ANALYTICS_CACHE_TIMEOUT = getattr(settings,
+                                  'YANDEX_CR_ANALYTICS_CACHE_TIMEOUT', 60 * 60)
+
+JOURNAL = getattr(settings, 'YANDEX_CR_JOURNAL', False)
+JOURNAL_BATCH_SIZE = getattr(settings, 'YANDEX_CR_JOURNAL_BATCH_SIZE', 100)
+JOURNAL_FLUSH_INTERVAL = getattr(settings, 'YANDEX_CR_JOURNAL_FLUSH_INTERVAL',
+                                 1.0)
+JOURNAL_QUEUE_SIZE = getattr(settings, 'YANDEX_CR_JOURNAL_QUEUE_SIZE', 10000)
+JOURNAL_RETENTION_DAYS = getattr(settings, 'YANDEX_CR_JOURNAL_RETENTION_DAYS',
+                                 90)
+
+LOG_QUEUE = getattr(settings, 'YANDEX_CR_LOG_QUEUE', False)
+LOG_QUEUE_SIZE = getattr(settings, 'YANDEX_CR_LOG_QUEUE_SIZE', 10000)
+LOG_SUCCESS_SAMPLE_RATE = getattr(settings,
+                                  'YANDEX_CR_LOG_SUCCESS_SAMPLE_RATE', 1.0)
+
+API_URL = getattr(settings, 'YANDEX_CR_API_URL',
+                  'https://payment.yandex.net/api/v3/')
+API_SHOP_ID = getattr(settings, 'YANDEX_CR_API_SHOP_ID', SHOP_ID)
+API_SECRET_KEY = getattr(settings, 'YANDEX_CR_API_SECRET_KEY', None)
+API_POOL_SIZE = getattr(settings, 'YANDEX_CR_API_POOL_SIZE', 10)
+API_CONNECT_TIMEOUT = getattr(settings, 'YANDEX_CR_API_CONNECT_TIMEOUT', 3.05)
+API_READ_TIMEOUT = getattr(settings, 'YANDEX_CR_API_READ_TIMEOUT', 10)
+API_RETRIES = getattr(settings, 'YANDEX_CR_API_RETRIES', 3)
+API_BACKOFF = getattr(settings, 'YANDEX_CR_API_BACKOFF', 0.3)
+
+SYNC_MIN_AGE = getattr(settings, 'YANDEX_CR_SYNC_MIN_AGE', 60 * 60)
+SYNC_BATCH_SIZE = getattr(settings, 'YANDEX_CR_SYNC_BATCH_SIZE', 500)
+SYNC_WORKERS = getattr(settings, 'YANDEX_CR_SYNC_WORKERS', API_POOL_SIZE)
+# Fail processed payments of the HTTP protocol without paymentAviso after
+# that many seconds, 0 to only log them
+SYNC_LEGACY_EXPIRE = getattr(settings, 'YANDEX_CR_SYNC_LEGACY_EXPIRE',
+                             7 * 24 * 60 * 60)
+
+# Networks Yandex.Kassa sends API notifications from, None to allow any
+WEBHOOK_ALLOWED_IPS = getattr(settings, 'YANDEX_CR_WEBHOOK_ALLOWED_IPS', (
+    '185.71.76.0/27',
+    '185.71.77.0/27',
+    '77.75.153.0/25',
+    '77.75.154.128/25',
+    '77.75.156.11',
+    '77.75.156.35',
+    '2a02:5180::/32',
+))
+WEBHOOK_IP_HEADER = getattr(settings, 'YANDEX_CR_WEBHOOK_IP_HEADER',
+                            'REMOTE_ADDR')
+
+REFUND_RATE = getattr(settings, 'YANDEX_CR_REFUND_RATE', 5)
+REFUND_WORKERS = getattr(settings, 'YANDEX_CR_REFUND_WORKERS', API_POOL_SIZE)
+REFUND_BATCH_SIZE = getattr(settings, 'YANDEX_CR_REFUND_BATCH_SIZE', 500)
+
+BULK_BATCH_SIZE = getattr(settings, 'YANDEX_CR_BULK_BATCH_SIZE', 500)
+
+SUBSCRIPTION_ORDER_PREFIX = getattr(
+    settings, 'YANDEX_CR_SUBSCRIPTION_ORDER_PREFIX', 'rb')
+SUBSCRIPTION_RATE = getattr(settings, 'YANDEX_CR_SUBSCRIPTION_RATE', 10)
+SUBSCRIPTION_WORKERS = getattr(settings, 'YANDEX_CR_SUBSCRIPTION_WORKERS',
+                               API_POOL_SIZE)
+SUBSCRIPTION_BATCH_SIZE = getattr(settings,
+                                  'YANDEX_CR_SUBSCRIPTION_BATCH_SIZE', 500)
+SUBSCRIPTION_RETRY_DELAY = getattr(settings,
+                                   'YANDEX_CR_SUBSCRIPTION_RETRY_DELAY',
+                                   24 * 60 * 60)
+SUBSCRIPTION_MAX_FAILURES = getattr(settings,
+                                    'YANDEX_CR_SUBSCRIPTION_MAX_FAILURES', 3)
+
+# Lifetime of a hold when Kassa doesn't tell its expiry time
+HOLD_TTL = getattr(settings, 'YANDEX_CR_HOLD_TTL', 7 * 24 * 60 * 60)
+# Holds are cancelled that many seconds before they expire
+HOLD_CANCEL_MARGIN = getattr(settings, 'YANDEX_CR_HOLD_CANCEL_MARGIN',
+                             60 * 60)
+HOLD_RATE = getattr(settings, 'YANDEX_CR_HOLD_RATE', 10)
+HOLD_WORKERS = getattr(settings, 'YANDEX_CR_HOLD_WORKERS', API_POOL_SIZE)
+HOLD_BATCH_SIZE = getattr(settings, 'YANDEX_CR_HOLD_BATCH_SIZE', 500)
+
+# Look the order up in Payment.form() to add its receipt
+RECEIPTS = getattr(settings, 'YANDEX_CR_RECEIPTS', False)
+# VAT code of receipt items that don't set one, 1 is "no VAT"
+RECEIPT_TAX = getattr(settings, 'YANDEX_CR_RECEIPT_TAX', 1)
+RECEIPT_TAX_SYSTEM = getattr(settings, 'YANDEX_CR_RECEIPT_TAX_SYSTEM', None)
+
+# Load URLs, translations, lxml and templates when the process starts
+WARMUP = getattr(settings, 'YANDEX_CR_WARMUP', False)
@@ -0,0 +1,82 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import models
+
+from . import conf
+
+
+class CompactChoiceField(models.CharField):
+    """Char field with a fixed set of values. With compact storage enabled
+    the value is kept in the database as its index in ``codes``, a small
+    integer, while Python code keeps working with strings.
+
+    ``codes`` must only ever be appended to: position of a value is what
+    gets stored.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.codes = tuple(kwargs.pop('codes', ()))
+        self._indexes = dict((code, i) for i, code in enumerate(self.codes))
+        super(CompactChoiceField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(CompactChoiceField, self)\
+            .deconstruct()
+        kwargs['codes'] = self.codes
+        return name, path, args, kwargs
+
+    def get_internal_type(self):
+        if conf.COMPACT_STORAGE:
+            return 'PositiveSmallIntegerField'
+        return 'CharField'
+
+    def from_db_value(self, value, *args):
+        if value is None or not conf.COMPACT_STORAGE:
+            return value
+        return self.codes[value]
+
+    def get_prep_value(self, value):
+        value = super(CompactChoiceField, self).get_prep_value(value)
+        if value is None or not conf.COMPACT_STORAGE:
+            return value
+        try:
+            return self._indexes[value]
+        except KeyError:
+            raise ValueError('{!r} has no storage code in {}'.format(
+                value, self.name))
+
+
+class MinorUnitsDecimalField(models.DecimalField):
+    """Decimal field for money. With compact storage enabled the amount is
+    kept in the database as a big integer number of minor units (kopecks),
+    which makes comparison and aggregation exact and cheap.
+    """
+
+    def get_internal_type(self):
+        if conf.COMPACT_STORAGE:
+            return 'BigIntegerField'
+        return 'DecimalField'
+
+    def from_db_value(self, value, *args):
+        if value is None or not conf.COMPACT_STORAGE:
+            return value
+        return Decimal(str(value)).scaleb(-self.decimal_places)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not conf.COMPACT_STORAGE:
+            return super(MinorUnitsDecimalField, self).get_db_prep_value(
+                value, connection, prepared)
+        value = self.to_python(value)
+        if value is None:
+            return None
+        return int(value.scaleb(self.decimal_places).to_integral_value(
+            ROUND_HALF_UP))
+
+    def get_db_prep_save(self, value, connection):
+        if not conf.COMPACT_STORAGE:
+            return super(MinorUnitsDecimalField, self).get_db_prep_save(
+                value, connection)
+        return self.get_db_prep_value(value, connection)
@@ -1,21 +1,109 @@
 # coding=utf-8
 from __future__ import absolute_import, unicode_literals
 
+from decimal import Decimal, ROUND_HALF_EVEN
 from hashlib import md5
 
 from django import forms
 from django.apps import apps
-from django.utils.functional import cached_property
+from django.utils.crypto import constant_time_compare
 from django.utils.translation import ugettext_lazy, ugettext as _
 
 from .apps import YandexMoneyConfig
-from . import conf
+from . import conf, metrics, routers
 
 
 readonly_widget = forms.TextInput(attrs={'readonly': 'readonly'})
 
 
-class ShopIdForm(forms.Form):
+def make_md5(data, keys):
+    """
+    action;orderSumAmount;orderSumCurrencyPaycash;orderSumBankPaycash;shopId;invoiceId;customerNumber;shopPassword
+    """
+    md5_base = ';'.join(str(data.get(key, '')) for key in keys)
+    md5_base = '{};{}'.format(md5_base, conf.SHOP_PASSWORD).encode('utf-8')
+    return md5(md5_base).hexdigest().upper()
+
+
+def get_payment(order_number):
+    """Find payment by order number without locking it
+
+    :type order_number: basestring
+    :rtype: yandex_cash_register.models.Payment
+    """
+    payment_model = apps.get_model(YandexMoneyConfig.name, 'Payment')
+    try:
+        return payment_model.objects.for_order(order_number).get(
+            order_id=order_number)
+    except payment_model.DoesNotExist:
+        return None
+
+
+def get_locked_payment(order_number, source):
+    """Find payment by order number and lock its row until the end of the
+    current transaction
+
+    :type order_number: basestring
+    :param source: name of the caller, used to label lock wait metrics
+    :rtype: yandex_cash_register.models.Payment
+    """
+    payment_model = apps.get_model(YandexMoneyConfig.name, 'Payment')
+    with metrics.registry.timer(metrics.LOCK_WAIT, source=source):
+        try:
+            return payment_model.objects.for_order(order_number)\
+                .select_for_update().get(order_id=order_number)
+        except payment_model.DoesNotExist:
+            return None
+
+
+class PaymentLookupMixin(object):
+    """Gives form access to the payment its data refers to.
+
+    Validation works with a plain unlocked read. Anything that changes the
+    payment should call ``lock_payment`` inside a transaction first, so that
+    the row stays locked only for the time of the state change.
+    """
+    order_number_field = NotImplemented
+
+    def can_access_payment(self):
+        """Whether form data is trusted enough to look payment up in the
+        database. Until it is, ``payment_obj`` is ``None``
+        """
+        return True
+
+    @property
+    def payment_obj(self):
+        """
+        :rtype: yandex_cash_register.models.Payment
+        """
+        if '_payment' not in self.__dict__:
+            if not self.can_access_payment():
+                return None
+            self._payment = get_payment(
+                self.cleaned_data.get(self.order_number_field))
+        return self._payment
+
+    def payment_db(self):
+        """Database alias the payment lives in, to open the locking
+        transaction on
+        """
+        return routers.shard_for(
+            self.cleaned_data.get(self.order_number_field))
+
+    def lock_payment(self):
+        """Re-read payment locking its row
+
+        :rtype: yandex_cash_register.models.Payment
+        """
+        self._payment = get_locked_payment(
+            self.cleaned_data.get(self.order_number_field),
+            self.__class__.__name__)
+        return self._payment
+
+
+class ShopIdForm(PaymentLookupMixin, forms.Form):
+    order_number_field = 'orderNumber'
+
     shopId = forms.IntegerField(initial=conf.SHOP_ID, widget=readonly_widget)
     orderNumber = forms.CharField(min_length=1, max_length=64,
                                   widget=readonly_widget)
@@ -26,28 +114,19 @@ class ShopIdForm(forms.Form):
         min_length=2, max_length=2
     )
 
-    @cached_property
-    def payment_obj(self):
-        """
-        :rtype: yandex_cash_register.models.Payment
-        """
-        payment_model = apps.get_model(YandexMoneyConfig.name, 'Payment')
-        order_number = self.cleaned_data.get('orderNumber')
-        try:
-            return payment_model.objects.select_for_update().get(
-                order_id=order_number)
-        except payment_model.DoesNotExist:
-            return None
+    @staticmethod
+    def _unknown_order_error(order_number):
+        return forms.ValidationError(
+            _('Cannot find payment with order ID %(order_number)s'),
+            code='invalid',
+            params={'order_number': order_number},
+        )
 
     def clean_orderNumber(self):
         order_number = self.cleaned_data.get('orderNumber')
         payment = self.payment_obj
         if payment is None:
-            raise forms.ValidationError(
-                _('Cannot find payment with order ID %(order_number)s'),
-                code='invalid',
-                params={'order_number': order_number},
-            )
+            raise self._unknown_order_error(order_number)
         return order_number
 
     def clean_shopId(self):
@@ -98,10 +177,16 @@ class PaymentForm(ShopIdForm):
     shopSuccessURL = forms.URLField(initial=conf.SUCCESS_URL,
                                     widget=readonly_widget)
 
+    # Fiscal receipt JSON, see yandex_cash_register.receipts
+    ym_merchant_receipt = forms.CharField(required=False,
+                                          widget=readonly_widget)
+
     use_required_attribute = False
 
     def __init__(self, *args, **kwargs):
         super(PaymentForm, self).__init__(*args, **kwargs)
+        if not self.initial.get('ym_merchant_receipt'):
+            del self.fields['ym_merchant_receipt']
 
         if not conf.DEBUG:
             for name in self.fields:
@@ -116,7 +201,50 @@ class PaymentForm(ShopIdForm):
         return conf.TARGET
 
 
-class PaymentProcessingForm(ShopIdForm):
+class NotificationErrorsMixin(object):
+    """Error codes reported back to Yandex.Kassa in checkOrder and
+    paymentAviso responses
+    """
+    ERROR_CODE_MD5 = 1
+    ERROR_CODE_UNKNOWN_ORDER = 100
+    ERROR_CODE_INTERNAL = 200
+
+    _error_code = None
+    _error_message = None
+
+    def set_error(self, code, message, raise_error=False):
+        self._error_code = code
+        self._error_message = message
+        if raise_error:
+            raise forms.ValidationError(message)
+
+    def _set_field_error(self):
+        if 'md5' in self.errors:
+            self.set_error(self.ERROR_CODE_MD5, _('MD5 is incorrect'))
+        elif 'customerNumber' in self.errors or \
+                'orderNumber' in self.errors:
+            self.set_error(self.ERROR_CODE_UNKNOWN_ORDER,
+                           _('No such order'))
+        else:
+            self.set_error(self.ERROR_CODE_INTERNAL,
+                           _('Cannot process payment'))
+
+    @staticmethod
+    def _round(paysum):
+        if not isinstance(paysum, Decimal):
+            paysum = Decimal(str(paysum))
+        return int(paysum.scaleb(-1).to_integral_value(ROUND_HALF_EVEN)) * 10
+
+    @property
+    def error_code(self):
+        return self._error_code
+
+    @property
+    def error_message(self):
+        return self._error_message
+
+
+class PaymentProcessingForm(NotificationErrorsMixin, ShopIdForm):
     ACTION_CHECK = 'checkOrder'
     ACTION_CPAYMENT = 'paymentAviso'
 
@@ -128,10 +256,6 @@ class PaymentProcessingForm(ShopIdForm):
                      'orderSumBankPaycash', 'shopId', 'invoiceId',
                      'customerNumber']
 
-    ERROR_CODE_MD5 = 1
-    ERROR_CODE_UNKNOWN_ORDER = 100
-    ERROR_CODE_INTERNAL = 200
-
     md5 = forms.CharField(min_length=32, max_length=32)
     invoiceId = forms.IntegerField(min_value=1)
     orderSumAmount = forms.DecimalField(min_value=0, decimal_places=2)
@@ -146,48 +270,40 @@ class PaymentProcessingForm(ShopIdForm):
     def __init__(self, *args, **kwargs):
         super(PaymentProcessingForm, self).__init__(*args, **kwargs)
 
-        self._error_code = None
-        self._error_message = None
+        self._signature_verified = False
 
-    def _make_md5(self):
-        """
-        action;orderSumAmount;orderSumCurrencyPaycash;orderSumBankPaycash;shopId;invoiceId;customerNumber;shopPassword
-        """
-        md5_base = ';'.join(str(self.cleaned_data.get(key, ''))
-                            for key in self.MD5_KEY_ORDER)
-        md5_base = '{};{}'.format(md5_base, conf.SHOP_PASSWORD).encode('utf-8')
-        return md5(md5_base).hexdigest().upper()
+    def can_access_payment(self):
+        # Requests are authenticated only by their MD5 signature, so nothing
+        # touches the database (or takes a lock) before it is checked
+        return self._signature_verified
 
-    def set_error(self, code, message, raise_error=False):
-        self._error_code = code
-        self._error_message = message
-        if raise_error:
-            raise forms.ValidationError(message)
+    def _make_md5(self):
+        return make_md5(self.cleaned_data, self.MD5_KEY_ORDER)
 
-    @staticmethod
-    def _round(paysum):
-        paysum = float(paysum)
-        return int(round(paysum / 10, 0)) * 10
+    def clean_orderNumber(self):
+        # Payment is looked up in clean() once the signature is verified
+        return self.cleaned_data.get('orderNumber')
 
     def clean(self):
-        data = super(PaymentProcessingForm, self).clean()
+        data = self.cleaned_data
         if self.errors:
-            if 'md5' in self.errors:
-                self.set_error(self.ERROR_CODE_MD5, _('MD5 is incorrect'))
-            elif 'customerNumber' in self.errors or \
-                    'orderNumber' in self.errors:
-                self.set_error(self.ERROR_CODE_UNKNOWN_ORDER,
-                               _('No such order'))
-            else:
-                self.set_error(self.ERROR_CODE_INTERNAL,
-                               _('Cannot process payment'))
-
+            self._set_field_error()
             return data
 
-        if self._make_md5() != data['md5']:
+        if not constant_time_compare(self._make_md5(), data['md5']):
             self.set_error(self.ERROR_CODE_MD5, _('MD5 is incorrect'),
                            raise_error=True)
 
+        self._signature_verified = True
+        if self.payment_obj is None:
+            self.add_error('orderNumber',
+                           self._unknown_order_error(data['orderNumber']))
+
+        data = super(PaymentProcessingForm, self).clean()
+        if self.errors:
+            self._set_field_error()
+            return data
+
         if self._round(self.payment_obj.order_sum) != self._round(
                 data['orderSumAmount']):
             self.set_error(self.ERROR_CODE_UNKNOWN_ORDER,
@@ -195,16 +311,8 @@ class PaymentProcessingForm(ShopIdForm):
 
         return data
 
-    @property
-    def error_code(self):
-        return self._error_code
 
-    @property
-    def error_message(self):
-        return self._error_message
-
-
-class FinalPaymentStateForm(forms.Form):
+class FinalPaymentStateForm(PaymentLookupMixin, forms.Form):
     ACTION_FAIL = 'payment_fail'
     ACTION_CONFIRM = 'payment_confirm'
 
@@ -215,15 +323,4 @@ class FinalPaymentStateForm(forms.Form):
     cr_action = forms.ChoiceField(choices=ACTION_CHOICES)
     cr_order_number = forms.CharField(min_length=1, max_length=64)
 
-    @cached_property
-    def payment_obj(self):
-        """
-        :rtype: yandex_cash_register.models.Payment
-        """
-        payment_model = apps.get_model(YandexMoneyConfig.name, 'Payment')
-        order_number = self.cleaned_data.get('cr_order_number')
-        try:
-            return payment_model.objects.select_for_update().get(
-                order_id=order_number)
-        except payment_model.DoesNotExist:
-            return None
+    order_number_field = 'cr_order_number'
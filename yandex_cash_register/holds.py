@@ -0,0 +1,192 @@
+# coding=utf-8
+"""Two-stage payments: the money is held first and captured later.
+
+A payment is created with ``capture=False`` and becomes ``authorized`` once
+the payer confirms it (``payment.waiting_for_capture`` notification). When
+the order ships, ``request_capture()`` marks its payment with one
+``UPDATE`` per shard, and ``process_holds()`` (the ``process_holds``
+command) captures marked payments and cancels the ones about to expire, API
+calls running concurrently under a rate limit. A capture sends
+``payment_success`` and a cancel ``payment_fail``, the same signals as for
+one-stage payments.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+import logging
+
+from django.utils.timezone import now
+
+from . import bulk, concurrency, conf, kassa, routers
+from .models import Payment
+from .views import locked_transaction
+
+
+logger = logging.getLogger(__name__)
+
+ACTION_CAPTURE = 'capture'
+ACTION_CANCEL = 'cancel'
+
+RESULTS = ('captured', 'cancelled', 'skipped', 'errors')
+
+
+def request_capture(order_ids, batch_size=None):
+    """Mark authorized payments of shipped orders for capture
+
+    :return: number of payments marked
+    """
+    batch_size = batch_size or conf.HOLD_BATCH_SIZE
+    by_shard = {}
+    for order_id in order_ids:
+        by_shard.setdefault(routers.shard_for(order_id), []).append(order_id)
+
+    marked = 0
+    for alias, shard_order_ids in by_shard.items():
+        for chunk in bulk.chunks(shard_order_ids, batch_size):
+            marked += Payment.objects.using(alias).filter(
+                order_id__in=chunk, state=Payment.STATE_AUTHORIZED,
+                capture_requested__isnull=True,
+            ).update(capture_requested=now())
+    return marked
+
+
+def apply_result(order_id, data):
+    """Capture or cancel a locally authorized payment according to its API
+    payment object. Does nothing if it was changed meanwhile, e.g. by a
+    notification
+
+    :return: new state, or ``None`` if the payment is left as is
+    """
+    with locked_transaction('hold', routers.shard_for(order_id)):
+        payment = Payment.objects.for_order(order_id).select_for_update(
+        ).get(order_id=order_id)
+        if payment.state != Payment.STATE_AUTHORIZED or \
+                data['status'] not in ('succeeded', 'canceled'):
+            return None
+        kassa.update_payment(payment, data)
+        if data['status'] == 'succeeded':
+            payment.complete()
+        else:
+            payment.fail()
+        return payment.state
+
+
+def submit(client, action, external_id, order_id, amount=None,
+           currency='RUB'):
+    """Capture or cancel a payment in Kassa. The idempotence key is derived
+    from the order ID, so repeating it is safe. If the payment can no
+    longer be changed (e.g. the hold expired), its current state is
+    returned instead
+
+    :rtype: dict
+    """
+    key = '{}:{}'.format(order_id, action)
+    try:
+        if action == ACTION_CAPTURE:
+            return client.capture_payment(external_id, amount, currency,
+                                          idempotence_key=key)
+        return client.cancel_payment(external_id, idempotence_key=key)
+    except kassa.KassaError as e:
+        if e.status != 400:
+            raise
+        return client.get_payment(external_id)
+
+
+def capture(payment, amount=None, client=None):
+    """Capture an authorized payment now, fully or ``amount`` of it
+
+    :type payment: yandex_cash_register.models.Payment
+    :return: new state of the payment, ``None`` if unchanged
+    """
+    data = submit(client or kassa.get_client(), ACTION_CAPTURE,
+                  payment.external_id, payment.order_id, amount,
+                  payment.order_currency)
+    return apply_result(payment.order_id, data)
+
+
+def cancel(payment, client=None):
+    """Cancel an authorized payment now, releasing the held money
+
+    :type payment: yandex_cash_register.models.Payment
+    :return: new state of the payment, ``None`` if unchanged
+    """
+    data = submit(client or kassa.get_client(), ACTION_CANCEL,
+                  payment.external_id, payment.order_id)
+    return apply_result(payment.order_id, data)
+
+
+def _holds(queryset, action, batch_size):
+    queryset = queryset.order_by('pk').values('pk', 'order_id',
+                                              'external_id')
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        for row in batch:
+            row['action'] = action
+            yield row
+        if len(batch) < batch_size:
+            return
+        last_pk = batch[-1]['pk']
+
+
+def process_holds(workers=None, rate=None, client=None, batch_size=None,
+                  at=None):
+    """Capture authorized payments marked by ``request_capture()`` and
+    cancel unmarked ones expiring within ``YANDEX_CR_HOLD_CANCEL_MARGIN``
+    seconds of ``at`` (now by default)
+
+    :param rate: API requests per second
+    :return: number of payments by result, see ``RESULTS``
+    :rtype: dict
+    """
+    client = client or kassa.get_client()
+    workers = workers or conf.HOLD_WORKERS
+    batch_size = batch_size or conf.HOLD_BATCH_SIZE
+    limiter = concurrency.RateLimiter(rate or conf.HOLD_RATE)
+    expiring = (at or now()) + datetime.timedelta(
+        seconds=conf.HOLD_CANCEL_MARGIN)
+
+    def call(row):
+        limiter.wait()
+        return submit(client, row['action'], row['external_id'],
+                      row['order_id'])
+
+    counts = dict.fromkeys(RESULTS, 0)
+    for queryset in Payment.objects.fan_out():
+        held = queryset.filter(state=Payment.STATE_AUTHORIZED,
+                               external_id__isnull=False)
+
+        def rows():
+            for row in _holds(held.filter(capture_requested__isnull=False),
+                              ACTION_CAPTURE, batch_size):
+                yield row
+            for row in _holds(held.filter(capture_requested__isnull=True,
+                                          hold_expires__lte=expiring),
+                              ACTION_CANCEL, batch_size):
+                yield row
+
+        # API calls run in worker threads, database work stays in this one
+        for row, data, exc_info in concurrency.run_bounded(
+                call, rows(), workers):
+            if exc_info is not None:
+                logger.warning('Failed to %s payment #%s', row['action'],
+                               row['order_id'], exc_info=exc_info)
+                counts['errors'] += 1
+                continue
+            try:
+                state = apply_result(row['order_id'], data)
+            except Exception:
+                logger.exception('Failed to save payment #%s',
+                                 row['order_id'])
+                counts['errors'] += 1
+                continue
+            if state == Payment.STATE_SUCCESS:
+                counts['captured'] += 1
+            elif state == Payment.STATE_FAIL:
+                counts['cancelled'] += 1
+            else:
+                counts['skipped'] += 1
+            if state is not None:
+                logger.info('Payment #%s after %s: state %s',
+                            row['order_id'], row['action'], state)
+    return counts
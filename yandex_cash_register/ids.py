@@ -0,0 +1,80 @@
+# coding=utf-8
+"""Time-ordered identifiers.
+
+Random ``uuid4`` keys land all over unique B-tree indexes, so each insert
+touches a different index page. Identifiers generated here start with a
+millisecond timestamp and grow monotonically within a process, so new rows
+are appended to the "right" edge of the index instead.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import binascii
+import os
+import threading
+import time
+import uuid
+
+from django.utils.module_loading import import_string
+
+from . import conf
+
+
+CROCKFORD_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_counter = 0
+
+
+def _random_bits(bits):
+    value = int(binascii.hexlify(os.urandom((bits + 7) // 8)), 16)
+    return value & ((1 << bits) - 1)
+
+
+def uuid7():
+    """Return UUID version 7: 48-bit unix time in milliseconds, 12-bit
+    counter and 62 random bits. UUIDs generated by one process are strictly
+    increasing, even within the same millisecond.
+
+    :rtype: uuid.UUID
+    """
+    global _last_ms, _last_counter
+    with _lock:
+        ms = int(time.time() * 1000)
+        if ms > _last_ms:
+            # Random start leaves room for the counter to grow
+            counter = _random_bits(11)
+        else:
+            ms = _last_ms
+            counter = _last_counter + 1
+            if counter > 0xfff:
+                ms += 1
+                counter = _random_bits(11)
+        _last_ms, _last_counter = ms, counter
+
+    value = (ms << 80) | (0x7 << 76) | (counter << 64) | (0x2 << 62) | \
+        _random_bits(62)
+    return uuid.UUID(int=value)
+
+
+def make_order_id(prefix=''):
+    """Return a monotonic order ID: ``prefix`` followed by 26 characters of
+    Crockford's base32, ULID-style. Fits ``Payment.order_id`` for prefixes
+    up to 24 characters.
+
+    :type prefix: basestring
+    :rtype: basestring
+    """
+    value = uuid7().int
+    chars = []
+    for i in range(26):
+        chars.append(CROCKFORD_ALPHABET[value & 0x1f])
+        value >>= 5
+    return prefix + ''.join(reversed(chars))
+
+
+def new_customer_id():
+    """Default for ``Payment.customer_id``, generated by the callable set in
+    ``YANDEX_CR_CUSTOMER_ID_FACTORY``
+    """
+    return import_string(conf.CUSTOMER_ID_FACTORY)()
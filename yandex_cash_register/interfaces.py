@@ -24,3 +24,21 @@ class IPayableOrder(object):
 
         :return: An order object
         """
+
+    # Optional, for fiscal receipts (see yandex_cash_register.receipts).
+    # Implement them in the order model, not by inheriting these stubs
+
+    def get_receipt_items(self):
+        """Items of the fiscal receipt of the order
+
+        :return: list of dicts with ``text``, ``quantity``, ``price``
+            (``Decimal``) and optionally ``tax``, ``paymentMethodType`` and
+            ``paymentSubjectType``
+        """
+
+    def get_receipt_version(self):
+        """Value that changes whenever receipt items change, such as the
+        modification time of the order. Receipts are cached by it
+
+        :return: a string or a number, ``None`` disables caching
+        """
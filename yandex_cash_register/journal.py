@@ -0,0 +1,178 @@
+# coding=utf-8
+"""Journal of raw Yandex.Kassa notifications.
+
+Request threads only put a plain dict into a queue. A background thread
+compresses the payloads and inserts them in batches, so journaling costs a
+notification next to nothing and the database sees one insert per batch.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from django.db import close_old_connections
+from django.http.request import RawPostDataException
+from django.utils.timezone import now
+
+from . import conf, metrics
+
+
+logger = logging.getLogger(__name__)
+
+META_KEYS = ('CONTENT_TYPE', 'CONTENT_LENGTH', 'REMOTE_ADDR')
+
+
+class JournalWriter(object):
+    """Buffers journal entries and writes them with ``bulk_create``.
+
+    :param background: write from a daemon thread; otherwise entries stay
+        in the queue until ``flush`` is called
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, queue_size=None,
+                 background=True):
+        self.batch_size = batch_size or conf.JOURNAL_BATCH_SIZE
+        self.flush_interval = flush_interval or conf.JOURNAL_FLUSH_INTERVAL
+        self.queue_size = queue_size or conf.JOURNAL_QUEUE_SIZE
+        self.background = background
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _get_queue(self):
+        # Queue and thread don't survive fork, so workers of a preforking
+        # server get their own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(self.queue_size)
+                    self._thread = None
+                    self._pid = os.getpid()
+        if self.background and self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='yandex-cr-journal')
+                    self._thread.daemon = True
+                    self._thread.start()
+        return self._queue
+
+    def record(self, entry):
+        """
+        :type entry: dict
+        :param entry: ``NotificationJournal`` fields, with ``payload`` as
+            a dict to be compressed
+        """
+        try:
+            self._get_queue().put_nowait(entry)
+        except queue.Full:
+            metrics.registry.inc(metrics.JOURNAL_DROPPED)
+
+    def flush(self):
+        """Write everything queued so far
+
+        :return: number of entries written
+        """
+        entries = []
+        journal_queue = self._get_queue()
+        while True:
+            try:
+                entries.append(journal_queue.get_nowait())
+            except queue.Empty:
+                break
+        for start in range(0, len(entries), self.batch_size):
+            self._write(entries[start:start + self.batch_size])
+        return len(entries)
+
+    def _run(self):
+        journal_queue = self._queue
+        while True:
+            entries = [journal_queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(entries) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entries.append(journal_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(entries)
+
+    def _write(self, entries):
+        from .models import NotificationJournal
+
+        try:
+            NotificationJournal.objects.bulk_create([
+                NotificationJournal(
+                    payload=NotificationJournal.pack(entry['payload']),
+                    **dict((key, value) for key, value in entry.items()
+                           if key != 'payload'))
+                for entry in entries
+            ])
+        except Exception:
+            logger.exception('Failed to write %d journal entries',
+                             len(entries))
+            if self.background:
+                close_old_connections()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = JournalWriter()
+                atexit.register(_writer.flush)
+    return _writer
+
+
+def record_notification(request, response, duration, code=None,
+                        action=None, order_id=None):
+    """Put a notification and the response to it into the journal, if it is
+    enabled
+
+    :type request: django.http.HttpRequest
+    :type response: django.http.HttpResponse
+    :param duration: time spent serving the request, in seconds
+    :param code: result code sent to Yandex.Kassa
+    :param action: notification type, ``action`` form field by default
+    :param order_id: ``orderNumber`` form field by default
+    """
+    if not conf.JOURNAL:
+        return
+
+    try:
+        body = request.body
+    except RawPostDataException:
+        body = request.POST.urlencode().encode('utf-8')
+    headers = dict((key, value) for key, value in request.META.items()
+                   if key.startswith('HTTP_') or key in META_KEYS)
+    get_writer().record({
+        'created': now(),
+        'action': (action or request.POST.get('action', ''))[:32],
+        'order_id': (order_id or request.POST.get('orderNumber', ''))[:64],
+        'code': code,
+        'duration': duration,
+        'payload': {
+            # Latin-1 maps bytes to characters one to one, so the body is
+            # restored exactly with .encode('latin-1')
+            'body': body.decode('latin-1'),
+            'headers': headers,
+            'status': response.status_code,
+            'response': response.content.decode('utf-8', 'replace'),
+        },
+    })
@@ -0,0 +1,380 @@
+# coding=utf-8
+"""Client of the Yandex.Kassa REST API (protocol v3).
+
+All calls go through one ``requests`` session per process, so connections
+to the API are kept alive and reused instead of paying for a TCP and TLS
+handshake on each call. Failed connections and 429/5xx responses are
+retried with backoff; that is safe for POST requests too, because every one
+of them carries an ``Idempotence-Key``.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+import logging
+import os
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.six.moves.urllib.parse import quote
+
+from . import conf
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    requests = None
+
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    asyncio = None
+
+
+logger = logging.getLogger(__name__)
+
+CURRENCIES = {643: 'RUB', 10643: 'RUB'}
+CURRENCY_CODES = {'RUB': 643}
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# API payment method types and their payment types of the HTTP protocol
+PAYMENT_METHODS = {
+    'alfabank': conf.PAYMENT_TYPE_ALFA_CLICK,
+    'bank_card': conf.PAYMENT_TYPE_CARD,
+    'cash': conf.PAYMENT_TYPE_TERMINAL_CACHE,
+    'mobile_balance': conf.PAYMENT_TYPE_MOBILE_ACCOUNT,
+    'qiwi': conf.PAYMENT_TYPE_QIWI_WALLET,
+    'sberbank': conf.PAYMENT_TYPE_SBERBANK,
+    'webmoney': conf.PAYMENT_TYPE_WEBMONEY,
+    'yandex_money': conf.PAYMENT_TYPE_YANDEX_MONEY,
+}
+
+
+class KassaError(Exception):
+    """Error response of the API, or the API being unreachable
+
+    :ivar status: HTTP status code, ``None`` if no response was received
+    :ivar data: decoded error response, e.g. ``{'type': 'error',
+        'code': 'invalid_request', 'description': ...}``
+    """
+
+    def __init__(self, message, status=None, data=None):
+        super(KassaError, self).__init__(message)
+        self.status = status
+        self.data = data or {}
+
+    @property
+    def code(self):
+        return self.data.get('code')
+
+
+def _make_retry(retries, backoff):
+    kwargs = dict(total=retries, connect=retries, read=retries,
+                  status=retries, backoff_factor=backoff,
+                  status_forcelist=RETRY_STATUSES,
+                  raise_on_status=False)
+    try:
+        # Retry all methods, requests are made idempotent by their keys
+        return Retry(allowed_methods=None, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=False, **kwargs)
+
+
+def make_session(pool_size=None, retries=None, backoff=None):
+    """``requests`` session with a connection pool of ``pool_size``
+    keep-alive connections per host
+
+    :rtype: requests.Session
+    """
+    if requests is None:
+        raise ImproperlyConfigured('requests is required for the Kassa API')
+    pool_size = pool_size or conf.API_POOL_SIZE
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size, pool_block=True,
+        max_retries=_make_retry(
+            conf.API_RETRIES if retries is None else retries,
+            conf.API_BACKOFF if backoff is None else backoff))
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def format_amount(value, currency='RUB'):
+    """
+    :type value: decimal.Decimal
+    :param currency: ISO 4217 code, either alphabetic or numeric as in
+        ``Payment.order_currency``
+    :rtype: dict
+    """
+    return {
+        'value': '{:.2f}'.format(Decimal(value)),
+        'currency': CURRENCIES.get(currency, currency),
+    }
+
+
+def amount_matches(amount, payment, partial=False):
+    """Whether API ``amount`` is the order sum of ``payment`` in its
+    currency. A ``partial`` one (a hold captured in part) may be less
+
+    :type amount: dict
+    :type payment: yandex_cash_register.models.Payment
+    :rtype: bool
+    """
+    expected = format_amount(payment.order_sum, payment.order_currency)
+    try:
+        value = Decimal(amount['value'])
+        currency = amount['currency']
+    except (KeyError, TypeError, ValueError, ArithmeticError):
+        return False
+    if currency != expected['currency']:
+        return False
+    if partial:
+        return 0 < value <= Decimal(expected['value'])
+    return value == Decimal(expected['value'])
+
+
+def parse_time(value):
+    """Datetime of an API time string such as ``2017-11-10T05:54:42.563Z``,
+    naive in the current time zone unless ``USE_TZ`` is set
+
+    :rtype: datetime.datetime
+    """
+    value = parse_datetime(value)
+    if value is not None and not settings.USE_TZ:
+        value = timezone.make_naive(value)
+    return value
+
+
+def update_payment(payment, data):
+    """Copy details of an API payment object into a local payment. Changes
+    are saved by the next state transition
+
+    :type payment: yandex_cash_register.models.Payment
+    :type data: dict
+    """
+    payment.external_id = data['id']
+    if not payment.invoice_id:
+        payment.invoice_id = data['id']
+    income = data.get('income_amount')
+    if income:
+        payment.shop_sum = Decimal(income['value'])
+        payment.shop_currency = CURRENCY_CODES.get(income['currency'],
+                                                   payment.shop_currency)
+    method = data.get('payment_method') or {}
+    if not payment.payment_type and method.get('type') in PAYMENT_METHODS:
+        payment.payment_type = PAYMENT_METHODS[method['type']]
+    if data.get('expires_at'):
+        # Authorized payment is cancelled by Kassa at this time
+        payment.hold_expires = parse_time(data['expires_at'])
+    if method.get('saved'):
+        # Created with save_payment_method, can be charged again
+        payment.payment_method_id = method['id']
+
+
+class KassaClient(object):
+    """Yandex.Kassa API client, safe to share between threads.
+
+    :param url: API base URL
+    :param shop_id: shop ID, used as the HTTP basic auth user name
+    :param secret_key: secret key of the shop
+    :param session: session to use instead of a new pooled one
+    :param timeout: ``(connect, read)`` timeouts in seconds
+    """
+
+    def __init__(self, url=None, shop_id=None, secret_key=None,
+                 session=None, timeout=None, pool_size=None, retries=None):
+        self.url = (url or conf.API_URL).rstrip('/') + '/'
+        self.auth = ('{}'.format(shop_id or conf.API_SHOP_ID),
+                     secret_key or conf.API_SECRET_KEY)
+        self.timeout = timeout or (conf.API_CONNECT_TIMEOUT,
+                                   conf.API_READ_TIMEOUT)
+        self.session = session or make_session(pool_size, retries)
+
+    def request(self, method, path, data=None, idempotence_key=None):
+        """Make an API call
+
+        :param idempotence_key: ``Idempotence-Key`` of a POST request,
+            repeated requests with the same key have the same result.
+            Random if not given
+        :rtype: dict
+        :raises KassaError:
+        """
+        headers = {}
+        if method == 'POST':
+            headers['Idempotence-Key'] = '{}'.format(
+                idempotence_key or uuid.uuid4())
+        try:
+            response = self.session.request(
+                method, self.url + path, json=data, headers=headers,
+                auth=self.auth, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise KassaError('Kassa API request failed: {}'.format(e))
+
+        try:
+            result = response.json()
+        except ValueError:
+            result = {}
+        if response.status_code >= 400:
+            logger.warning('Kassa API error %s on %s %s: %r',
+                           response.status_code, method, path, result)
+            raise KassaError(
+                result.get('description') or
+                'Kassa API responded with {}'.format(response.status_code),
+                response.status_code, result)
+        return result
+
+    def create_payment(self, amount, currency='RUB', return_url=None,
+                       description=None, capture=True, metadata=None,
+                       idempotence_key=None, **extra):
+        """Create a payment. With ``return_url`` the customer is redirected
+        to Kassa, see ``confirmation.confirmation_url`` of the result
+
+        :param capture: if false, the payment is only authorized and has to
+            be captured or cancelled later
+        :param extra: other fields of the request, e.g. ``receipt``
+        :rtype: dict
+        """
+        data = {'amount': format_amount(amount, currency), 'capture': capture}
+        if return_url is not None:
+            data['confirmation'] = {'type': 'redirect',
+                                    'return_url': return_url}
+        if description:
+            data['description'] = description
+        if metadata:
+            data['metadata'] = metadata
+        data.update(extra)
+        return self.request('POST', 'payments', data, idempotence_key)
+
+    def create_payment_for(self, payment, return_url=None, **kwargs):
+        """Create a payment in Kassa for a local one and store its ID in
+        ``payment.external_id``. Order ID is used as the idempotence key, so
+        retrying it never pays twice
+
+        :type payment: yandex_cash_register.models.Payment
+        :rtype: dict
+        """
+        kwargs.setdefault('idempotence_key', payment.order_id)
+        metadata = kwargs.pop('metadata', None) or {}
+        metadata.setdefault('orderNumber', payment.order_id)
+        metadata.setdefault('customerNumber', '{}'.format(
+            payment.customer_id))
+        result = self.create_payment(payment.order_sum,
+                                     payment.order_currency, return_url,
+                                     metadata=metadata, **kwargs)
+        if payment.external_id != result['id']:
+            payment.external_id = result['id']
+            if payment.pk is not None:
+                payment.save(update_fields=['external_id'])
+        return result
+
+    def get_payment(self, payment_id):
+        """
+        :rtype: dict
+        """
+        return self.request('GET', 'payments/{}'.format(quote(payment_id)))
+
+    def capture_payment(self, payment_id, amount=None, currency='RUB',
+                        idempotence_key=None):
+        """Capture an authorized payment, fully or ``amount`` of it
+
+        :rtype: dict
+        """
+        data = {}
+        if amount is not None:
+            data['amount'] = format_amount(amount, currency)
+        return self.request(
+            'POST', 'payments/{}/capture'.format(quote(payment_id)), data,
+            idempotence_key)
+
+    def cancel_payment(self, payment_id, idempotence_key=None):
+        """Cancel an authorized payment
+
+        :rtype: dict
+        """
+        return self.request(
+            'POST', 'payments/{}/cancel'.format(quote(payment_id)), {},
+            idempotence_key)
+
+    def create_refund(self, payment_id, amount, currency='RUB',
+                      description=None, idempotence_key=None):
+        """Refund ``amount`` of a successful payment
+
+        :rtype: dict
+        """
+        data = {'payment_id': payment_id,
+                'amount': format_amount(amount, currency)}
+        if description:
+            data['description'] = description
+        return self.request('POST', 'refunds', data, idempotence_key)
+
+    def get_refund(self, refund_id):
+        """
+        :rtype: dict
+        """
+        return self.request('GET', 'refunds/{}'.format(quote(refund_id)))
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncKassaClient(object):
+    """asyncio variant of ``KassaClient``: methods with the same signatures
+    return awaitable futures. Calls run in a thread pool of the size of the
+    connection pool, sharing its keep-alive connections.
+
+    :type client: KassaClient
+    """
+    methods = ('request', 'create_payment', 'create_payment_for',
+               'get_payment', 'capture_payment', 'cancel_payment',
+               'create_refund', 'get_refund')
+
+    def __init__(self, client=None, loop=None, max_workers=None):
+        if asyncio is None:
+            raise ImproperlyConfigured('asyncio is required for '
+                                       'AsyncKassaClient')
+        self.client = client or get_client()
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers or conf.API_POOL_SIZE)
+
+    def __getattr__(self, name):
+        if name not in self.methods:
+            raise AttributeError(name)
+        method = getattr(self.client, name)
+
+        def call(*args, **kwargs):
+            loop = self.loop or asyncio.get_event_loop()
+            return loop.run_in_executor(
+                self.executor, lambda: method(*args, **kwargs))
+        return call
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Shared client of the current process. Pooled connections don't
+    survive fork, so workers of a preforking server get their own
+
+    :rtype: KassaClient
+    """
+    global _client, _client_pid
+    if _client_pid != os.getpid():
+        with _client_lock:
+            if _client_pid != os.getpid():
+                _client = KassaClient()
+                _client_pid = os.getpid()
+    return _client
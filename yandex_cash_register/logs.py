@@ -0,0 +1,206 @@
+# coding=utf-8
+"""Non-blocking logging for notification views.
+
+``setup_queue_logging`` puts a ``QueueHandler`` in front of whatever
+handlers ``yandex_cash_register`` loggers end up using: request threads only
+put records into a queue, and a listener thread formats them and passes them
+to the real (file, network...) handlers.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+import json
+import logging
+import os
+import threading
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import conf, metrics
+
+
+LOGGER_NAME = 'yandex_cash_register'
+
+OUTCOME_SUCCESS = 'success'
+OUTCOME_ERROR = 'error'
+
+_RECORD_ATTRS = frozenset(
+    vars(logging.LogRecord('', 0, '', 0, '', (), None))) | \
+    frozenset(('message', 'asctime'))
+
+
+class QueueHandler(logging.Handler):
+    """Puts records into a queue as they are. Unlike the standard handler
+    it doesn't format messages, so that is done by the listener thread
+    rather than the request one
+    """
+
+    def __init__(self, records, listener=None):
+        logging.Handler.__init__(self)
+        self.queue = records
+        self.listener = listener
+
+    def emit(self, record):
+        records = self.queue if self.listener is None \
+            else self.listener.get_queue()
+        try:
+            records.put_nowait(record)
+        except queue.Full:
+            metrics.registry.inc(metrics.LOGS_DROPPED)
+
+
+class QueueListener(object):
+    """Passes queued records to handlers from a background thread,
+    respecting handler levels
+    """
+    _sentinel = None
+
+    def __init__(self, records, *handlers):
+        self.queue = records
+        self.handlers = handlers
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._monitor,
+                                        name='yandex-cr-logging')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get_queue(self):
+        """Queue records should be put into. The thread doesn't survive
+        fork, so workers of a preforking server (e.g. ``gunicorn
+        --preload``) get a queue and a thread of their own
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.Queue(self.queue.maxsize)
+                    self.start()
+        return self.queue
+
+    def stop(self):
+        """Handle everything queued so far and stop the thread"""
+        if self._thread is None:
+            return
+        if self._pid != os.getpid():
+            # The thread stayed in the parent process
+            self._thread = None
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            self.handle(record)
+
+
+class SuccessSampler(logging.Filter):
+    """Lets through only a ``rate`` share of records about successfully
+    handled notifications (those with ``outcome='success'``). Sampling is
+    done by order ID, so all records of a sampled payment are kept
+    """
+
+    def __init__(self, rate=None):
+        logging.Filter.__init__(self)
+        self.rate = conf.LOG_SUCCESS_SAMPLE_RATE if rate is None else rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or \
+                getattr(record, 'outcome', None) != OUTCOME_SUCCESS:
+            return True
+        order_id = getattr(record, 'order_id', None) or ''
+        checksum = zlib.crc32(order_id.encode('utf-8')) & 0xffffffff
+        return checksum % 10000 < self.rate * 10000
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a JSON object, including extra fields such as
+    ``order_id``, ``view`` and ``outcome``
+    """
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str, sort_keys=True)
+
+
+def _effective_handlers(logger):
+    handlers = []
+    while logger is not None:
+        handlers.extend(logger.handlers)
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    return handlers
+
+
+_listener = None
+_saved = None
+_lock = threading.Lock()
+
+
+def setup_queue_logging(name=LOGGER_NAME, queue_size=None,
+                        sample_rate=None):
+    """Route records of the ``name`` logger and its children through a
+    queue to the handlers they would otherwise go to. Does nothing if
+    already set up
+
+    :rtype: QueueListener
+    """
+    global _listener, _saved
+    with _lock:
+        if _listener is not None:
+            return _listener
+
+        logger = logging.getLogger(name)
+        records = queue.Queue(queue_size or conf.LOG_QUEUE_SIZE)
+        _listener = QueueListener(records, *_effective_handlers(logger))
+        handler = QueueHandler(records, _listener)
+        handler.addFilter(SuccessSampler(sample_rate))
+
+        _saved = (logger, logger.handlers, logger.propagate)
+        logger.handlers = [handler]
+        logger.propagate = False
+        _listener.start()
+        return _listener
+
+
+def teardown_queue_logging():
+    """Flush queued records and restore original handlers"""
+    global _listener, _saved
+    with _lock:
+        if _listener is None:
+            return
+        logger, handlers, propagate = _saved
+        logger.handlers = handlers
+        logger.propagate = propagate
+        _listener.stop()
+        _listener = _saved = None
+
+
+atexit.register(teardown_queue_logging)
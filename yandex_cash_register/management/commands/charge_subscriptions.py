@@ -0,0 +1,43 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import conf, subscriptions
+
+
+class Command(BaseCommand):
+    help = 'Charge due subscriptions through the Yandex.Kassa API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            default=conf.SUBSCRIPTION_BATCH_SIZE,
+                            help='Subscriptions charged in one batch')
+        parser.add_argument('--workers', type=int,
+                            default=conf.SUBSCRIPTION_WORKERS,
+                            help='Concurrent API requests')
+        parser.add_argument('--rate', type=float,
+                            default=conf.SUBSCRIPTION_RATE,
+                            help='API requests per second')
+
+    def handle(self, *args, **options):
+        started = time.time()
+        try:
+            counts = subscriptions.charge_subscriptions(
+                options['workers'], options['rate'],
+                batch_size=options['batch_size'])
+        except ImproperlyConfigured as e:
+            raise CommandError('{}, install it with '
+                               'pip install requests'.format(e))
+        elapsed = time.time() - started
+        total = sum(counts[key] for key in subscriptions.RESULTS
+                    if key != 'retries')
+        self.stdout.write(', '.join(
+            '{}: {}'.format(key, counts[key])
+            for key in subscriptions.RESULTS))
+        self.stdout.write('{} subscriptions in {:.1f} s, {:.1f} per '
+                          'second'.format(total, elapsed,
+                                          total / elapsed if elapsed else 0))
@@ -0,0 +1,77 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from ... import analytics, conf
+
+
+def date_argument(value):
+    date = parse_date(value)
+    if date is None:
+        raise CommandError('Invalid date: {}'.format(value))
+    return date
+
+
+class PeriodCommand(BaseCommand):
+    """Base for reports over payments created within a period"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=date_argument,
+                            help='First day, YYYY-MM-DD')
+        parser.add_argument('--until', type=date_argument,
+                            help='Last day, YYYY-MM-DD, defaults to today')
+        parser.add_argument('--days', type=int, default=30,
+                            help='Period length if --since is not set')
+        parser.add_argument('--json', action='store_true',
+                            help='Output JSON')
+
+    @staticmethod
+    def get_period(options):
+        return analytics.get_period(options['since'], options['until'],
+                                    options['days'])
+
+
+class Command(PeriodCommand):
+    help = 'Show payment conversion funnel and timings for a period'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--no-cache', action='store_false',
+                            dest='use_cache', help='Ignore cached results')
+
+    def handle(self, *args, **options):
+        since, until = self.get_period(options)
+        result = analytics.report(since, until, use_cache=options['use_cache'])
+
+        if options['json']:
+            result = dict(result, since=since.isoformat(),
+                          until=until.isoformat())
+            self.stdout.write(json.dumps(result, indent=2, sort_keys=True))
+            return
+
+        self.stdout.write('Payments created since {} until {}'.format(
+            since, until))
+        self.stdout.write('')
+        self._table('Funnel', analytics.STAGES, result['funnel'])
+        columns = ['count'] + ['p{}'.format(q)
+                               for q in conf.ANALYTICS_PERCENTILES]
+        self._table('Time to process, s', columns, result['to_process'])
+        self._table('Time to complete, s', columns, result['to_complete'])
+
+    def _table(self, title, columns, rows):
+        self.stdout.write(title.ljust(22) + ''.join(
+            column.rjust(12) for column in columns))
+        keys = sorted(rows, key=lambda key: (key != analytics.TOTAL, key))
+        for key in keys:
+            values = []
+            for column in columns:
+                value = rows[key][column]
+                if isinstance(value, float):
+                    value = '{:.1f}'.format(value)
+                values.append(str(value).rjust(12))
+            self.stdout.write((key or '-').ljust(22) + ''.join(values))
+        self.stdout.write('')
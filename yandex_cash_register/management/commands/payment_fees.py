@@ -0,0 +1,69 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import json
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import CommandError
+
+from ... import analytics
+from .payment_analytics import PeriodCommand
+
+
+class Command(PeriodCommand):
+    help = 'Show Yandex.Kassa fees by payment method and flag payments ' \
+           'with unusual fees or mismatched sums. Requires NumPy'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--threshold', type=float, default=3.5,
+                            help='Robust z-score of an outlier fee rate')
+        parser.add_argument('--limit', type=int, default=20,
+                            help='How many flagged payments to list')
+        parser.add_argument('--chunk-size', type=int, default=50000,
+                            help='Rows fetched from the database at once')
+
+    def handle(self, *args, **options):
+        since, until = self.get_period(options)
+        try:
+            result = analytics.fee_report(
+                since, until, threshold=options['threshold'],
+                limit=options['limit'], chunk_size=options['chunk_size'])
+        except ImproperlyConfigured as e:
+            raise CommandError('{}, install it with '
+                               'pip install numpy'.format(e))
+
+        if options['json']:
+            result = dict(result, since=since.isoformat(),
+                          until=until.isoformat())
+            self.stdout.write(json.dumps(result, indent=2, sort_keys=True))
+            return
+
+        self.stdout.write('Payments created since {} until {}'.format(
+            since, until))
+        self.stdout.write('')
+        columns = ('count', 'order_total', 'fee_total', 'rate', 'median_rate',
+                   'outliers')
+        self.stdout.write('Payment method'.ljust(16) + ''.join(
+            column.rjust(14) for column in columns))
+        rows = result['by_payment_type']
+        for key in sorted(rows, key=lambda key: (key != analytics.TOTAL, key)):
+            values = []
+            for column in columns:
+                value = rows[key][column]
+                if value is None:
+                    value = '-'
+                elif column.endswith('rate'):
+                    value = '{:.3%}'.format(value)
+                elif isinstance(value, float):
+                    value = '{:.2f}'.format(value)
+                values.append(str(value).rjust(14))
+            self.stdout.write((key or '-').ljust(16) + ''.join(values))
+
+        self.stdout.write('')
+        self.stdout.write('Outliers:')
+        for order_id, rate in result['outliers']:
+            self.stdout.write('  {}  {:.3%}'.format(order_id, rate))
+        self.stdout.write('Mismatches: {}'.format(result['mismatch_count']))
+        for order_id in result['mismatches']:
+            self.stdout.write('  {}'.format(order_id))
@@ -0,0 +1,53 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import io
+import sys
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import conf, holds
+
+
+class Command(BaseCommand):
+    help = 'Capture authorized payments of shipped orders and cancel ' \
+           'expiring holds through the Yandex.Kassa API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('order_ids', nargs='*', metavar='order_id',
+                            help='Shipped orders to capture payments of')
+        parser.add_argument('--file',
+                            help='Read order IDs from a file, one per line; '
+                                 '"-" for stdin')
+        parser.add_argument('--batch-size', type=int,
+                            default=conf.HOLD_BATCH_SIZE,
+                            help='Payments read from the database at once')
+        parser.add_argument('--workers', type=int, default=conf.HOLD_WORKERS,
+                            help='Concurrent API requests')
+        parser.add_argument('--rate', type=float, default=conf.HOLD_RATE,
+                            help='API requests per second')
+
+    def get_order_ids(self, options):
+        order_ids = list(options['order_ids'])
+        if options['file'] == '-':
+            order_ids.extend(sys.stdin)
+        elif options['file']:
+            with io.open(options['file'], encoding='utf-8') as f:
+                order_ids.extend(f)
+        return [order_id.strip() for order_id in order_ids if order_id.strip()]
+
+    def handle(self, *args, **options):
+        order_ids = self.get_order_ids(options)
+        if order_ids:
+            marked = holds.request_capture(order_ids, options['batch_size'])
+            self.stdout.write('Payments to capture: {}'.format(marked))
+
+        try:
+            counts = holds.process_holds(options['workers'], options['rate'],
+                                         batch_size=options['batch_size'])
+        except ImproperlyConfigured as e:
+            raise CommandError('{}, install it with '
+                               'pip install requests'.format(e))
+        self.stdout.write(', '.join(
+            '{}: {}'.format(key, counts[key]) for key in holds.RESULTS))
@@ -0,0 +1,69 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+import gzip
+import json
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from ... import conf
+from ...models import NotificationJournal
+
+
+class Command(BaseCommand):
+    help = 'Delete journaled notifications older than the retention period, ' \
+           'optionally archiving them first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=conf.JOURNAL_RETENTION_DAYS,
+                            help='Keep notifications of that many last days')
+        parser.add_argument('--archive',
+                            help='Append deleted notifications to this '
+                                 'gzipped JSON lines file')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows deleted per query')
+
+    def handle(self, *args, **options):
+        cutoff = now() - datetime.timedelta(days=options['days'])
+        queryset = NotificationJournal.objects.filter(
+            created__lt=cutoff).order_by('pk')
+
+        archive = None
+        if options['archive']:
+            archive = gzip.open(options['archive'], 'ab')
+        deleted = 0
+        try:
+            while True:
+                # Short batches don't hold locks for long and let the
+                # archive be written as we go
+                batch = list(queryset[:options['batch_size']])
+                if not batch:
+                    break
+                if archive is not None:
+                    for entry in batch:
+                        archive.write(self._dump(entry))
+                    archive.flush()
+                NotificationJournal.objects.filter(
+                    pk__in=[entry.pk for entry in batch]).delete()
+                deleted += len(batch)
+        finally:
+            if archive is not None:
+                archive.close()
+
+        self.stdout.write('Deleted {} notifications received before '
+                          '{}'.format(deleted, cutoff))
+
+    @staticmethod
+    def _dump(entry):
+        data = {
+            'created': entry.created.isoformat(),
+            'action': entry.action,
+            'order_id': entry.order_id,
+            'code': entry.code,
+            'duration': entry.duration,
+        }
+        data.update(entry.get_payload())
+        return (json.dumps(data, sort_keys=True) + '\n').encode('utf-8')
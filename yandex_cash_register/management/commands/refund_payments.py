@@ -0,0 +1,67 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal, InvalidOperation
+import io
+import sys
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import conf, refunds
+
+
+def amount_argument(value):
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise CommandError('Invalid amount: {}'.format(value))
+
+
+class Command(BaseCommand):
+    help = 'Refund successful payments with the given order IDs through ' \
+           'the Yandex.Kassa API and submit refunds left unsubmitted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('order_ids', nargs='*', metavar='order_id')
+        parser.add_argument('--file',
+                            help='Read order IDs from a file, one per line; '
+                                 '"-" for stdin')
+        parser.add_argument('--amount', type=amount_argument,
+                            help='Refund amount, full order sum by default')
+        parser.add_argument('--description', default='',
+                            help='Reason of the refund')
+        parser.add_argument('--workers', type=int,
+                            default=conf.REFUND_WORKERS,
+                            help='Concurrent API requests')
+        parser.add_argument('--rate', type=float, default=conf.REFUND_RATE,
+                            help='API requests per second')
+        parser.add_argument('--retry-errors', action='store_true',
+                            help='Submit refunds that failed before again')
+
+    def get_order_ids(self, options):
+        order_ids = list(options['order_ids'])
+        if options['file'] == '-':
+            order_ids.extend(sys.stdin)
+        elif options['file']:
+            with io.open(options['file'], encoding='utf-8') as f:
+                order_ids.extend(f)
+        return [order_id.strip() for order_id in order_ids if order_id.strip()]
+
+    def handle(self, *args, **options):
+        order_ids = self.get_order_ids(options)
+        if order_ids:
+            created = refunds.create_refunds(
+                order_ids, options['amount'], options['description'])
+            self.stdout.write('Refunds created: {}'.format(created))
+
+        try:
+            counts = refunds.submit_refunds(
+                options['workers'], options['rate'],
+                retry_errors=options['retry_errors'])
+        except ImproperlyConfigured as e:
+            raise CommandError('{}, install it with '
+                               'pip install requests'.format(e))
+        self.stdout.write(', '.join(
+            '{}: {}'.format(status, counts[status])
+            for status in sorted(counts)))
@@ -0,0 +1,40 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import conf, sync
+
+
+class Command(BaseCommand):
+    help = 'Check payments stuck in the processed state with the ' \
+           'Yandex.Kassa API and complete or fail them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=conf.SYNC_MIN_AGE,
+                            help='Only check payments processed that many '
+                                 'seconds ago or earlier')
+        parser.add_argument('--batch-size', type=int,
+                            default=conf.SYNC_BATCH_SIZE,
+                            help='Payments read from the database at once')
+        parser.add_argument('--workers', type=int, default=conf.SYNC_WORKERS,
+                            help='Concurrent API requests')
+        parser.add_argument('--legacy-expire', type=int,
+                            default=conf.SYNC_LEGACY_EXPIRE,
+                            help='Fail payments of the HTTP protocol '
+                                 'processed that many seconds ago and never '
+                                 'confirmed, 0 to only list them')
+
+    def handle(self, *args, **options):
+        try:
+            counts = sync.sync_payments(options['min_age'],
+                                        options['batch_size'],
+                                        options['workers'],
+                                        legacy_expire=options[
+                                            'legacy_expire'])
+        except ImproperlyConfigured as e:
+            raise CommandError('{}, install it with '
+                               'pip install requests'.format(e))
+        self.stdout.write(', '.join(
+            '{}: {}'.format(key, counts[key]) for key in sync.RESULTS))
@@ -0,0 +1,332 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from contextlib import contextmanager
+import errno
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from . import conf
+
+
+logger = logging.getLogger(__name__)
+
+REQUEST_DURATION = 'yandex_cr_request_duration_seconds'
+RESPONSES = 'yandex_cr_responses_total'
+TRANSITIONS = 'yandex_cr_transitions_total'
+LOCK_WAIT = 'yandex_cr_lock_wait_seconds'
+LOCK_HOLD = 'yandex_cr_lock_hold_seconds'
+JOURNAL_DROPPED = 'yandex_cr_journal_dropped_total'
+LOGS_DROPPED = 'yandex_cr_logs_dropped_total'
+SUBSCRIPTION_CHARGES = 'yandex_cr_subscription_charges_total'
+
+HELP = {
+    REQUEST_DURATION: 'Time spent serving a request, by view',
+    RESPONSES: 'Responses sent to Yandex.Kassa, by view and result code',
+    TRANSITIONS: 'Payment state transitions, by new state and payment type',
+    LOCK_WAIT: 'Time spent waiting for a payment row lock',
+    LOCK_HOLD: 'Time a payment row lock is held, up to transaction commit',
+    JOURNAL_DROPPED: 'Notifications not journaled because the write queue '
+                     'was full',
+    LOGS_DROPPED: 'Log records lost because the log queue was full',
+    SUBSCRIPTION_CHARGES: 'Recurring charges of subscriptions, by result',
+}
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+def _key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _file_pid(path):
+    """PID of the process that wrote a ``<pid>-<nonce>.json`` file"""
+    try:
+        return int(os.path.basename(path).split('-', 1)[0])
+    except ValueError:
+        return None
+
+
+def _is_alive(pid):
+    if os.name != 'posix':
+        # os.kill() would terminate the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class Registry(object):
+    """Thread-safe in-process storage of counters and histograms.
+
+    When ``conf.METRICS_DIR`` is set, each process periodically dumps its
+    values into that directory, so that any worker can serve numbers
+    aggregated over all workers of the server. Files are named by PID and a
+    random nonce, so a recycled PID doesn't overwrite a live process' file,
+    and files of dead processes are removed when collecting.
+    """
+
+    def __init__(self, directory=None, flush_interval=None,
+                 buckets=DEFAULT_BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._flushed_at = 0
+        self._pid = os.getpid()
+        self._nonce = uuid.uuid4().hex[:8]
+
+    def _check_pid(self):
+        """Start afresh in a forked child, values inherited from the parent
+        are counted in the parent's file. Called with ``_lock`` held
+        """
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._nonce = uuid.uuid4().hex[:8]
+            self._counters.clear()
+            self._histograms.clear()
+            self._flushed_at = 0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _key(labels))
+        with self._lock:
+            self._check_pid()
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, **labels):
+        key = (name, _key(labels))
+        with self._lock:
+            self._check_pid()
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0.0,
+                    'count': 0,
+                }
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+                    break
+            hist['sum'] += value
+            hist['count'] += 1
+        self._maybe_flush()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def count(self, name, **labels):
+        """Return current value of a counter or number of observations of a
+        histogram in this process
+        """
+        key = (name, _key(labels))
+        with self._lock:
+            self._check_pid()
+            if key in self._histograms:
+                return self._histograms[key]['count']
+            return self._counters.get(key, 0)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        with self._lock:
+            self._check_pid()
+            return {
+                'counters': [[name, list(map(list, labels)), value]
+                             for (name, labels), value
+                             in self._counters.items()],
+                'histograms': [[name, list(map(list, labels)),
+                                dict(hist, buckets=list(hist['buckets']))]
+                               for (name, labels), hist
+                               in self._histograms.items()],
+            }
+
+    def _path(self):
+        with self._lock:
+            self._check_pid()
+            name = '{}-{}.json'.format(self._pid, self._nonce)
+        return os.path.join(self.directory, name)
+
+    def _maybe_flush(self):
+        if not self.directory:
+            return
+        if time.time() - self._flushed_at < (self.flush_interval or 0):
+            return
+        self.flush()
+
+    def flush(self):
+        """Dump values of the current process into ``directory``"""
+        if not self.directory:
+            return
+        with self._flush_lock:
+            self._flushed_at = time.time()
+            path = self._path()
+            tmp_path = '{}.tmp'.format(path)
+            try:
+                with open(tmp_path, 'w') as fp:
+                    json.dump(self.snapshot(), fp)
+                os.rename(tmp_path, path)
+            except (IOError, OSError):
+                logger.warning('Cannot write metrics to %s', path,
+                               exc_info=True)
+
+    def collect(self):
+        """Return values aggregated over all processes sharing
+        ``directory`` (or over the current process only)
+        """
+        snapshots = [self.snapshot()]
+        if self.directory:
+            for path in self._other_paths():
+                try:
+                    with open(path) as fp:
+                        snapshots.append(json.load(fp))
+                except (IOError, OSError, ValueError):
+                    logger.warning('Cannot read metrics from %s', path,
+                                   exc_info=True)
+        return merge(snapshots)
+
+    def _other_paths(self):
+        """Files of other live processes. Files of dead ones, and older
+        files of a recycled PID, are removed
+        """
+        own_path = self._path()
+        newest = {}
+        paths = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            if path == own_path:
+                continue
+            pid = _file_pid(path)
+            if pid is None:
+                paths.append(path)
+                continue
+            if pid == self._pid or not _is_alive(pid):
+                self._remove(path)
+                continue
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            entry = (mtime, path)
+            if pid in newest:
+                stale, entry = sorted([newest[pid], entry])
+                self._remove(stale[1])
+            newest[pid] = entry
+        return paths + [path for _, path in newest.values()]
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def render(self):
+        return render(self.collect(), self.buckets)
+
+
+def merge(snapshots):
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, hist in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.get(key)
+            if total is None:
+                histograms[key] = dict(hist, buckets=list(hist['buckets']))
+                continue
+            total['buckets'] = [a + b for a, b in zip(total['buckets'],
+                                                      hist['buckets'])]
+            total['sum'] += hist['sum']
+            total['count'] += hist['count']
+    return counters, histograms
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"')\
+        .replace('\n', r'\n')
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(k, _escape(v))
+                                    for k, v in labels))
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(collected, buckets=DEFAULT_BUCKETS):
+    """Render aggregated values in Prometheus text exposition format"""
+    counters, histograms = collected
+    lines = []
+    described = set()
+
+    def describe(name, kind):
+        if name in described:
+            return
+        described.add(name)
+        if name in HELP:
+            lines.append('# HELP {} {}'.format(name, HELP[name]))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name, 'counter')
+        lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                      _format_value(value)))
+
+    for (name, labels), hist in sorted(histograms.items(),
+                                       key=lambda item: item[0]):
+        describe(name, 'histogram')
+        cumulative = 0
+        for bound, value in zip(buckets, hist['buckets']):
+            cumulative += value
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels, (('le', repr(bound)),)),
+                cumulative))
+        lines.append('{}_bucket{} {}'.format(
+            name, _format_labels(labels, (('le', '+Inf'),)), hist['count']))
+        lines.append('{}_sum{} {}'.format(name, _format_labels(labels),
+                                          _format_value(hist['sum'])))
+        lines.append('{}_count{} {}'.format(name, _format_labels(labels),
+                                            hist['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+# Nothing is written to the directory unless metrics are served
+registry = Registry(directory=conf.METRICS_DIR if conf.METRICS else None,
+                    flush_interval=conf.METRICS_FLUSH_INTERVAL)
+
+
+def observe_transition(payment):
+    """
+    :type payment: yandex_cash_register.models.Payment
+    """
+    registry.inc(TRANSITIONS, state=payment.state,
+                 payment_type=payment.payment_type or '')
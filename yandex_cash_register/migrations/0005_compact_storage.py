@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import yandex_cash_register.fields
+
+
+STATE_FIELD = dict(
+    choices=[('created', 'Created'), ('processed', 'Processed'), ('success', 'Succeed'), ('fail', 'Failed')],
+    codes=('created', 'processed', 'success', 'fail'), default='created',
+    editable=False, max_length=16, verbose_name='State')
+PAYMENT_TYPE_FIELD = dict(
+    blank=True,
+    choices=[('AB', 'Alfa Click'), ('AC', 'Credit/Debit card'), ('GP', 'Cash via terminal'), ('MA', 'MasterPass'), ('MC', 'Mobile phone account'), ('PB', 'Promsvyazbank online-bank'), ('PC', 'Yandex.Money wallet'), ('SB', 'Sberbank Online'), ('WM', 'WebMoney wallet'), ('QS', 'QiWi wallet')],
+    codes=('', 'AB', 'AC', 'GP', 'MA', 'MC', 'PB', 'PC', 'SB', 'WM', 'QS'),
+    editable=False, max_length=2, verbose_name='Payment method')
+ORDER_SUM_FIELD = dict(
+    decimal_places=2, editable=False, max_digits=15, verbose_name='Order sum')
+SHOP_SUM_FIELD = dict(
+    decimal_places=2, editable=False, help_text='Order sum - Yandex.Kassa fee',
+    max_digits=15, null=True, verbose_name='Received sum')
+
+CHOICE_FIELDS = (('state', STATE_FIELD), ('payment_type', PAYMENT_TYPE_FIELD))
+SUM_FIELDS = (('order_sum', ORDER_SUM_FIELD), ('shop_sum', SHOP_SUM_FIELD))
+
+
+def backfill(apps, schema_editor):
+    Payment = apps.get_model('yandex_cash_register', 'Payment')
+    payments = Payment.objects.using(schema_editor.connection.alias)
+    for name, kwargs in CHOICE_FIELDS:
+        for code in kwargs['codes']:
+            payments.filter(**{name: code}).update(**{name + '_new': code})
+    for name, kwargs in SUM_FIELDS:
+        payments.update(**{name + '_new': models.Func(
+            models.F(name) * 10 ** kwargs['decimal_places'],
+            function='ROUND', output_field=models.BigIntegerField())})
+
+
+def backfill_reverse(apps, schema_editor):
+    Payment = apps.get_model('yandex_cash_register', 'Payment')
+    payments = Payment.objects.using(schema_editor.connection.alias)
+    for name, kwargs in CHOICE_FIELDS:
+        for code in kwargs['codes']:
+            payments.filter(**{name + '_new': code}).update(**{name: code})
+    names = [name for name, kwargs in SUM_FIELDS]
+    rows = payments.values_list('pk', *[name + '_new' for name in names])
+    for row in rows.iterator():
+        payments.filter(pk=row[0]).update(**dict(zip(names, row[1:])))
+
+
+def compact_operations():
+    operations = []
+    for name, kwargs in CHOICE_FIELDS:
+        operations.append(migrations.AddField(
+            model_name='payment',
+            name=name + '_new',
+            field=yandex_cash_register.fields.CompactChoiceField(**kwargs),
+        ))
+    for name, kwargs in SUM_FIELDS:
+        operations.append(migrations.AddField(
+            model_name='payment',
+            name=name + '_new',
+            field=yandex_cash_register.fields.MinorUnitsDecimalField(
+                default=0, **kwargs),
+            preserve_default=False,
+        ))
+    operations.append(migrations.RunPython(backfill, backfill_reverse))
+    for name, kwargs in SUM_FIELDS:
+        # Lets the old column be re-added when migrating backwards
+        operations.append(migrations.AlterField(
+            model_name='payment',
+            name=name,
+            field=models.DecimalField(default=0, **kwargs),
+        ))
+    for name, kwargs in CHOICE_FIELDS + SUM_FIELDS:
+        operations.extend([
+            migrations.RemoveField(model_name='payment', name=name),
+            migrations.RenameField(model_name='payment',
+                                   old_name=name + '_new', new_name=name),
+        ])
+    return operations
+
+
+def alter_operations():
+    return [
+        migrations.AlterField(
+            model_name='payment',
+            name=name,
+            field=yandex_cash_register.fields.CompactChoiceField(**kwargs),
+        ) for name, kwargs in CHOICE_FIELDS
+    ] + [
+        migrations.AlterField(
+            model_name='payment',
+            name=name,
+            field=yandex_cash_register.fields.MinorUnitsDecimalField(**kwargs),
+        ) for name, kwargs in SUM_FIELDS
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('yandex_cash_register', '0004_auto_20170206_2146'),
+    ]
+
+    # Both branches end in the same model state, only the columns differ
+    if getattr(settings, 'YANDEX_CR_COMPACT_STORAGE', False):
+        operations = compact_operations()
+    else:
+        operations = alter_operations()
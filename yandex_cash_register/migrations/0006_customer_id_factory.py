@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import yandex_cash_register.ids
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('yandex_cash_register', '0005_compact_storage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='customer_id',
+            field=models.UUIDField(default=yandex_cash_register.ids.new_customer_id, editable=False, unique=True, verbose_name='Customer ID'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('yandex_cash_register', '0006_customer_id_factory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationJournal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Received at')),
+                ('action', models.CharField(blank=True, max_length=32, verbose_name='Action')),
+                ('order_id', models.CharField(blank=True, db_index=True, max_length=64, verbose_name='Order ID')),
+                ('code', models.IntegerField(null=True, verbose_name='Result code')),
+                ('duration', models.FloatField(verbose_name='Duration, s')),
+                ('payload', models.BinaryField(verbose_name='Request and response')),
+            ],
+            options={
+                'verbose_name': 'notification',
+                'verbose_name_plural': 'notification journal',
+                'ordering': ('-created',),
+            },
+        ),
+    ]
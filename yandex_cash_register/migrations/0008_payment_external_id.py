@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('yandex_cash_register', '0007_notificationjournal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='external_id',
+            field=models.CharField(editable=False, help_text='Payment ID in the Yandex.Kassa API', max_length=64, null=True, unique=True, verbose_name='Kassa payment ID'),
+        ),
+        migrations.AlterIndexTogether(
+            name='payment',
+            index_together=set([('state', 'performed')]),
+        ),
+    ]
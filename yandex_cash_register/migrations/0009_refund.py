@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+import yandex_cash_register.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('yandex_cash_register', '0008_payment_external_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Refund',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.CharField(db_index=True, editable=False, max_length=50, verbose_name='Order ID')),
+                ('external_id', models.CharField(editable=False, max_length=64, null=True, unique=True, verbose_name='Kassa refund ID')),
+                ('idempotence_key', models.UUIDField(default=uuid.uuid4, editable=False, verbose_name='Idempotence key')),
+                ('amount', yandex_cash_register.fields.MinorUnitsDecimalField(decimal_places=2, editable=False, max_digits=15, verbose_name='Amount')),
+                ('status', models.CharField(choices=[('new', 'Not submitted'), ('pending', 'Pending'), ('succeeded', 'Succeeded'), ('canceled', 'Canceled'), ('error', 'Error')], db_index=True, default='new', editable=False, max_length=16, verbose_name='Status')),
+                ('description', models.CharField(blank=True, max_length=250, verbose_name='Description')),
+                ('error', models.CharField(blank=True, editable=False, max_length=255, verbose_name='Error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Updated at')),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='refunds', to='yandex_cash_register.Payment', verbose_name='Payment')),
+            ],
+            options={
+                'verbose_name': 'refund',
+                'verbose_name_plural': 'refunds',
+                'ordering': ('-created',),
+            },
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='state',
+            field=yandex_cash_register.fields.CompactChoiceField(choices=[('created', 'Created'), ('processed', 'Processed'), ('success', 'Succeed'), ('fail', 'Failed'), ('refunded', 'Refunded')], codes=('created', 'processed', 'success', 'fail', 'refunded'), default='created', editable=False, max_length=16, verbose_name='State'),
+        ),
+    ]
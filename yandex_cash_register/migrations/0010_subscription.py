@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import yandex_cash_register.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('yandex_cash_register', '0009_refund'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Subscription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.CharField(editable=False, max_length=50, unique=True, verbose_name='Order ID')),
+                ('payment_method_id', models.CharField(max_length=64, verbose_name='Saved payment method')),
+                ('amount', yandex_cash_register.fields.MinorUnitsDecimalField(decimal_places=2, max_digits=15, verbose_name='Amount')),
+                ('currency', models.PositiveIntegerField(choices=[(643, 'Rouble'), (10643, 'Test currency')], default=643, verbose_name='Currency')),
+                ('description', models.CharField(blank=True, max_length=128, verbose_name='Description')),
+                ('interval_months', models.PositiveSmallIntegerField(default=1, verbose_name='Interval, months')),
+                ('state', models.CharField(choices=[('active', 'Active'), ('suspended', 'Suspended'), ('cancelled', 'Cancelled')], default='active', max_length=16, verbose_name='State')),
+                ('next_charge', models.DateTimeField(verbose_name='Next charge at')),
+                ('retry_at', models.DateTimeField(blank=True, null=True, verbose_name='Retry at')),
+                ('failures', models.PositiveSmallIntegerField(default=0, help_text='Declined charges in a row', verbose_name='Failed attempts')),
+                ('last_charged', models.DateTimeField(editable=False, null=True, verbose_name='Last charged at')),
+                ('last_error', models.CharField(blank=True, editable=False, max_length=255, verbose_name='Last error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Updated at')),
+            ],
+            options={
+                'verbose_name': 'subscription',
+                'verbose_name_plural': 'subscriptions',
+                'ordering': ('next_charge',),
+            },
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='parent_order_id',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Set for recurring charges of a subscription', max_length=50, verbose_name='Subscription order ID'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='payment_method_id',
+            field=models.CharField(blank=True, editable=False, help_text='Token for charging the payer again', max_length=64, verbose_name='Saved payment method'),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='payment',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='subscription', to='yandex_cash_register.Payment', verbose_name='Initial payment'),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='User'),
+        ),
+        migrations.AlterIndexTogether(
+            name='subscription',
+            index_together=set([('state', 'next_charge')]),
+        ),
+    ]
+
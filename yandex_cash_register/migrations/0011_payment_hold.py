@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import yandex_cash_register.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('yandex_cash_register', '0010_subscription'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='capture_requested',
+            field=models.DateTimeField(editable=False, help_text='Set when the order ships, the held money is captured after that', null=True, verbose_name='Capture requested at'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='hold_expires',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='Hold expires at'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='state',
+            field=yandex_cash_register.fields.CompactChoiceField(choices=[('created', 'Created'), ('processed', 'Processed'), ('success', 'Succeed'), ('fail', 'Failed'), ('refunded', 'Refunded'), ('authorized', 'Authorized')], codes=('created', 'processed', 'success', 'fail', 'refunded', 'authorized'), default='created', editable=False, max_length=16, verbose_name='State'),
+        ),
+    ]
+
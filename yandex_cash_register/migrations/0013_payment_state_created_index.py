@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('yandex_cash_register', '0012_user_db_constraint'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='payment',
+            index_together=set([('state', 'performed'), ('state', 'created')]),
+        ),
+    ]
+
@@ -1,18 +1,121 @@
 # coding=utf-8
 from __future__ import absolute_import, unicode_literals
 
+import calendar
+import datetime
+import json
 import uuid
+import zlib
 
+from django.apps import apps
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
-from . import conf
+from . import cache, conf, ids, metrics, receipts, routers
+from .fields import CompactChoiceField, MinorUnitsDecimalField
 from .forms import PaymentForm, FinalPaymentStateForm
-from .signals import payment_process, payment_success, payment_fail
+from .signals import payment_process, payment_success, payment_fail, \
+    payment_refund, payment_authorize
+
+
+def _supports_upsert(connection):
+    """Whether the backend has ``INSERT ... ON CONFLICT DO NOTHING
+    RETURNING``
+    """
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 35, 0)
+    return False
+
+
+class PaymentQuerySet(models.QuerySet):
+    def for_read(self, order_id=None):
+        """Read from the replica, if configured. Only for read-only paths
+        that can tolerate replication lag
+
+        :param order_id: payment being read, to see its recent changes
+        """
+        return self.using(routers.read_db(order_id))
+
+    def for_order(self, order_id):
+        """Use the shard the payment with the given order ID lives in"""
+        return self.using(routers.shard_for(order_id))
+
+    def create(self, **kwargs):
+        # QuerySet.create() saves to self.db, which knows nothing about
+        # the order ID
+        if self._db is None and len(routers.get_shards()) > 1:
+            return self.for_order(kwargs.get('order_id')).create(**kwargs)
+        return super(PaymentQuerySet, self).create(**kwargs)
+
+    def fan_out(self):
+        """Copies of the queryset for every shard
+
+        :rtype: list
+        """
+        return [self.using(alias) for alias in routers.get_shards()]
+
+    def get_or_create_for_order(self, order_id, **fields):
+        """Create the object of an order, or return the existing one if it
+        was created first, e.g. by a concurrent request of a double click.
+
+        On PostgreSQL 9.5+ and SQLite 3.35+ it is a single ``INSERT ... ON
+        CONFLICT DO NOTHING RETURNING``: a collision costs neither an
+        exception nor a rollback, and the existing row is read only then.
+        Elsewhere the insert runs in a savepoint and ``IntegrityError`` is
+        caught. Like ``bulk_create()``, the upsert sends no ``post_save``.
+
+        :param fields: values of a new object, ignored if it exists
+        :return: ``(object, created)``
+        """
+        alias = self._db or routers.shard_for(order_id)
+        connection = connections[alias]
+        obj = self.model(order_id=order_id, **fields)
+        if _supports_upsert(connection):
+            pk = self._insert_or_nothing(obj, connection)
+            if pk is not None:
+                obj.pk = pk
+                obj._state.adding = False
+                obj._state.db = alias
+                routers.mark_written(order_id)
+                return obj, True
+        else:
+            try:
+                with transaction.atomic(using=alias):
+                    obj.save(force_insert=True, using=alias)
+                return obj, True
+            except IntegrityError:
+                pass
+        return self.using(alias).get(order_id=order_id), False
+
+    def _insert_or_nothing(self, obj, connection):
+        """
+        :return: primary key of the inserted row, ``None`` on conflict
+        """
+        meta = self.model._meta
+        fields = [field for field in meta.concrete_fields
+                  if not isinstance(field, models.AutoField)]
+        quote = connection.ops.quote_name
+        sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO NOTHING ' \
+              'RETURNING {}'.format(
+                  quote(meta.db_table),
+                  ', '.join(quote(field.column) for field in fields),
+                  ', '.join(['%s'] * len(fields)),
+                  quote(meta.get_field('order_id').column),
+                  quote(meta.pk.column))
+        params = [field.get_db_prep_save(field.pre_save(obj, True),
+                                         connection)
+                  for field in fields]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        return row[0] if row else None
 
 
 @python_2_unicode_compatible
@@ -21,12 +124,23 @@ class Payment(models.Model):
     STATE_PROCESSED = 'processed'
     STATE_SUCCESS = 'success'
     STATE_FAIL = 'fail'
+    STATE_REFUNDED = 'refunded'
+    STATE_AUTHORIZED = 'authorized'
     STATE_CHOICES = (
         (STATE_CREATED, _('Created')),
         (STATE_PROCESSED, _('Processed')),
         (STATE_SUCCESS, _('Succeed')),
         (STATE_FAIL, _('Failed')),
+        (STATE_REFUNDED, _('Refunded')),
+        (STATE_AUTHORIZED, _('Authorized')),
     )
+    # Storage codes for compact storage, append only
+    # New states go to the end, stored codes are indexes in this tuple
+    STATE_CODES = (STATE_CREATED, STATE_PROCESSED, STATE_SUCCESS, STATE_FAIL,
+                   STATE_REFUNDED, STATE_AUTHORIZED)
+    COMPLETED_STATES = (STATE_SUCCESS, STATE_FAIL, STATE_REFUNDED)
+    # The money was taken, even if returned later
+    PAID_STATES = (STATE_SUCCESS, STATE_REFUNDED)
 
     CURRENCY_RUB = 643
     CURRENCY_TEST = 10643
@@ -36,26 +150,39 @@ class Payment(models.Model):
         (CURRENCY_TEST, _('Test currency')),
     )
 
+    # Users live in the default database only, not in every shard
     user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True,
-                             verbose_name=_('User'))
+                             db_constraint=False, verbose_name=_('User'))
     order_id = models.CharField(_('Order ID'), max_length=50, unique=True,
                                 editable=False, db_index=True)
     customer_id = models.UUIDField(_('Customer ID'), unique=True,
-                                   default=uuid.uuid4, editable=False)
-    state = models.CharField(_('State'), max_length=16, choices=STATE_CHOICES,
-                             default=STATE_CREATED, editable=False)
+                                   default=ids.new_customer_id,
+                                   editable=False)
+    state = CompactChoiceField(_('State'), max_length=16,
+                               choices=STATE_CHOICES, codes=STATE_CODES,
+                               default=STATE_CREATED, editable=False)
 
-    payment_type = models.CharField(_('Payment method'), max_length=2,
-                                    choices=conf.BASE_PAYMENT_TYPE_CHOICES,
-                                    editable=False, blank=True)
+    payment_type = CompactChoiceField(_('Payment method'), max_length=2,
+                                      choices=conf.BASE_PAYMENT_TYPE_CHOICES,
+                                      codes=conf.PAYMENT_TYPE_CODES,
+                                      editable=False, blank=True)
     invoice_id = models.CharField(_('Invoice ID'), max_length=64,
                                   blank=True, editable=False)
-    order_sum = models.DecimalField(_('Order sum'), max_digits=15,
-                                    decimal_places=2, editable=False)
-    shop_sum = models.DecimalField(_('Received sum'), max_digits=15,
-                                   decimal_places=2, null=True,
-                                   help_text=_('Order sum - Yandex.Kassa fee'),
-                                   editable=False)
+    external_id = models.CharField(
+        _('Kassa payment ID'), max_length=64, null=True, unique=True,
+        editable=False, help_text=_('Payment ID in the Yandex.Kassa API'))
+    payment_method_id = models.CharField(
+        _('Saved payment method'), max_length=64, blank=True, editable=False,
+        help_text=_('Token for charging the payer again'))
+    parent_order_id = models.CharField(
+        _('Subscription order ID'), max_length=50, blank=True,
+        editable=False, db_index=True,
+        help_text=_('Set for recurring charges of a subscription'))
+    order_sum = MinorUnitsDecimalField(_('Order sum'), max_digits=15,
+                                       decimal_places=2, editable=False)
+    shop_sum = MinorUnitsDecimalField(
+        _('Received sum'), max_digits=15, decimal_places=2, null=True,
+        help_text=_('Order sum - Yandex.Kassa fee'), editable=False)
 
     order_currency = models.PositiveIntegerField(
         _('Order currency'), default=CURRENCY_RUB, choices=CURRENCY_CHOICES,
@@ -74,15 +201,69 @@ class Payment(models.Model):
     created = models.DateTimeField(_('Created at'), auto_now_add=True)
     performed = models.DateTimeField(_('Started at'), null=True)
     completed = models.DateTimeField(_('Completed at'), null=True)
+    hold_expires = models.DateTimeField(_('Hold expires at'), null=True,
+                                        editable=False)
+    capture_requested = models.DateTimeField(
+        _('Capture requested at'), null=True, editable=False,
+        help_text=_('Set when the order ships, the held money is '
+                    'captured after that'))
+
+    objects = PaymentQuerySet.as_manager()
 
     def __str__(self):
         return _('Payment #%(payment)s') % {'payment': self.order_id}
 
     class Meta:
         ordering = ('-created',)
+        # Lookup of stale payments by sync_payments
+        index_together = (('state', 'performed'), ('state', 'created'))
         verbose_name = _('payment')
         verbose_name_plural = _('payments')
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Payment, cls).from_db(db, field_names, values)
+        instance._loaded_state = instance.__dict__.get('state')
+        return instance
+
+    def save(self, *args, **kwargs):
+        super(Payment, self).save(*args, **kwargs)
+        routers.mark_written(self.order_id)
+
+        loaded_state = getattr(self, '_loaded_state', None)
+        if loaded_state != self.state and \
+                loaded_state in (self.STATE_SUCCESS, self.STATE_FAIL,
+                                 self.STATE_REFUNDED):
+            # Final state was changed (e.g. by an admin) - cached responses
+            # for the payment are no longer valid
+            cache.invalidate_final_redirect(self.order_id)
+        self._loaded_state = self.state
+        # Any save may change the public status, e.g. by an admin
+        self._write_status()
+
+    def get_status(self):
+        """Public information about payment progress, safe to be cached
+
+        :rtype: dict
+        """
+        updated = self.completed or self.performed or self.created
+        return {
+            'order_id': self.order_id,
+            'customer_id': str(self.customer_id),
+            'state': self.state,
+            'updated': calendar.timegm(updated.utctimetuple()) +
+            updated.microsecond / 1e6,
+        }
+
+    def _write_status(self):
+        status = self.get_status()
+        on_commit = getattr(transaction, 'on_commit', None)
+        if on_commit is None:
+            cache.set_status(status)
+        else:
+            # Don't let readers see a state that may still be rolled back
+            on_commit(lambda: cache.set_status(status), using=self._state.db)
+
     @property
     def is_payed(self):
         return self.state == self.STATE_SUCCESS
@@ -93,7 +274,7 @@ class Payment(models.Model):
 
     @property
     def is_completed(self):
-        return self.state in (self.STATE_SUCCESS, self.STATE_FAIL)
+        return self.state in self.COMPLETED_STATES
 
     def process(self):
         send_signal = False
@@ -107,6 +288,7 @@ class Payment(models.Model):
         self.performed = now()
         self.state = self.STATE_PROCESSED
         self.save()
+        metrics.observe_transition(self)
 
         if send_signal:
             payment_process.send(sender=self)
@@ -116,7 +298,8 @@ class Payment(models.Model):
             raise RuntimeError(
                 'Cannot set state to "Success" when current state '
                 'is {}'.format(self.state))
-        if self.state not in (self.STATE_PROCESSED, self.STATE_FAIL):
+        if self.state not in (self.STATE_PROCESSED, self.STATE_FAIL,
+                              self.STATE_AUTHORIZED):
             raise RuntimeError(
                 'Cannot set state to "Success" when current state '
                 'is {}'.format(self.state))
@@ -124,21 +307,62 @@ class Payment(models.Model):
         self.completed = now()
         self.state = self.STATE_SUCCESS
         self.save()
+        metrics.observe_transition(self)
 
         payment_success.send(sender=self)
 
     def fail(self):
-        if self.state in (self.STATE_SUCCESS, self.STATE_FAIL):
+        if self.is_completed:
             raise RuntimeError('Cannot set state to "Fail" when current '
                                'state is {}'.format(self.state))
 
         self.completed = now()
         self.state = self.STATE_FAIL
         self.save()
+        metrics.observe_transition(self)
 
         payment_fail.send(sender=self)
 
-    def form(self):
+    def authorize(self):
+        """Mark a processed payment as authorized: the money is held until
+        the payment is captured (``complete()``) or cancelled (``fail()``),
+        see ``yandex_cash_register.holds``
+        """
+        if self.state != self.STATE_PROCESSED:
+            raise RuntimeError('Cannot set state to "Authorized" when current '
+                               'state is {}'.format(self.state))
+
+        if self.hold_expires is None:
+            self.hold_expires = now() + datetime.timedelta(
+                seconds=conf.HOLD_TTL)
+        self.state = self.STATE_AUTHORIZED
+        self.save()
+        metrics.observe_transition(self)
+
+        payment_authorize.send(sender=self)
+
+    def refund(self):
+        """Mark a successful payment as fully refunded, see
+        ``yandex_cash_register.refunds``
+        """
+        if self.state != self.STATE_SUCCESS:
+            raise RuntimeError('Cannot set state to "Refunded" when current '
+                               'state is {}'.format(self.state))
+
+        self.state = self.STATE_REFUNDED
+        self.save()
+        metrics.observe_transition(self)
+
+        payment_refund.send(sender=self)
+
+    def form(self, order=None):
+        """
+        :param order: order of the payment, its receipt is added to the form
+            (see ``yandex_cash_register.receipts``). Looked up if not given
+            and ``YANDEX_CR_RECEIPTS`` is set
+        :type order: yandex_cash_register.interfaces.IPayableOrder
+        :rtype: yandex_cash_register.forms.PaymentForm
+        """
         initial = {
             'orderNumber': self.order_id,
             'sum': self.order_sum,
@@ -147,6 +371,10 @@ class Payment(models.Model):
             'cps_phone': self.cps_phone,
             'paymentType': self.payment_type,
         }
+        if order is None and conf.RECEIPTS:
+            order = apps.get_model(*conf.MODEL).get_by_order_id(self.order_id)
+        if order is not None:
+            initial['ym_merchant_receipt'] = receipts.get_receipt(self, order)
         if conf.SUCCESS_URL is None:
             url = reverse('yandex_cash_register:money_payment_finish')
             initial['shopSuccessURL'] = \
@@ -160,3 +388,158 @@ class Payment(models.Model):
                     self.order_id
                 )
         return PaymentForm(initial=initial)
+
+
+@python_2_unicode_compatible
+class NotificationJournal(models.Model):
+    """Raw Yandex.Kassa notification and the response to it. Rows are only
+    ever inserted (see ``yandex_cash_register.journal``) and pruned
+    """
+    created = models.DateTimeField(_('Received at'), default=now,
+                                   db_index=True)
+    action = models.CharField(_('Action'), max_length=32, blank=True)
+    order_id = models.CharField(_('Order ID'), max_length=64, blank=True,
+                                db_index=True)
+    code = models.IntegerField(_('Result code'), null=True)
+    duration = models.FloatField(_('Duration, s'))
+    payload = models.BinaryField(_('Request and response'))
+
+    class Meta:
+        ordering = ('-created',)
+        verbose_name = _('notification')
+        verbose_name_plural = _('notification journal')
+
+    def __str__(self):
+        return '{} #{}'.format(self.action, self.order_id)
+
+    @staticmethod
+    def pack(data):
+        """
+        :type data: dict
+        :rtype: bytes
+        """
+        return zlib.compress(json.dumps(data, sort_keys=True).encode('utf-8'))
+
+    def get_payload(self):
+        """Request body, headers and response content
+
+        :rtype: dict
+        """
+        return json.loads(zlib.decompress(bytes(self.payload)).decode('utf-8'))
+
+
+@python_2_unicode_compatible
+class Refund(models.Model):
+    """Refund of a payment through the Kassa API. Lives in the shard of its
+    payment, see ``yandex_cash_register.refunds``
+    """
+    STATUS_NEW = 'new'
+    STATUS_PENDING = 'pending'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_CANCELED = 'canceled'
+    STATUS_ERROR = 'error'
+    STATUS_CHOICES = (
+        (STATUS_NEW, _('Not submitted')),
+        (STATUS_PENDING, _('Pending')),
+        (STATUS_SUCCEEDED, _('Succeeded')),
+        (STATUS_CANCELED, _('Canceled')),
+        (STATUS_ERROR, _('Error')),
+    )
+    # Refunds in these statuses block new refunds of the same payment
+    ACTIVE_STATUSES = (STATUS_NEW, STATUS_PENDING, STATUS_SUCCEEDED)
+    # The API changes these no more
+    FINAL_STATUSES = (STATUS_SUCCEEDED, STATUS_CANCELED)
+
+    payment = models.ForeignKey(Payment, related_name='refunds',
+                                verbose_name=_('Payment'))
+    order_id = models.CharField(_('Order ID'), max_length=50, editable=False,
+                                db_index=True)
+    external_id = models.CharField(_('Kassa refund ID'), max_length=64,
+                                   null=True, unique=True, editable=False)
+    idempotence_key = models.UUIDField(_('Idempotence key'),
+                                       default=uuid.uuid4, editable=False)
+    amount = MinorUnitsDecimalField(_('Amount'), max_digits=15,
+                                    decimal_places=2, editable=False)
+    status = models.CharField(_('Status'), max_length=16,
+                              choices=STATUS_CHOICES, default=STATUS_NEW,
+                              editable=False, db_index=True)
+    description = models.CharField(_('Description'), max_length=250,
+                                   blank=True)
+    error = models.CharField(_('Error'), max_length=255, blank=True,
+                             editable=False)
+    created = models.DateTimeField(_('Created at'), auto_now_add=True)
+    updated = models.DateTimeField(_('Updated at'), auto_now=True)
+
+    # Same routing by order ID as for payments
+    objects = PaymentQuerySet.as_manager()
+
+    class Meta:
+        ordering = ('-created',)
+        verbose_name = _('refund')
+        verbose_name_plural = _('refunds')
+
+    def __str__(self):
+        return _('Refund of payment #%(payment)s') % {
+            'payment': self.order_id}
+
+
+@python_2_unicode_compatible
+class Subscription(models.Model):
+    """Recurring charges of the payment method saved by the initial payment.
+    Lives in the shard of that payment; charges are payments of their own
+    with ``parent_order_id`` pointing to the subscription, see
+    ``yandex_cash_register.subscriptions``
+    """
+    STATE_ACTIVE = 'active'
+    STATE_SUSPENDED = 'suspended'
+    STATE_CANCELLED = 'cancelled'
+    STATE_CHOICES = (
+        (STATE_ACTIVE, _('Active')),
+        (STATE_SUSPENDED, _('Suspended')),
+        (STATE_CANCELLED, _('Cancelled')),
+    )
+
+    payment = models.OneToOneField(Payment, related_name='subscription',
+                                   verbose_name=_('Initial payment'))
+    order_id = models.CharField(_('Order ID'), max_length=50, unique=True,
+                                editable=False)
+    # Users live in the default database only, not in every shard
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True,
+                             db_constraint=False, verbose_name=_('User'))
+    payment_method_id = models.CharField(_('Saved payment method'),
+                                         max_length=64)
+    amount = MinorUnitsDecimalField(_('Amount'), max_digits=15,
+                                    decimal_places=2)
+    currency = models.PositiveIntegerField(
+        _('Currency'), default=Payment.CURRENCY_RUB,
+        choices=Payment.CURRENCY_CHOICES)
+    description = models.CharField(_('Description'), max_length=128,
+                                   blank=True)
+    interval_months = models.PositiveSmallIntegerField(
+        _('Interval, months'), default=1)
+    state = models.CharField(_('State'), max_length=16,
+                             choices=STATE_CHOICES, default=STATE_ACTIVE)
+    next_charge = models.DateTimeField(_('Next charge at'))
+    retry_at = models.DateTimeField(_('Retry at'), null=True, blank=True)
+    failures = models.PositiveSmallIntegerField(
+        _('Failed attempts'), default=0,
+        help_text=_('Declined charges in a row'))
+    last_charged = models.DateTimeField(_('Last charged at'), null=True,
+                                        editable=False)
+    last_error = models.CharField(_('Last error'), max_length=255,
+                                  blank=True, editable=False)
+    created = models.DateTimeField(_('Created at'), auto_now_add=True)
+    updated = models.DateTimeField(_('Updated at'), auto_now=True)
+
+    # Same routing by order ID as for payments
+    objects = PaymentQuerySet.as_manager()
+
+    class Meta:
+        ordering = ('next_charge',)
+        # Lookup of due subscriptions by charge_subscriptions
+        index_together = (('state', 'next_charge'),)
+        verbose_name = _('subscription')
+        verbose_name_plural = _('subscriptions')
+
+    def __str__(self):
+        return _('Subscription #%(payment)s') % {'payment': self.order_id}
@@ -0,0 +1,223 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from . import cache, conf
+from .signals import payment_authorize, payment_success, payment_fail, \
+    payment_refund
+
+
+logger = logging.getLogger(__name__)
+
+
+class InMemoryPubSub(object):
+    """Delivers messages to subscribers of the same process. Waiting
+    subscribers just block on an event, so an idle one costs next to nothing.
+    Only suitable if payments are processed in the process serving
+    ``wait/``, e.g. by a single-process server
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def subscribe(self, channel):
+        subscription = InMemorySubscription(self, channel)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.channel]
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(message)
+
+
+class InMemorySubscription(object):
+    def __init__(self, pubsub, channel):
+        self.pubsub = pubsub
+        self.channel = channel
+        self.message = None
+        self._event = threading.Event()
+
+    def deliver(self, message):
+        self.message = message
+        self._event.set()
+
+    def wait(self, timeout):
+        """Return message published after subscription, or ``None`` if
+        nothing was published within ``timeout`` seconds
+        """
+        self._event.wait(timeout)
+        return self.message
+
+    def close(self):
+        self.pubsub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CachePubSub(object):
+    """Delivers messages across processes and servers through the Django
+    cache. A single thread per process polls the cache every ``interval``
+    seconds for all channels waited on in the process with one
+    ``get_many()``, so a waiting subscriber only blocks on an event
+    """
+
+    def __init__(self, interval=None, timeout=None):
+        self.interval = interval or conf.PUBSUB_POLL_INTERVAL
+        self.timeout = timeout or conf.WAIT_TIMEOUT * 2
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        self._thread = None
+        self._pid = None
+
+    @staticmethod
+    def key(channel):
+        return cache.make_key('pubsub', channel)
+
+    def subscribe(self, channel):
+        subscription = CacheSubscription(self, channel)
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the poller and the waiters stayed in the parent
+                self._subscriptions = {}
+                self._thread = None
+                self._pid = os.getpid()
+            self._subscriptions.setdefault(subscription.key, set()).add(
+                subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll,
+                                                name='yandex-cr-pubsub')
+                self._thread.daemon = True
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.key)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.key]
+
+    def publish(self, channel, message):
+        cache.get_cache().set(self.key(channel),
+                              {'id': uuid.uuid4().hex, 'message': message},
+                              self.timeout)
+
+    def _poll(self):
+        while True:
+            with self._lock:
+                if not self._subscriptions:
+                    # Started again by the next subscribe()
+                    self._thread = None
+                    return
+                keys = list(self._subscriptions)
+            try:
+                values = cache.get_cache().get_many(keys)
+            except Exception:
+                logger.warning('Failed to poll the cache', exc_info=True)
+                values = {}
+            for key, value in values.items():
+                with self._lock:
+                    subscriptions = list(self._subscriptions.get(key, ()))
+                for subscription in subscriptions:
+                    subscription.check(value)
+            time.sleep(self.interval)
+
+
+class CacheSubscription(object):
+    def __init__(self, pubsub, channel):
+        self.pubsub = pubsub
+        self.channel = channel
+        self.key = pubsub.key(channel)
+        self.message = None
+        self._event = threading.Event()
+        value = cache.get_cache().get(self.key)
+        self._seen = value and value['id']
+
+    def check(self, value):
+        if value is not None and value['id'] != self._seen:
+            self.message = value['message']
+            self._event.set()
+
+    def wait(self, timeout):
+        """Return message published after subscription, or ``None`` if
+        nothing was published within ``timeout`` seconds
+        """
+        self._event.wait(timeout)
+        return self.message
+
+    def close(self):
+        self.pubsub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_pubsub = None
+_pubsub_lock = threading.Lock()
+
+
+def get_pubsub():
+    global _pubsub
+    if _pubsub is None:
+        with _pubsub_lock:
+            if _pubsub is None:
+                _pubsub = import_string(conf.PUBSUB_BACKEND)()
+    return _pubsub
+
+
+def publish_status(sender, **kwargs):
+    """Wake up everyone waiting for a payment to complete or be authorized
+
+    :type sender: yandex_cash_register.models.Payment
+    """
+    status = sender.get_status()
+
+    def publish():
+        get_pubsub().publish(status['order_id'], status)
+
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is None:
+        publish()
+    else:
+        on_commit(publish, using=sender._state.db)
+
+
+def connect():
+    payment_success.connect(publish_status,
+                            dispatch_uid='yandex_cr_publish_success')
+    payment_fail.connect(publish_status,
+                         dispatch_uid='yandex_cr_publish_fail')
+    payment_refund.connect(publish_status,
+                           dispatch_uid='yandex_cr_publish_refund')
+    payment_authorize.connect(publish_status,
+                              dispatch_uid='yandex_cr_publish_authorize')
@@ -0,0 +1,133 @@
+# coding=utf-8
+"""Fiscal receipts (54-FZ) sent with the payment form.
+
+The order describes its receipt with ``IPayableOrder.get_receipt_items()``,
+and ``get_receipt()`` turns the items into the ``ym_merchant_receipt`` JSON
+of the payment form. Rendered receipts are cached by order ID and
+``IPayableOrder.get_receipt_version()``, so a checkout page shown again for
+an unchanged order doesn't serialize the receipt again.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+import json
+
+from django.utils import six
+
+from . import cache, conf
+
+
+CENT = Decimal('0.01')
+# Quantity precision allowed by Kassa
+QUANTITY_STEP = Decimal('0.001')
+MAX_TEXT_LENGTH = 128
+
+
+def _amount(value):
+    return {'amount': float(Decimal(value).quantize(CENT))}
+
+
+def _quantity(value):
+    return float(Decimal(value).quantize(QUANTITY_STEP))
+
+
+def _text(value):
+    return six.text_type(value)[:MAX_TEXT_LENGTH]
+
+
+class ReceiptSerializer(object):
+    """Renders receipt items to ``ym_merchant_receipt`` JSON.
+
+    Converters of item fields are looked up and the JSON encoder is built
+    once, when the serializer is created; rendering is then a single pass
+    over the items.
+
+    :param tax: VAT code of items that have none, see
+        ``YANDEX_CR_RECEIPT_TAX``
+    :param tax_system: tax system code of the shop, optional
+    """
+    # Receipt item key, its converter and whether it is required
+    item_fields = (
+        ('quantity', _quantity, True),
+        ('price', _amount, True),
+        ('tax', int, True),
+        ('text', _text, True),
+        ('paymentMethodType', six.text_type, False),
+        ('paymentSubjectType', six.text_type, False),
+    )
+
+    def __init__(self, tax=None, tax_system=None):
+        self.defaults = {'tax': conf.RECEIPT_TAX if tax is None else tax}
+        self.tax_system = conf.RECEIPT_TAX_SYSTEM if tax_system is None \
+            else tax_system
+        self.encode = json.JSONEncoder(ensure_ascii=False,
+                                       separators=(',', ':')).encode
+
+    def convert_item(self, item):
+        result = {}
+        for key, converter, required in self.item_fields:
+            value = item.get(key, self.defaults.get(key))
+            if value is None:
+                if required:
+                    raise ValueError('Receipt item has no {}'.format(key))
+                continue
+            result[key] = converter(value)
+        return result
+
+    def serialize(self, items, contact):
+        """
+        :param items: dicts with ``text``, ``quantity``, ``price`` and
+            optionally ``tax``, ``paymentMethodType`` and
+            ``paymentSubjectType``
+        :param contact: e-mail or phone of the customer
+        :rtype: basestring
+        """
+        receipt = {'customerContact': contact,
+                   'items': [self.convert_item(item) for item in items]}
+        if self.tax_system is not None:
+            receipt['taxSystem'] = self.tax_system
+        return self.encode(receipt)
+
+
+_serializer = None
+
+
+def get_serializer():
+    """
+    :rtype: ReceiptSerializer
+    """
+    global _serializer
+    if _serializer is None:
+        _serializer = ReceiptSerializer()
+    return _serializer
+
+
+def get_receipt(payment, order):
+    """``ym_merchant_receipt`` of a payment, or ``None`` if the order
+    doesn't describe its receipt
+
+    :type payment: yandex_cash_register.models.Payment
+    :type order: yandex_cash_register.interfaces.IPayableOrder
+    :rtype: basestring
+    """
+    get_items = getattr(order, 'get_receipt_items', None)
+    if get_items is None:
+        return None
+    contact = payment.cps_email or payment.cps_phone
+    get_version = getattr(order, 'get_receipt_version', None)
+    version = get_version() if get_version is not None else None
+
+    if version is not None:
+        receipt = cache.get_receipt(payment.order_id, version, contact)
+        if receipt is not None:
+            return receipt
+    items = get_items()
+    if not items:
+        return None
+    if not contact:
+        raise ValueError('Payment #{} needs an e-mail or a phone for the '
+                         'receipt'.format(payment.order_id))
+    receipt = get_serializer().serialize(items, contact)
+    if version is not None:
+        cache.set_receipt(payment.order_id, version, contact, receipt)
+    return receipt
@@ -0,0 +1,197 @@
+# coding=utf-8
+"""Bulk refunds through the Kassa API.
+
+Refunds are created in the database first (``create_refunds``) and then
+submitted (``submit_refunds``) in batches: API calls run concurrently under a
+rate limit, and each batch of results is saved with a single ``UPDATE``.
+Every refund has its own idempotence key, so submitting it again after a
+crash or an error never refunds twice.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+import logging
+
+from django.utils.timezone import now
+
+from . import bulk, concurrency, conf, kassa, routers
+from .models import Payment, Refund
+from .views import locked_transaction
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_refunds(order_ids, amount=None, description='', batch_size=None):
+    """Create refunds of successful payments with the given order IDs.
+    Payments that already have a refund (not failed) are skipped, so
+    running it again for the same orders is safe
+
+    :param amount: refund amount, full order sum by default
+    :return: number of refunds created
+    """
+    batch_size = batch_size or conf.REFUND_BATCH_SIZE
+    by_shard = {}
+    for order_id in order_ids:
+        by_shard.setdefault(routers.shard_for(order_id), []).append(order_id)
+
+    created = 0
+    for alias, shard_order_ids in by_shard.items():
+        for chunk in bulk.chunks(shard_order_ids, batch_size):
+            payments = Payment.objects.using(alias).filter(
+                order_id__in=chunk, state=Payment.STATE_SUCCESS,
+            ).exclude(
+                refunds__status__in=Refund.ACTIVE_STATUSES,
+            ).only('pk', 'order_id', 'order_sum')
+            refunds = [Refund(payment=payment, order_id=payment.order_id,
+                              amount=amount or payment.order_sum,
+                              description=description)
+                       for payment in payments]
+            Refund.objects.using(alias).bulk_create(refunds)
+            created += len(refunds)
+    return created
+
+
+def record_results(queryset, results, batch_size=None):
+    """Save new field values of many refunds, one ``UPDATE`` per batch.
+    Refunds already finished, e.g. by a ``refund.succeeded`` notification
+    that came before the API response, are left as they are
+
+    :param results: ``{pk: {field: value}}``
+    """
+    queryset = queryset.exclude(status__in=Refund.FINAL_STATUSES)
+    bulk.update_rows(queryset, results,
+                     batch_size or conf.REFUND_BATCH_SIZE, updated=now())
+
+
+def finish_payment(payment_pk, using=None):
+    """Mark the payment refunded once its succeeded refunds cover the
+    order sum
+
+    :return: whether the payment was marked
+    """
+    with locked_transaction('refund', using):
+        payment = Payment.objects.using(using).select_for_update().get(
+            pk=payment_pk)
+        if payment.state != Payment.STATE_SUCCESS:
+            return False
+        refunded = sum(payment.refunds.filter(
+            status=Refund.STATUS_SUCCEEDED).values_list('amount', flat=True),
+            Decimal(0))
+        if refunded < payment.order_sum:
+            return False
+        payment.refund()
+        return True
+
+
+def submit_refunds(workers=None, rate=None, client=None, retry_errors=False,
+                   batch_size=None):
+    """Send refunds that were not submitted yet to the API
+
+    :param rate: API requests per second
+    :param retry_errors: submit refunds that failed before once more
+    :return: number of refunds by resulting status
+    :rtype: dict
+    """
+    client = client or kassa.get_client()
+    workers = workers or conf.REFUND_WORKERS
+    batch_size = batch_size or conf.REFUND_BATCH_SIZE
+    limiter = concurrency.RateLimiter(rate or conf.REFUND_RATE)
+    statuses = [Refund.STATUS_NEW]
+    if retry_errors:
+        statuses.append(Refund.STATUS_ERROR)
+
+    def submit(refund):
+        if not refund['payment__external_id']:
+            raise kassa.KassaError('Payment is unknown to the Kassa API')
+        limiter.wait()
+        return client.create_refund(
+            refund['payment__external_id'], refund['amount'],
+            refund['payment__order_currency'], refund['description'],
+            refund['idempotence_key'])
+
+    counts = dict((status, 0) for status, _ in Refund.STATUS_CHOICES
+                  if status != Refund.STATUS_NEW)
+    for queryset in Refund.objects.fan_out():
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(
+                status__in=statuses, pk__gt=last_pk,
+            ).order_by('pk').values(
+                'pk', 'payment_id', 'amount', 'description',
+                'idempotence_key', 'payment__external_id',
+                'payment__order_currency',
+            )[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1]['pk']
+
+            results = {}
+            succeeded = set()
+            for refund, data, exc_info in concurrency.run_bounded(
+                    submit, batch, workers):
+                if exc_info is not None:
+                    logger.warning('Failed to submit refund %s',
+                                   refund['pk'], exc_info=exc_info)
+                    results[refund['pk']] = {
+                        'status': Refund.STATUS_ERROR,
+                        'error': '{}'.format(exc_info[1])[:255],
+                    }
+                    continue
+                results[refund['pk']] = {'status': data['status'],
+                                         'external_id': data['id'],
+                                         'error': ''}
+                if data['status'] == Refund.STATUS_SUCCEEDED:
+                    succeeded.add(refund['payment_id'])
+            record_results(queryset, results, batch_size)
+
+            for values in results.values():
+                # Statuses the API may add later are saved as they are
+                status = values['status']
+                if status not in counts:
+                    status = Refund.STATUS_ERROR
+                counts[status] += 1
+            for payment_pk in sorted(succeeded):
+                finish_payment(payment_pk, queryset.db)
+    return counts
+
+
+def apply_refund(data):
+    """Save the state of an API refund object, e.g. from a
+    ``refund.succeeded`` notification. Refunds made outside of this
+    application (in the Kassa dashboard) are recorded too
+
+    :type data: dict
+    :return: the refund, or ``None`` if its payment is unknown
+    :rtype: yandex_cash_register.models.Refund
+    """
+    refund = None
+    for queryset in Refund.objects.fan_out():
+        refund = queryset.filter(external_id=data['id']).first()
+        if refund is not None:
+            break
+    else:
+        payment = None
+        for queryset in Payment.objects.fan_out():
+            payment = queryset.filter(external_id=data['payment_id']).first()
+            if payment is not None:
+                break
+        if payment is None:
+            return None
+        amount = Decimal(data['amount']['value'])
+        # A submitted refund whose response was lost
+        refund = payment.refunds.filter(
+            external_id__isnull=True, amount=amount,
+            status__in=(Refund.STATUS_NEW, Refund.STATUS_PENDING,
+                        Refund.STATUS_ERROR),
+        ).order_by('pk').first() or Refund(
+            payment=payment, order_id=payment.order_id, amount=amount,
+            description=data.get('description', ''))
+        refund.external_id = data['id']
+
+    refund.status = data['status']
+    refund.error = ''
+    refund.save()
+    if refund.status == Refund.STATUS_SUCCEEDED:
+        finish_payment(refund.payment_id, refund._state.db)
+    return refund
@@ -0,0 +1,162 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from contextlib import contextmanager
+import threading
+import zlib
+
+from . import cache, conf
+
+
+APP_LABEL = 'yandex_cash_register'
+
+_local = threading.local()
+
+
+@contextmanager
+def pin_primary():
+    """Read payments only from the primary database within the block"""
+    depth = getattr(_local, 'pinned', 0)
+    _local.pinned = depth + 1
+    try:
+        yield
+    finally:
+        _local.pinned = depth
+
+
+def is_pinned():
+    return getattr(_local, 'pinned', 0) > 0
+
+
+def mark_written(order_id):
+    """Keep reads of the payment on the primary until the replica is
+    expected to catch up with the write
+    """
+    if conf.REPLICA_DB is None:
+        return
+    cache.get_cache().set(cache.make_key('written', order_id), True,
+                          conf.READ_YOUR_WRITES_WINDOW)
+
+
+def get_shards():
+    """Aliases of the primary databases payments are spread across
+
+    :rtype: list
+    """
+    return list(conf.SHARDS or [conf.PRIMARY_DB])
+
+
+def shard_for(order_id):
+    """Primary database alias of the payment with the given order ID. The
+    hash is stable across processes and Python versions, but adding a
+    shard moves existing payments
+
+    :type order_id: basestring
+    :rtype: basestring
+    """
+    shards = get_shards()
+    if len(shards) == 1 or order_id is None:
+        return shards[0]
+    checksum = zlib.crc32(order_id.encode('utf-8')) & 0xffffffff
+    return shards[checksum % len(shards)]
+
+
+def replica_for(alias):
+    """Replica of a primary database alias, or ``None``"""
+    if isinstance(conf.REPLICA_DB, dict):
+        return conf.REPLICA_DB.get(alias)
+    if alias == conf.PRIMARY_DB:
+        return conf.REPLICA_DB
+    return None
+
+
+def read_db(order_id=None):
+    """Database alias for a read-only path, e.g. a report or a status read.
+    Replica is used unless it is not configured, the current code is pinned
+    to the primary or the payment was changed recently.
+
+    :type order_id: basestring
+    :param order_id: payment being read, picks the shard when sharding
+        is enabled
+    :rtype: basestring
+    """
+    primary = shard_for(order_id)
+    replica = replica_for(primary)
+    if replica is None or is_pinned():
+        return primary
+    if order_id is not None and \
+            cache.get_cache().get(cache.make_key('written', order_id)):
+        return primary
+    return replica
+
+
+class ReplicaRouter(object):
+    """Keeps payments on the primary database. Replica is only read from
+    explicitly, through ``Payment.objects.for_read()``, and objects loaded
+    from it are still saved to the primary.
+    """
+
+    @staticmethod
+    def _is_payment_app(model):
+        return model._meta.app_label == APP_LABEL
+
+    def db_for_read(self, model, **hints):
+        if self._is_payment_app(model):
+            return conf.PRIMARY_DB
+        return None
+
+    def db_for_write(self, model, **hints):
+        if self._is_payment_app(model):
+            return conf.PRIMARY_DB
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = (conf.PRIMARY_DB, conf.REPLICA_DB)
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == APP_LABEL and db == conf.REPLICA_DB:
+            return False
+        return None
+
+
+class ShardRouter(ReplicaRouter):
+    """Spreads payments across ``YANDEX_CR_SHARDS`` by order ID. Payments
+    are saved to their shard automatically, but querysets have to pick one
+    with ``Payment.objects.for_order()`` or go through all of them with
+    ``Payment.objects.fan_out()``; otherwise the first shard is used.
+    """
+
+    @staticmethod
+    def _instance_db(hints):
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if instance._meta.app_label == APP_LABEL and \
+                getattr(instance, 'order_id', None):
+            return shard_for(instance.order_id)
+        return instance._state.db
+
+    def db_for_read(self, model, **hints):
+        if self._is_payment_app(model):
+            return self._instance_db(hints) or get_shards()[0]
+        return None
+
+    def db_for_write(self, model, **hints):
+        if self._is_payment_app(model):
+            return self._instance_db(hints) or get_shards()[0]
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = set(get_shards())
+        aliases.update(replica_for(alias) for alias in get_shards())
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == APP_LABEL and db not in get_shards():
+            return False
+        return None
@@ -7,3 +7,5 @@ from django.dispatch import Signal
 payment_process = Signal()
 payment_success = Signal()
 payment_fail = Signal()
+payment_refund = Signal()
+payment_authorize = Signal()
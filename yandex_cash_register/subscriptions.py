@@ -0,0 +1,280 @@
+# coding=utf-8
+"""Recurring charges of saved payment methods.
+
+The initial payment is created with ``save_payment_method=True``; once it
+succeeds, ``subscribe()`` starts a subscription on the saved method.
+``charge_subscriptions()`` (the ``charge_subscriptions`` command, run e.g.
+nightly) then takes due subscriptions in batches: it creates their charges
+as payments with one ``INSERT`` per shard, submits them to the API
+concurrently under a rate limit and saves the new schedules with one
+``UPDATE`` per batch.
+
+Order ID of a charge is derived from the subscription, its due date and
+the attempt, and is also the idempotence key of the API request. A run that
+crashed halfway is simply started again: charges already made are found and
+recorded instead of being made twice.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import calendar
+import datetime
+import hashlib
+import logging
+import time
+
+from django.db.models import Q
+from django.utils.timezone import now
+
+from . import bulk, concurrency, conf, kassa, metrics, routers
+from .models import Payment, Subscription
+from .views import locked_transaction
+
+
+logger = logging.getLogger(__name__)
+
+RESULTS = ('charged', 'pending', 'declined', 'errors', 'suspended',
+           'retries')
+
+# Outcome of a charge by the state of its payment
+STATE_RESULTS = {
+    Payment.STATE_SUCCESS: 'charged',
+    Payment.STATE_REFUNDED: 'charged',
+    Payment.STATE_PROCESSED: 'pending',
+    # Not settled until the hold is captured or cancelled
+    Payment.STATE_AUTHORIZED: 'pending',
+    Payment.STATE_FAIL: 'declined',
+}
+
+
+def add_months(value, months):
+    """Same day ``months`` later, or the last day of a shorter month
+
+    :type value: datetime.datetime
+    """
+    month = value.month - 1 + months
+    year = value.year + month // 12
+    month = month % 12 + 1
+    day = min(value.day, calendar.monthrange(year, month)[1])
+    return value.replace(year=year, month=month, day=day)
+
+
+def charge_order_id(order_id, due, attempt):
+    """Order ID of a charge: the same for repeated runs, a new one for each
+    retry after a decline
+
+    :param order_id: order ID of the subscription
+    :param due: ``next_charge`` of the subscription
+    :param attempt: number of failed attempts before this one
+    """
+    name = '{}/{:%Y%m%d%H%M%S}/{}'.format(order_id, due, attempt)
+    return conf.SUBSCRIPTION_ORDER_PREFIX + \
+        hashlib.sha1(name.encode('utf-8')).hexdigest()[:32]
+
+
+def subscribe(payment, interval_months=1, amount=None, description='',
+              start=None):
+    """Start charging the payment method saved by a successful payment
+    every ``interval_months``. Calling it again for the same payment
+    returns the existing subscription
+
+    :type payment: yandex_cash_register.models.Payment
+    :param amount: amount of each charge, the order sum by default
+    :param start: first charge time, one interval after the payment by
+        default
+    :rtype: yandex_cash_register.models.Subscription
+    """
+    if not payment.is_payed or not payment.payment_method_id:
+        raise ValueError('Payment #{} has no saved payment method'.format(
+            payment.order_id))
+    subscription, _ = Subscription.objects.for_order(
+        payment.order_id).get_or_create(order_id=payment.order_id, defaults={
+            'payment': payment,
+            'user_id': payment.user_id,
+            'payment_method_id': payment.payment_method_id,
+            'amount': amount or payment.order_sum,
+            'currency': payment.order_currency,
+            'description': description,
+            'interval_months': interval_months,
+            'next_charge': start or add_months(payment.completed or now(),
+                                               interval_months),
+        })
+    return subscription
+
+
+def due_subscriptions(queryset, at, batch_size):
+    """Batches of active subscriptions due at ``at``, paginated by pk"""
+    queryset = queryset.filter(
+        state=Subscription.STATE_ACTIVE, next_charge__lte=at,
+    ).filter(
+        Q(retry_at__isnull=True) | Q(retry_at__lte=at),
+    ).order_by('pk').values(
+        'pk', 'order_id', 'user_id', 'payment_method_id', 'amount',
+        'currency', 'description', 'interval_months', 'next_charge',
+        'failures')
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1]['pk']
+
+
+def create_charges(rows):
+    """Create payments of the charges of a batch, skipping ones created by
+    an earlier run
+
+    :param rows: subscriptions with ``charge`` order IDs
+    :return: state of each charge payment by order ID
+    :rtype: dict
+    """
+    by_shard = {}
+    for row in rows:
+        by_shard.setdefault(routers.shard_for(row['charge']), []).append(row)
+
+    states = {}
+    for alias, shard_rows in by_shard.items():
+        queryset = Payment.objects.using(alias)
+        states.update(queryset.filter(
+            order_id__in=[row['charge'] for row in shard_rows],
+        ).values_list('order_id', 'state'))
+        queryset.bulk_create([
+            Payment(order_id=row['charge'], order_sum=row['amount'],
+                    order_currency=row['currency'], user_id=row['user_id'],
+                    parent_order_id=row['order_id'],
+                    payment_method_id=row['payment_method_id'])
+            for row in shard_rows if row['charge'] not in states])
+    for row in rows:
+        states.setdefault(row['charge'], Payment.STATE_CREATED)
+    return states
+
+
+def apply_charge(order_id, data):
+    """Move the payment of a charge to the state of its API payment
+
+    :return: new state of the payment
+    """
+    with locked_transaction('subscription', routers.shard_for(order_id)):
+        payment = Payment.objects.for_order(order_id).select_for_update(
+        ).get(order_id=order_id)
+        if payment.state != Payment.STATE_CREATED:
+            return payment.state
+        kassa.update_payment(payment, data)
+        if data['status'] == 'canceled':
+            payment.fail()
+        else:
+            payment.process()
+            if data['status'] == 'succeeded':
+                payment.complete()
+        return payment.state
+
+
+def charge_subscriptions(workers=None, rate=None, client=None,
+                         batch_size=None, at=None):
+    """Charge subscriptions due at ``at`` (now by default).
+
+    A declined charge is retried after ``YANDEX_CR_SUBSCRIPTION_RETRY_DELAY``
+    seconds, and the subscription is suspended after
+    ``YANDEX_CR_SUBSCRIPTION_MAX_FAILURES`` declines in a row. A request that
+    failed (e.g. the API is down) is retried after the same delay with the
+    same idempotence key. Pending charges are completed by notifications or
+    ``sync_payments`` like any other payment; until then the schedule stays
+    as it is and the subscription is checked again after the same delay.
+
+    :param rate: API requests per second
+    :return: number of subscriptions by result, see ``RESULTS``
+    :rtype: dict
+    """
+    client = client or kassa.get_client()
+    workers = workers or conf.SUBSCRIPTION_WORKERS
+    batch_size = batch_size or conf.SUBSCRIPTION_BATCH_SIZE
+    limiter = concurrency.RateLimiter(rate or conf.SUBSCRIPTION_RATE)
+    at = at or now()
+    retry_at = at + datetime.timedelta(seconds=conf.SUBSCRIPTION_RETRY_DELAY)
+
+    def submit(row):
+        limiter.wait()
+        return client.create_payment(
+            row['amount'], row['currency'],
+            description=row['description'] or None,
+            metadata={'orderNumber': row['charge'],
+                      'subscription': row['order_id']},
+            idempotence_key=row['charge'],
+            payment_method_id=row['payment_method_id'])
+
+    def outcome(row, state, error=''):
+        result = STATE_RESULTS.get(state)
+        if result == 'pending':
+            # Looked at again after the delay: the same charge is found
+            # settled by then and counted as charged or declined
+            return result, {'retry_at': retry_at}
+        if result == 'charged':
+            return result, {
+                'next_charge': add_months(row['next_charge'],
+                                          row['interval_months']),
+                'retry_at': None, 'failures': 0, 'last_charged': at,
+                'last_error': ''}
+        if result == 'declined':
+            failures = row['failures'] + 1
+            values = {'failures': failures, 'last_error': error[:255]}
+            if failures >= conf.SUBSCRIPTION_MAX_FAILURES:
+                values['state'] = Subscription.STATE_SUSPENDED
+                return 'suspended', values
+            values['retry_at'] = retry_at
+            return result, values
+        return 'errors', {'retry_at': retry_at, 'last_error': error[:255]}
+
+    counts = dict.fromkeys(RESULTS, 0)
+    started = time.time()
+    for queryset in Subscription.objects.fan_out():
+        for batch in due_subscriptions(queryset, at, batch_size):
+            for row in batch:
+                row['charge'] = charge_order_id(
+                    row['order_id'], row['next_charge'], row['failures'])
+                if row['failures']:
+                    counts['retries'] += 1
+            states = create_charges(batch)
+
+            updates = {}
+            submitted = []
+            for row in batch:
+                if states[row['charge']] == Payment.STATE_CREATED:
+                    submitted.append(row)
+                else:
+                    # Charged by a run that stopped before saving it, or
+                    # pending the last time
+                    updates[row['pk']] = outcome(row, states[row['charge']],
+                                                 'Declined')
+            # API calls run in worker threads, database work stays in this one
+            for row, data, exc_info in concurrency.run_bounded(
+                    submit, submitted, workers):
+                if exc_info is not None:
+                    logger.warning('Failed to charge subscription #%s',
+                                   row['order_id'], exc_info=exc_info)
+                    updates[row['pk']] = outcome(
+                        row, None, '{}'.format(exc_info[1]))
+                    continue
+                try:
+                    state = apply_charge(row['charge'], data)
+                except Exception as e:
+                    logger.exception('Failed to save charge #%s',
+                                     row['charge'])
+                    updates[row['pk']] = outcome(row, None, '{}'.format(e))
+                    continue
+                reason = (data.get('cancellation_details') or {}).get(
+                    'reason', data['status'])
+                updates[row['pk']] = outcome(row, state, reason)
+
+            bulk.update_rows(queryset, dict(
+                (pk, values) for pk, (_, values) in updates.items()),
+                batch_size, updated=now())
+            for result, _ in updates.values():
+                counts[result] += 1
+                metrics.registry.inc(metrics.SUBSCRIPTION_CHARGES,
+                                     result=result)
+
+    elapsed = time.time() - started
+    total = sum(counts[result] for result in RESULTS if result != 'retries')
+    logger.info('Charged %d subscriptions in %.1f s (%.1f per second): %r',
+                total, elapsed, total / elapsed if elapsed else 0, counts)
+    return counts
@@ -0,0 +1,201 @@
+# coding=utf-8
+"""Checking stale payments against the Kassa API.
+
+A payment gets stuck if its final notification never arrives.
+``sync_payments`` finds such payments, asks Kassa for their real status
+and completes, fails or authorizes them the same way the notification
+views do.
+
+Only payments known to the API, i.e. with ``external_id``, can be checked:
+API payments (``KassaClient.create_payment_for()``, subscription charges)
+left ``created``, and ``processed`` ones. Payments of the legacy HTTP
+protocol have no ``external_id``, and the API can't look them up: the ones
+left ``processed`` (``checkOrder`` without ``paymentAviso``) are logged
+and, once ``YANDEX_CR_SYNC_LEGACY_EXPIRE`` seconds old, failed.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+import logging
+
+from django.db.models import Q
+from django.utils.timezone import now
+
+from . import concurrency, conf, kassa
+from .models import Payment
+from .views import locked_transaction
+
+
+logger = logging.getLogger(__name__)
+
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_CANCELED = 'canceled'
+STATUS_WAITING_FOR_CAPTURE = 'waiting_for_capture'
+
+RESULTS = ('checked', 'completed', 'failed', 'authorized', 'pending',
+           'skipped', 'errors', 'legacy', 'expired')
+
+
+# States of stuck payments, each with the field telling how long they have
+# been in it. Both pairs are indexed
+STALE_STATES = ((Payment.STATE_PROCESSED, 'performed'),
+                (Payment.STATE_CREATED, 'created'))
+
+
+def stale_payments(queryset, before, batch_size):
+    """``(pk, order_id, external_id)`` of payments stuck since before
+    ``before`` (see ``STALE_STATES``) and known to the API, read in batches
+    of ``batch_size``. Batches are paginated by ``(time, pk)``, so each one
+    is a short range scan of the ``(state, time)`` index, however many
+    payments get completed meanwhile
+    """
+    for state, field in STALE_STATES:
+        for row in _stale_in_state(queryset, state, field, before,
+                                   batch_size):
+            yield row
+
+
+def legacy_payments(queryset, before, batch_size):
+    """``(pk, order_id, None)`` of payments of the HTTP protocol processed
+    before ``before`` and never confirmed, read like ``stale_payments()``
+    """
+    return _stale_in_state(queryset, Payment.STATE_PROCESSED, 'performed',
+                           before, batch_size, known=False)
+
+
+def _stale_in_state(queryset, state, field, before, batch_size, known=True):
+    queryset = queryset.filter(**{
+        'state': state, field + '__lt': before,
+        'external_id__isnull': not known,
+    }).order_by(field, 'pk').values_list(
+        field, 'pk', 'order_id', 'external_id')
+    last = None
+    while True:
+        batch = queryset
+        if last is not None:
+            batch = batch.filter(Q(**{field + '__gt': last[0]}) |
+                                 Q(**{field: last[0], 'pk__gt': last[1]}))
+        batch = list(batch[:batch_size])
+        for row in batch:
+            yield row[1:]
+        if len(batch) < batch_size:
+            return
+        last = batch[-1]
+
+
+def apply_status(pk, status, using=None, data=None):
+    """Complete, fail or authorize a created or processed payment according
+    to its status in Kassa. Does nothing if the payment was changed
+    meanwhile, e.g. by a late notification, so it is safe to repeat
+
+    :param status: ``status`` of the API payment object
+    :param data: the API payment object, its details are copied to the
+        payment
+    :return: new state, or ``None`` if the payment is left as is
+    """
+    if status not in (STATUS_SUCCEEDED, STATUS_CANCELED,
+                      STATUS_WAITING_FOR_CAPTURE):
+        return None
+    with locked_transaction('sync', using):
+        payment = Payment.objects.using(using).select_for_update().get(pk=pk)
+        if payment.state not in (Payment.STATE_CREATED,
+                                 Payment.STATE_PROCESSED):
+            return None
+        if data is not None:
+            kassa.update_payment(payment, data)
+        if status == STATUS_CANCELED:
+            payment.fail()
+            return payment.state
+        # As the notification views do for API payments
+        if payment.state == Payment.STATE_CREATED:
+            payment.process()
+        if status == STATUS_SUCCEEDED:
+            payment.complete()
+        else:
+            payment.authorize()
+        return payment.state
+
+
+def expire_payment(pk, using=None):
+    """Fail a processed payment of the HTTP protocol that was never
+    confirmed. Does nothing if it was changed meanwhile
+
+    :return: new state, or ``None`` if the payment is left as is
+    """
+    with locked_transaction('sync', using):
+        payment = Payment.objects.using(using).select_for_update().get(pk=pk)
+        if payment.state != Payment.STATE_PROCESSED or \
+                payment.external_id is not None:
+            return None
+        payment.fail()
+        return payment.state
+
+
+def sync_payments(min_age=None, batch_size=None, workers=None, client=None,
+                  legacy_expire=None):
+    """Check payments stuck for more than ``min_age`` seconds with the API,
+    ``workers`` requests at a time. Payments of the HTTP protocol are failed
+    once processed more than ``legacy_expire`` seconds ago, and only logged
+    before that
+
+    :type client: yandex_cash_register.kassa.KassaClient
+    :return: number of payments by result, see ``RESULTS``
+    :rtype: dict
+    """
+    client = client or kassa.get_client()
+    before = now() - datetime.timedelta(
+        seconds=conf.SYNC_MIN_AGE if min_age is None else min_age)
+    batch_size = batch_size or conf.SYNC_BATCH_SIZE
+    workers = workers or conf.SYNC_WORKERS
+    if legacy_expire is None:
+        legacy_expire = conf.SYNC_LEGACY_EXPIRE
+
+    def fetch(row):
+        return client.get_payment(row[2])
+
+    counts = dict.fromkeys(RESULTS, 0)
+    for queryset in Payment.objects.fan_out():
+        rows = stale_payments(queryset, before, batch_size)
+        # API calls run in worker threads, database work stays in this one
+        for row, data, exc_info in concurrency.run_bounded(
+                fetch, rows, workers):
+            counts['checked'] += 1
+            if exc_info is not None:
+                logger.warning('Failed to get status of payment #%s',
+                               row[1], exc_info=exc_info)
+                counts['errors'] += 1
+                continue
+            status = data['status']
+            try:
+                state = apply_status(row[0], status, queryset.db, data)
+            except Exception:
+                logger.exception('Failed to sync payment #%s', row[1])
+                counts['errors'] += 1
+                continue
+            if state == Payment.STATE_SUCCESS:
+                counts['completed'] += 1
+            elif state == Payment.STATE_FAIL:
+                counts['failed'] += 1
+            elif state == Payment.STATE_AUTHORIZED:
+                counts['authorized'] += 1
+            elif status in (STATUS_SUCCEEDED, STATUS_CANCELED,
+                            STATUS_WAITING_FOR_CAPTURE):
+                counts['skipped'] += 1
+            else:
+                counts['pending'] += 1
+            if state is not None:
+                logger.info('Payment #%s synced, state %s', row[1], state)
+
+        if legacy_expire:
+            expire_before = now() - datetime.timedelta(seconds=legacy_expire)
+            for pk, order_id, _ in legacy_payments(queryset, expire_before,
+                                                   batch_size):
+                if expire_payment(pk, queryset.db) is not None:
+                    logger.warning('Payment #%s was never confirmed, '
+                                   'failed', order_id)
+                    counts['expired'] += 1
+        for pk, order_id, _ in legacy_payments(queryset, before, batch_size):
+            logger.warning('Payment #%s is processed but not confirmed yet',
+                           order_id)
+            counts['legacy'] += 1
+    return counts
@@ -0,0 +1,240 @@
+# coding=utf-8
+"""Local stand-in for the Yandex.Kassa REST API, for tests"""
+from __future__ import absolute_import, unicode_literals
+
+import base64
+from decimal import Decimal
+import json
+import re
+import threading
+import uuid
+
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.timezone import now
+
+
+SHOP_ID = '12345'
+SECRET_KEY = 'test_secret'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeKassa(object):
+    """Keeps payments in memory and serves the API from a background thread.
+    Use as a context manager or call ``start()`` and ``stop()``
+    """
+
+    def __init__(self):
+        self.payments = {}
+        self.refunds = {}
+        self.refund_status = 'succeeded'
+        # Saved payment methods that get declined
+        self.declined_methods = set()
+        # Saved payment methods whose charges stay pending
+        self.pending_methods = set()
+        self.requests = []
+        self.ports = set()
+        self.failures = []
+        self._responses = {}
+        self._lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/api/v3/'.format(
+            self.server.server_address[1])
+
+    def start(self):
+        kassa = self
+
+        class Handler(KassaHandler):
+            pass
+        Handler.kassa = kassa
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail_next(self, count=1, status=503):
+        """Respond to the next ``count`` requests with ``status``"""
+        with self._lock:
+            self.failures.extend([status] * count)
+
+    def add_payment(self, status='pending', amount='100.00', **kwargs):
+        payment = {
+            'id': '{}'.format(uuid.uuid4()),
+            'status': status,
+            'paid': status in ('waiting_for_capture', 'succeeded'),
+            'amount': {'value': amount, 'currency': 'RUB'},
+            'created_at': now().isoformat(),
+            'metadata': {},
+        }
+        payment.update(kwargs)
+        with self._lock:
+            self.payments[payment['id']] = payment
+        return payment
+
+    def handle(self, method, path, headers, data):
+        """
+        :return: status and response data
+        """
+        with self._lock:
+            self.requests.append((method, path, dict(headers), data))
+            if self.failures:
+                return self.failures.pop(0), {'type': 'error',
+                                              'code': 'internal_server_error'}
+
+        credentials = base64.b64encode('{}:{}'.format(
+            SHOP_ID, SECRET_KEY).encode('ascii')).decode('ascii')
+        if headers.get('Authorization') != 'Basic ' + credentials:
+            return 401, {'type': 'error', 'code': 'invalid_credentials'}
+
+        key = headers.get('Idempotence-Key')
+        if method == 'POST':
+            if not key:
+                return 400, {'type': 'error', 'code': 'invalid_request',
+                             'description': 'Idempotence key is missing'}
+            with self._lock:
+                if (path, key) in self._responses:
+                    return self._responses[path, key]
+
+        for pattern, route in self.routes:
+            match = re.match(pattern, path)
+            if match and route[0] == method:
+                result = getattr(self, route[1])(data, *match.groups())
+                if method == 'POST':
+                    with self._lock:
+                        self._responses[path, key] = result
+                return result
+        return 404, {'type': 'error', 'code': 'not_found'}
+
+    routes = (
+        (r'^/api/v3/payments$', ('POST', 'create_payment')),
+        (r'^/api/v3/payments/([\w-]+)$', ('GET', 'get_payment')),
+        (r'^/api/v3/payments/([\w-]+)/capture$', ('POST', 'capture_payment')),
+        (r'^/api/v3/payments/([\w-]+)/cancel$', ('POST', 'cancel_payment')),
+        (r'^/api/v3/refunds$', ('POST', 'create_refund')),
+        (r'^/api/v3/refunds/([\w-]+)$', ('GET', 'get_refund')),
+    )
+
+    def create_payment(self, data):
+        kwargs = {'metadata': data.get('metadata', {})}
+        status = 'pending'
+        if 'confirmation' in data:
+            kwargs['confirmation'] = {
+                'type': 'redirect',
+                'confirmation_url': 'https://kassa.test/checkout',
+            }
+        if data.get('save_payment_method'):
+            kwargs['payment_method'] = {'type': 'bank_card',
+                                        'id': '{}'.format(uuid.uuid4()),
+                                        'saved': True}
+        method_id = data.get('payment_method_id')
+        if method_id:
+            # Charge of a saved method, no confirmation needed
+            kwargs['payment_method'] = {'type': 'bank_card', 'id': method_id,
+                                        'saved': True}
+            if method_id in self.declined_methods:
+                status = 'canceled'
+                kwargs['cancellation_details'] = {
+                    'party': 'issuer', 'reason': 'insufficient_funds'}
+            elif method_id in self.pending_methods:
+                pass
+            elif data.get('capture', True):
+                status = 'succeeded'
+            else:
+                status = 'waiting_for_capture'
+        payment = self.add_payment(status, amount=data['amount']['value'],
+                                   **kwargs)
+        return 200, payment
+
+    def get_payment(self, data, payment_id):
+        if payment_id not in self.payments:
+            return 404, {'type': 'error', 'code': 'not_found'}
+        return 200, self.payments[payment_id]
+
+    def _change_status(self, payment_id, status):
+        if payment_id not in self.payments:
+            return 404, {'type': 'error', 'code': 'not_found'}
+        payment = self.payments[payment_id]
+        if payment['status'] != 'waiting_for_capture':
+            return 400, {'type': 'error', 'code': 'invalid_request',
+                         'description': 'Wrong payment status'}
+        payment['status'] = status
+        return 200, payment
+
+    def capture_payment(self, data, payment_id):
+        if 'amount' in data and payment_id in self.payments:
+            # Partial capture
+            self.payments[payment_id]['amount'] = data['amount']
+        return self._change_status(payment_id, 'succeeded')
+
+    def cancel_payment(self, data, payment_id):
+        return self._change_status(payment_id, 'canceled')
+
+    def create_refund(self, data):
+        with self._lock:
+            payment = self.payments.get(data['payment_id'])
+            if payment is None or payment['status'] != 'succeeded':
+                return 400, {'type': 'error', 'code': 'invalid_request',
+                             'description': 'Payment can not be refunded'}
+            refunded = sum(Decimal(refund['amount']['value'])
+                           for refund in self.refunds.values()
+                           if refund['payment_id'] == payment['id'])
+            amount = Decimal(data['amount']['value'])
+            if refunded + amount > Decimal(payment['amount']['value']):
+                return 400, {'type': 'error', 'code': 'invalid_request',
+                             'description': 'Refund exceeds payment'}
+            refund = {
+                'id': '{}'.format(uuid.uuid4()),
+                'payment_id': payment['id'],
+                'status': self.refund_status,
+                'amount': data['amount'],
+                'created_at': now().isoformat(),
+            }
+            self.refunds[refund['id']] = refund
+        return 200, refund
+
+    def get_refund(self, data, refund_id):
+        if refund_id not in self.refunds:
+            return 404, {'type': 'error', 'code': 'not_found'}
+        return 200, self.refunds[refund_id]
+
+
+class KassaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    kassa = None
+
+    def _serve(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        data = json.loads(body.decode('utf-8')) if body else {}
+        self.kassa.ports.add(self.client_address[1])
+        status, result = self.kassa.handle(self.command, self.path,
+                                           self.headers, data)
+        content = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = _serve
+
+    def log_message(self, format, *args):
+        pass
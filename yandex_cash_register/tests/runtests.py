@@ -32,6 +32,11 @@ SETTINGS_DICT = {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': os.path.join(APP_DIR, 'db.sqlite3'),
         },
+        # Second shard for sharding tests
+        'shard2': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(APP_DIR, 'shard2.sqlite3'),
+        },
     },
     'MIDDLEWARE_CLASSES': (
         'django.middleware.common.CommonMiddleware',
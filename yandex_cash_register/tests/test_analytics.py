@@ -0,0 +1,190 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from array import array
+import datetime
+from decimal import Decimal
+import json
+from unittest import skipIf
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils.six import StringIO
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from .. import analytics
+from ..cache import get_cache
+from ..models import Payment
+from .. import conf
+
+
+class AnalyticsTestCase(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.since, self.until = analytics.get_period(
+            datetime.date(2017, 3, 1), datetime.date(2017, 3, 31))
+        created = datetime.datetime(2017, 3, 10, 12)
+        second = datetime.timedelta(seconds=1)
+        rows = (
+            # payment type, state, seconds to process, seconds to complete
+            (conf.PAYMENT_TYPE_CARD, Payment.STATE_SUCCESS, 10, 20),
+            (conf.PAYMENT_TYPE_CARD, Payment.STATE_SUCCESS, 20, 40),
+            (conf.PAYMENT_TYPE_CARD, Payment.STATE_FAIL, 30, 60),
+            (conf.PAYMENT_TYPE_YANDEX_MONEY, Payment.STATE_PROCESSED, 40,
+             None),
+            (conf.PAYMENT_TYPE_YANDEX_MONEY, Payment.STATE_CREATED, None,
+             None),
+        )
+        for i, (payment_type, state, to_process, to_complete) in \
+                enumerate(rows):
+            performed = completed = None
+            if to_process is not None:
+                performed = created + to_process * second
+            if to_complete is not None:
+                completed = performed + to_complete * second
+            payment = Payment.objects.create(
+                order_id='order-{}'.format(i), order_sum=Decimal('100.00'),
+                payment_type=payment_type, state=state)
+            Payment.objects.filter(pk=payment.pk).update(
+                created=created, performed=performed, completed=completed)
+
+        # Out of the period
+        Payment.objects.create(order_id='other', order_sum=Decimal('100.00'))
+
+    def test_period(self):
+        self.assertEqual(self.since, datetime.datetime(2017, 3, 1))
+        self.assertEqual(self.until, datetime.datetime(2017, 4, 1))
+
+    def test_funnel(self):
+        result = analytics.report(self.since, self.until)['funnel']
+        self.assertEqual(result[analytics.TOTAL], {
+            'created': 5, 'processed': 4, 'success': 2, 'fail': 1})
+        self.assertEqual(result[conf.PAYMENT_TYPE_CARD], {
+            'created': 3, 'processed': 3, 'success': 2, 'fail': 1})
+        self.assertEqual(result[conf.PAYMENT_TYPE_YANDEX_MONEY], {
+            'created': 2, 'processed': 1, 'success': 0, 'fail': 0})
+
+    def test_refunded_in_success(self):
+        Payment.objects.filter(order_id='order-0').update(
+            state=Payment.STATE_REFUNDED)
+        result = analytics.report(self.since, self.until)['funnel']
+        self.assertEqual(result[analytics.TOTAL]['success'], 2)
+        self.assertEqual(result[conf.PAYMENT_TYPE_CARD]['success'], 2)
+
+    def test_timings(self):
+        result = analytics.report(self.since, self.until)
+        to_process = result['to_process'][analytics.TOTAL]
+        self.assertEqual(to_process['count'], 4)
+        for key, value in (('p50', 25), ('p90', 37), ('p99', 39.7)):
+            self.assertAlmostEqual(to_process[key], value)
+        self.assertEqual(result['to_complete'][conf.PAYMENT_TYPE_CARD]['p50'],
+                         40.0)
+        self.assertNotIn(conf.PAYMENT_TYPE_YANDEX_MONEY,
+                         result['to_complete'])
+
+    def test_cache(self):
+        analytics.report(self.since, self.until)
+        Payment.objects.all().delete()
+        with self.assertNumQueries(0):
+            result = analytics.report(self.since, self.until)
+        self.assertEqual(result['funnel'][analytics.TOTAL]['created'], 5)
+
+        result = analytics.report(self.since, self.until, use_cache=False)
+        self.assertEqual(result['funnel'][analytics.TOTAL]['created'], 0)
+
+    def test_percentile(self):
+        values = sorted(array('d', [4, 1, 3, 2]))
+        self.assertEqual(analytics.percentile(values, 0), 1)
+        self.assertEqual(analytics.percentile(values, 50), 2.5)
+        self.assertEqual(analytics.percentile(values, 100), 4)
+        self.assertIsNone(analytics.percentile([], 50))
+        self.assertEqual(analytics.summarize(array('d'), (50,)),
+                         {'count': 0, 'p50': None})
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command('payment_analytics', '--since=2017-03-01',
+                     '--until=2017-03-31', '--json', stdout=stdout)
+        result = json.loads(stdout.getvalue())
+        self.assertEqual(result['funnel']['total']['success'], 2)
+        self.assertEqual(result['since'], '2017-03-01T00:00:00')
+
+        stdout = StringIO()
+        call_command('payment_analytics', '--since=2017-03-01',
+                     '--until=2017-03-31', stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertIn('Funnel', lines[2])
+        self.assertEqual(lines[3].split(), ['total', '5', '4', '2', '1'])
+
+
+class FeeReportTestCase(TestCase):
+    def setUp(self):
+        self.since, self.until = analytics.get_period(days=1)
+        rows = [(conf.PAYMENT_TYPE_CARD, '1000.00', '965.00')] * 5 + [
+            (conf.PAYMENT_TYPE_CARD, '1000.00', '900.00'),
+            (conf.PAYMENT_TYPE_YANDEX_MONEY, '500.00', '500.10'),
+            (conf.PAYMENT_TYPE_YANDEX_MONEY, '500.00', None),
+        ]
+        for i, (payment_type, order_sum, shop_sum) in enumerate(rows):
+            Payment.objects.create(
+                order_id='order-{}'.format(i), payment_type=payment_type,
+                order_sum=Decimal(order_sum), state=Payment.STATE_SUCCESS,
+                shop_sum=shop_sum and Decimal(shop_sum))
+
+    @skipIf(analytics.numpy is None, 'NumPy is not installed')
+    def test_report(self):
+        result = analytics.fee_report(self.since, self.until, chunk_size=3)
+        card = result['by_payment_type'][conf.PAYMENT_TYPE_CARD]
+        self.assertEqual(card['count'], 6)
+        self.assertAlmostEqual(card['fee_total'], 275)
+        self.assertAlmostEqual(card['rate'], 275 / 6000.0)
+        self.assertAlmostEqual(card['median_rate'], 0.035)
+        self.assertEqual(card['outliers'], 1)
+        self.assertEqual(result['by_payment_type']['total']['count'], 7)
+
+        self.assertEqual([order_id for order_id, rate in result['outliers']],
+                         ['order-5'])
+        self.assertEqual(result['mismatch_count'], 1)
+        self.assertEqual(result['mismatches'], ['order-6'])
+
+    @skipIf(analytics.numpy is None, 'NumPy is not installed')
+    def test_paid_only(self):
+        """checkOrder fills shop_sum, but only paid payments have a fee"""
+        for i, state in enumerate((Payment.STATE_PROCESSED,
+                                   Payment.STATE_FAIL)):
+            Payment.objects.create(
+                order_id='unpaid-{}'.format(i), state=state,
+                payment_type=conf.PAYMENT_TYPE_CARD,
+                order_sum=Decimal('1000.00'), shop_sum=Decimal('500.00'))
+        Payment.objects.create(
+            order_id='refunded', state=Payment.STATE_REFUNDED,
+            payment_type=conf.PAYMENT_TYPE_CARD,
+            order_sum=Decimal('1000.00'), shop_sum=Decimal('965.00'),
+            shop_currency=None)
+
+        result = analytics.fee_report(self.since, self.until)
+        card = result['by_payment_type'][conf.PAYMENT_TYPE_CARD]
+        self.assertEqual(card['count'], 7)
+        self.assertAlmostEqual(card['fee_total'], 310)
+        self.assertEqual([order_id for order_id, rate in result['outliers']],
+                         ['order-5'])
+        # Unknown currency is not a mismatch
+        self.assertEqual(result['mismatches'], ['order-6'])
+
+    @skipIf(analytics.numpy is None, 'NumPy is not installed')
+    def test_command(self):
+        stdout = StringIO()
+        call_command('payment_fees', '--days=1', stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn('3.500%', output)
+        self.assertIn('  order-5  10.000%', output)
+
+    @mock.patch('yandex_cash_register.analytics.numpy', None)
+    def test_no_numpy(self):
+        with self.assertRaises(CommandError):
+            call_command('payment_fees', stdout=StringIO())
@@ -0,0 +1,160 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from contextlib import contextmanager
+from decimal import Decimal
+from importlib import import_module
+
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ..checks import check_compact_storage
+from ..models import Payment
+
+
+APP_LABEL = 'yandex_cash_register'
+
+
+def get_field(name):
+    return Payment._meta.get_field(name)
+
+
+@mock.patch('yandex_cash_register.fields.conf.COMPACT_STORAGE', True)
+class CompactStorageTestCase(TestCase):
+    def test_choice_internal_type(self):
+        self.assertEqual(get_field('state').get_internal_type(),
+                         'PositiveSmallIntegerField')
+
+    def test_choice_to_db(self):
+        field = get_field('state')
+        self.assertEqual(field.get_prep_value(Payment.STATE_CREATED), 0)
+        self.assertEqual(field.get_prep_value(Payment.STATE_FAIL), 3)
+        self.assertEqual(get_field('payment_type').get_prep_value(''), 0)
+        with self.assertRaises(ValueError):
+            field.get_prep_value('unknown')
+
+    def test_choice_from_db(self):
+        field = get_field('payment_type')
+        self.assertEqual(field.from_db_value(7, None, connection, {}), 'PC')
+        self.assertIsNone(field.from_db_value(None, None, connection, {}))
+
+    def test_sum_to_db(self):
+        field = get_field('order_sum')
+        self.assertEqual(field.get_internal_type(), 'BigIntegerField')
+        self.assertEqual(
+            field.get_db_prep_save(Decimal('975.30'), connection), 97530)
+        self.assertEqual(field.get_db_prep_save('0.29', connection), 29)
+        self.assertEqual(field.get_db_prep_save(1000, connection), 100000)
+        self.assertIsNone(
+            get_field('shop_sum').get_db_prep_save(None, connection))
+
+    def test_sum_from_db(self):
+        field = get_field('order_sum')
+        value = field.from_db_value(97530, None, connection, {})
+        self.assertEqual(value, Decimal('975.30'))
+        self.assertEqual(str(value), '975.30')
+
+
+class DefaultStorageTestCase(TestCase):
+    def test_internal_type(self):
+        self.assertEqual(get_field('state').get_internal_type(), 'CharField')
+        self.assertEqual(get_field('order_sum').get_internal_type(),
+                         'DecimalField')
+
+    def test_round_trip(self):
+        payment = Payment.objects.create(order_id='abcdef',
+                                         order_sum=Decimal('975.30'),
+                                         payment_type='PC')
+        payment = Payment.objects.get(pk=payment.pk)
+        self.assertEqual(payment.state, Payment.STATE_CREATED)
+        self.assertEqual(payment.payment_type, 'PC')
+        self.assertEqual(payment.order_sum, Decimal('975.30'))
+
+
+def migrate(target):
+    executor = MigrationExecutor(connection)
+    if target is None:
+        targets = executor.loader.graph.leaf_nodes(APP_LABEL)
+    else:
+        targets = [(APP_LABEL, target)]
+    executor.migrate(targets)
+
+
+@contextmanager
+def compact_schema():
+    """Migrate the test database back and apply ``0005_compact_storage``
+    again as with compact storage on. Restores the usual schema on exit
+    """
+    migration = import_module(
+        'yandex_cash_register.migrations.0005_compact_storage')
+    with mock.patch.object(migration.Migration, 'operations',
+                           migration.compact_operations()):
+        migrate('0004_auto_20170206_2146')
+        with mock.patch('yandex_cash_register.conf.COMPACT_STORAGE', True):
+            migrate(None)
+        try:
+            yield
+        finally:
+            migrate('0004_auto_20170206_2146')
+    migrate(None)
+
+
+class CompactSchemaTestCase(TransactionTestCase):
+    def test_backfill_and_round_trip(self):
+        old = Payment.objects.create(order_id='old', state=Payment.STATE_FAIL,
+                                     order_sum=Decimal('975.30'),
+                                     shop_sum=Decimal('0.29'),
+                                     payment_type='PC')
+        with compact_schema(), \
+                mock.patch('yandex_cash_register.conf.COMPACT_STORAGE',
+                           True):
+            old = Payment.objects.get(pk=old.pk)
+            self.assertEqual(old.state, Payment.STATE_FAIL)
+            self.assertEqual(old.payment_type, 'PC')
+            self.assertEqual(old.order_sum, Decimal('975.30'))
+            self.assertEqual(old.shop_sum, Decimal('0.29'))
+
+            new = Payment.objects.create(order_id='new',
+                                         order_sum=Decimal('10.05'))
+            new.process()
+            new = Payment.objects.get(pk=new.pk)
+            self.assertEqual(new.state, Payment.STATE_PROCESSED)
+            self.assertEqual(new.payment_type, '')
+            self.assertEqual(new.order_sum, Decimal('10.05'))
+            self.assertEqual(list(Payment.objects.filter(
+                state=Payment.STATE_PROCESSED, order_sum__gt=10).values_list(
+                'order_id', flat=True)), ['new'])
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT state, order_sum FROM {} WHERE '
+                               'order_id = %s'.format(Payment._meta.db_table),
+                               ['new'])
+                self.assertEqual(cursor.fetchone(), (1, 1005))
+
+            self.assertEqual(check_compact_storage(), [])
+            with mock.patch('yandex_cash_register.conf.COMPACT_STORAGE',
+                            False):
+                errors = check_compact_storage()
+            self.assertEqual([error.id for error in errors],
+                             ['yandex_cash_register.E001'])
+
+
+class StorageCheckTestCase(TestCase):
+    def test_check(self):
+        self.assertEqual(check_compact_storage(), [])
+        with mock.patch('yandex_cash_register.conf.COMPACT_STORAGE', True):
+            errors = check_compact_storage()
+        self.assertEqual([error.id for error in errors],
+                         ['yandex_cash_register.E001'])
+        self.assertIn('"default"', errors[0].msg)
+
+    def test_not_migrated(self):
+        with mock.patch('yandex_cash_register.conf.COMPACT_STORAGE', True), \
+                mock.patch('yandex_cash_register.checks.MigrationRecorder.'
+                           'applied_migrations', return_value=set()):
+            self.assertEqual(check_compact_storage(), [])
@@ -188,6 +188,9 @@ class OrderProcessingFormTestCase(TestCase):
         self.assertEqual(form._round(Decimal(333.33)), 330)
         self.assertEqual(form._round(Decimal(299.99)), 300)
         self.assertEqual(form._round(Decimal(15.99)), 20)
+        self.assertEqual(form._round(Decimal('994.99')), 990)
+        self.assertEqual(form._round(Decimal('995.00')), 1000)
+        self.assertEqual(form._round('25'), 20)
 
     def test_error_messages(self):
         form = self._get_form()
@@ -215,6 +218,19 @@ class OrderProcessingFormTestCase(TestCase):
         self.assertFalse(form.is_valid())
         self.assertEqual(list(form.errors.keys()), ['__all__'])
 
+    def test_invalid_signature_skips_database(self):
+        for kwargs in ({'md5': 'A' * 32},
+                       {'md5': 'A' * 32, 'orderNumber': 'asd'},
+                       {'shopId': TEST_SHOP_ID + 1}):
+            form = self._get_form(**kwargs)
+            with self.assertNumQueries(0):
+                self.assertFalse(form.is_valid())
+                self.assertIsNone(form.payment_obj)
+
+        form = self._get_form(md5='A' * 32, orderNumber='asd')
+        form.is_valid()
+        self.assertEqual(form.error_code, PaymentProcessingForm.ERROR_CODE_MD5)
+
     def test_error_values(self):
         form = self._get_form(md5='DE51FC39AAFB023A4AA8984083BCAE03')
         self.assertFalse(form.is_valid())
@@ -0,0 +1,128 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+from decimal import Decimal
+from unittest import skipIf
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+from django.utils.timezone import now
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ..holds import cancel, capture, process_holds, request_capture
+from ..kassa import KassaClient
+from ..models import Payment
+from ..signals import payment_authorize
+from .. import conf, kassa
+from .kassa_server import FakeKassa, SECRET_KEY, SHOP_ID
+from .test_views import fail_mock, success_mock
+
+
+class AuthorizeTestCase(TestCase):
+    def test_authorize(self):
+        payment = Payment.objects.create(order_id='abcdef',
+                                         order_sum=Decimal(100))
+        with self.assertRaises(RuntimeError):
+            payment.authorize()
+        payment.process()
+
+        authorize_mock = mock.Mock()
+        payment_authorize.connect(authorize_mock)
+        self.addCleanup(payment_authorize.disconnect, authorize_mock)
+        success_mock.reset_mock()
+        payment.authorize()
+        self.assertEqual(authorize_mock.call_count, 1)
+        self.assertEqual(payment.state, Payment.STATE_AUTHORIZED)
+        self.assertFalse(payment.is_completed)
+        self.assertAlmostEqual(
+            (payment.hold_expires - now()).total_seconds(), conf.HOLD_TTL,
+            delta=60)
+
+        payment.complete()
+        self.assertEqual(success_mock.call_count, 1)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).state,
+                         Payment.STATE_SUCCESS)
+
+
+@skipIf(kassa.requests is None, 'requests is not installed')
+class HoldsTestCase(TestCase):
+    def setUp(self):
+        self.kassa = FakeKassa().start()
+        self.addCleanup(self.kassa.stop)
+        self.client = KassaClient(self.kassa.url, SHOP_ID, SECRET_KEY)
+        self.addCleanup(self.client.close)
+        success_mock.reset_mock()
+        fail_mock.reset_mock()
+
+    def _hold(self, order_id, expires_in=3, status='waiting_for_capture'):
+        remote = self.kassa.add_payment(status)
+        return Payment.objects.create(
+            order_id=order_id, order_sum=Decimal(100),
+            state=Payment.STATE_AUTHORIZED, performed=now(),
+            external_id=remote['id'],
+            hold_expires=now() + datetime.timedelta(days=expires_in))
+
+    def test_process_holds(self):
+        shipped = ['shipped-{}'.format(i) for i in range(8)]
+        for order_id in shipped:
+            self._hold(order_id)
+        for i in range(3):
+            self._hold('expiring-{}'.format(i), expires_in=-1)
+        self._hold('waiting')
+        # Expired in Kassa already
+        self._hold('expired', status='canceled')
+
+        self.assertEqual(request_capture(shipped + ['expired', 'unknown'],
+                                         batch_size=3), 9)
+        self.assertEqual(request_capture(shipped), 0)
+
+        counts = process_holds(workers=3, rate=1000, client=self.client,
+                               batch_size=3)
+        self.assertEqual(counts, {'captured': 8, 'cancelled': 4,
+                                  'skipped': 0, 'errors': 0})
+        self.assertEqual(set(Payment.objects.filter(
+            order_id__in=shipped).values_list('state', flat=True)),
+            {Payment.STATE_SUCCESS})
+        self.assertEqual(Payment.objects.filter(
+            order_id__startswith='expiring',
+            state=Payment.STATE_FAIL).count(), 3)
+        self.assertEqual(Payment.objects.get(order_id='expired').state,
+                         Payment.STATE_FAIL)
+        self.assertEqual(Payment.objects.get(order_id='waiting').state,
+                         Payment.STATE_AUTHORIZED)
+        self.assertEqual(success_mock.call_count, 8)
+        self.assertEqual(fail_mock.call_count, 4)
+
+        # Nothing left to do
+        self.assertEqual(sum(process_holds(client=self.client).values()), 0)
+
+    def test_capture_and_cancel(self):
+        first = self._hold('first')
+        second = self._hold('second')
+        self.assertEqual(capture(first, Decimal(60), client=self.client),
+                         Payment.STATE_SUCCESS)
+        self.assertEqual(
+            self.kassa.payments[first.external_id]['amount']['value'],
+            '60.00')
+        # Repeated call changes nothing
+        self.assertIsNone(capture(first, client=self.client))
+
+        self.assertEqual(cancel(second, client=self.client),
+                         Payment.STATE_FAIL)
+        self.assertEqual(
+            self.kassa.payments[second.external_id]['status'], 'canceled')
+
+    def test_command(self):
+        self._hold('a')
+        out = StringIO()
+        with mock.patch('yandex_cash_register.holds.kassa.get_client',
+                        return_value=self.client):
+            call_command('process_holds', 'a', '--rate=100', stdout=out)
+        self.assertIn('Payments to capture: 1', out.getvalue())
+        self.assertIn('captured: 1', out.getvalue())
@@ -0,0 +1,55 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+import time
+import uuid
+
+from django.test import TestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ..ids import make_order_id, uuid7
+from ..models import Payment
+
+
+class IdsTestCase(TestCase):
+    def test_uuid7(self):
+        value = uuid7()
+        self.assertEqual(value.version, 7)
+        self.assertEqual(value.variant, uuid.RFC_4122)
+        self.assertAlmostEqual(value.int >> 80, time.time() * 1000,
+                               delta=1000)
+
+    def test_uuid7_monotonic(self):
+        values = [uuid7() for i in range(10000)]
+        self.assertEqual(values, sorted(values))
+        self.assertEqual(len(set(values)), len(values))
+
+    @mock.patch('yandex_cash_register.ids.time.time',
+                mock.Mock(return_value=1500000000.0))
+    def test_uuid7_counter_overflow(self):
+        values = [uuid7() for i in range(5000)]
+        self.assertEqual(values, sorted(values))
+        self.assertGreater(values[-1].int >> 80, 1500000000000)
+
+    def test_order_id(self):
+        values = [make_order_id('shop-') for i in range(1000)]
+        self.assertEqual(values, sorted(values))
+        self.assertTrue(all(v.startswith('shop-') for v in values))
+        self.assertEqual(len(values[0]), 31)
+
+    @mock.patch('yandex_cash_register.ids.conf.CUSTOMER_ID_FACTORY',
+                'yandex_cash_register.ids.uuid7')
+    def test_customer_id_factory(self):
+        payment = Payment.objects.create(order_id=make_order_id(),
+                                         order_sum=Decimal('100.00'))
+        self.assertEqual(payment.customer_id.version, 7)
+
+    def test_default_customer_id(self):
+        payment = Payment.objects.create(order_id=make_order_id(),
+                                         order_sum=Decimal('100.00'))
+        self.assertEqual(payment.customer_id.version, 4)
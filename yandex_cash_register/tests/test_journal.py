@@ -0,0 +1,157 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+from decimal import Decimal
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, RequestFactory
+from django.utils.http import urlencode
+from django.utils.six import StringIO
+from django.utils.timezone import now
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ..forms import PaymentProcessingForm, make_md5
+from ..journal import JournalWriter
+from ..models import NotificationJournal, Payment
+from ..views import CheckOrderView
+from .. import conf, metrics
+
+
+def make_entry(**kwargs):
+    entry = {'created': now(), 'action': 'checkOrder', 'order_id': 'abcdef',
+             'code': 0, 'duration': 0.01, 'payload': {'body': 'a=1'}}
+    entry.update(kwargs)
+    return entry
+
+
+@mock.patch('yandex_cash_register.journal.conf.JOURNAL', True)
+class RecordNotificationTestCase(TestCase):
+    def setUp(self):
+        self.writer = JournalWriter(background=False)
+        patcher = mock.patch('yandex_cash_register.journal._writer',
+                             self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.payment = Payment.objects.create(
+            order_id='abcdef', order_sum=Decimal('1000.00'),
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY)
+
+    def _post(self, **kwargs):
+        data = {
+            'shopId': conf.SHOP_ID, 'orderNumber': self.payment.order_id,
+            'customerNumber': self.payment.customer_id,
+            'action': 'checkOrder', 'invoiceId': '123456',
+            'paymentType': conf.PAYMENT_TYPE_YANDEX_MONEY,
+            'orderSumAmount': '1000.00', 'orderSumCurrencyPaycash': '643',
+            'orderSumBankPaycash': '643', 'shopSumAmount': '975.30',
+            'shopSumCurrencyPaycash': '643',
+        }
+        data['md5'] = make_md5(data, PaymentProcessingForm.MD5_KEY_ORDER)
+        data.update(kwargs)
+        request = RequestFactory().post(
+            '/', urlencode(data),
+            content_type='application/x-www-form-urlencoded',
+            HTTP_USER_AGENT='Kassa')
+        return request, CheckOrderView.as_view()(request)
+
+    def test_record(self):
+        request, response = self._post()
+        # Nothing is written until the writer flushes
+        self.assertEqual(NotificationJournal.objects.count(), 0)
+        self.assertEqual(self.writer.flush(), 1)
+
+        entry = NotificationJournal.objects.get()
+        self.assertEqual(entry.action, 'checkOrder')
+        self.assertEqual(entry.order_id, 'abcdef')
+        self.assertEqual(entry.code, 0)
+        self.assertGreater(entry.duration, 0)
+
+        payload = entry.get_payload()
+        self.assertEqual(payload['body'].encode('latin-1'), request.body)
+        self.assertEqual(payload['headers']['HTTP_USER_AGENT'], 'Kassa')
+        self.assertEqual(payload['status'], 200)
+        self.assertEqual(payload['response'],
+                         response.content.decode('utf-8'))
+
+    def test_error_code(self):
+        self._post(md5='A' * 32)
+        self.writer.flush()
+        self.assertEqual(NotificationJournal.objects.get().code,
+                         PaymentProcessingForm.ERROR_CODE_MD5)
+
+    def test_disabled(self):
+        with mock.patch('yandex_cash_register.journal.conf.JOURNAL', False):
+            self._post()
+        self.assertEqual(self.writer.flush(), 0)
+
+
+class JournalWriterTestCase(TestCase):
+    def test_batches(self):
+        writer = JournalWriter(batch_size=2, background=False)
+        for i in range(5):
+            writer.record(make_entry(order_id='order-{}'.format(i)))
+        with self.assertNumQueries(3):
+            self.assertEqual(writer.flush(), 5)
+        self.assertEqual(NotificationJournal.objects.count(), 5)
+
+    def test_queue_full(self):
+        writer = JournalWriter(queue_size=1, background=False)
+        dropped = metrics.registry.count(metrics.JOURNAL_DROPPED)
+        writer.record(make_entry())
+        writer.record(make_entry())
+        self.assertEqual(metrics.registry.count(metrics.JOURNAL_DROPPED),
+                         dropped + 1)
+        self.assertEqual(writer.flush(), 1)
+
+
+class BackgroundWriterTestCase(TransactionTestCase):
+    def test_background(self):
+        writer = JournalWriter(flush_interval=0.01)
+        for i in range(3):
+            writer.record(make_entry(order_id='order-{}'.format(i)))
+
+        deadline = time.time() + 5
+        while NotificationJournal.objects.count() < 3 and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(NotificationJournal.objects.count(), 3)
+
+
+class PruneCommandTestCase(TestCase):
+    def setUp(self):
+        old = now() - datetime.timedelta(days=conf.JOURNAL_RETENTION_DAYS + 1)
+        writer = JournalWriter(background=False)
+        for i in range(3):
+            writer.record(make_entry(created=old, order_id='old-{}'.format(i)))
+        writer.record(make_entry(order_id='new'))
+        writer.flush()
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_prune(self):
+        path = os.path.join(self.directory, 'journal.jsonl.gz')
+        call_command('prune_notification_journal', '--archive', path,
+                     '--batch-size', '2', stdout=StringIO())
+
+        self.assertEqual(
+            list(NotificationJournal.objects.values_list('order_id',
+                                                         flat=True)),
+            ['new'])
+        with gzip.open(path, 'rb') as archive:
+            lines = [json.loads(line.decode('utf-8')) for line in archive]
+        self.assertEqual(sorted(line['order_id'] for line in lines),
+                         ['old-0', 'old-1', 'old-2'])
+        self.assertEqual(lines[0]['body'], 'a=1')
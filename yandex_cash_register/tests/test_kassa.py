@@ -0,0 +1,129 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+from unittest import skipIf
+from uuid import UUID
+
+from django.test import SimpleTestCase
+
+from ..kassa import AsyncKassaClient, KassaClient, KassaError, \
+    format_amount
+from ..models import Payment
+from .. import kassa
+from .kassa_server import FakeKassa, SECRET_KEY, SHOP_ID
+
+
+class FormatAmountTestCase(SimpleTestCase):
+    def test_format(self):
+        self.assertEqual(format_amount(Decimal('10.5'), 643),
+                         {'value': '10.50', 'currency': 'RUB'})
+        self.assertEqual(format_amount(1, 'USD'),
+                         {'value': '1.00', 'currency': 'USD'})
+
+
+@skipIf(kassa.requests is None, 'requests is not installed')
+class KassaClientTestCase(SimpleTestCase):
+    def setUp(self):
+        self.kassa = FakeKassa().start()
+        self.addCleanup(self.kassa.stop)
+        self.client = KassaClient(self.kassa.url, SHOP_ID, SECRET_KEY,
+                                  retries=2)
+        self.client.session.get_adapter(self.kassa.url).max_retries \
+            .backoff_factor = 0
+        self.addCleanup(self.client.close)
+
+    def test_create_and_get(self):
+        payment = self.client.create_payment(
+            Decimal('100.5'), return_url='https://shop.test/done',
+            metadata={'orderNumber': 'abc'})
+        self.assertEqual(payment['status'], 'pending')
+        self.assertEqual(payment['amount']['value'], '100.50')
+        self.assertIn('confirmation_url', payment['confirmation'])
+        self.assertEqual(self.client.get_payment(payment['id']), payment)
+
+    def test_create_payment_for(self):
+        payment = Payment(order_id='abcdef', order_sum=Decimal('15'),
+                          customer_id=UUID(int=1))
+        first = self.client.create_payment_for(payment)
+        self.assertEqual(first['metadata'],
+                         {'orderNumber': 'abcdef',
+                          'customerNumber': '{}'.format(UUID(int=1))})
+        # Same order ID is the same Kassa payment
+        self.assertEqual(self.client.create_payment_for(payment)['id'],
+                         first['id'])
+
+    def test_capture_and_cancel(self):
+        held = self.kassa.add_payment('waiting_for_capture')
+        self.assertEqual(self.client.capture_payment(held['id'])['status'],
+                         'succeeded')
+        held = self.kassa.add_payment('waiting_for_capture')
+        self.assertEqual(self.client.cancel_payment(held['id'])['status'],
+                         'canceled')
+
+    def test_error(self):
+        with self.assertRaises(KassaError) as context:
+            self.client.get_payment('unknown')
+        self.assertEqual(context.exception.status, 404)
+        self.assertEqual(context.exception.code, 'not_found')
+
+        pending = self.kassa.add_payment()
+        with self.assertRaises(KassaError) as context:
+            self.client.capture_payment(pending['id'])
+        self.assertEqual(context.exception.code, 'invalid_request')
+
+    def test_bad_credentials(self):
+        client = KassaClient(self.kassa.url, SHOP_ID, 'wrong')
+        with self.assertRaises(KassaError) as context:
+            client.get_payment('unknown')
+        self.assertEqual(context.exception.status, 401)
+
+    def test_retries(self):
+        """Server errors are retried with the same idempotence key"""
+        self.kassa.fail_next(2)
+        payment = self.client.create_payment(Decimal('1'))
+        self.assertEqual(len(self.kassa.payments), 1)
+        keys = set(headers['Idempotence-Key']
+                   for _, _, headers, _ in self.kassa.requests)
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(self.client.get_payment(payment['id'])['id'],
+                         payment['id'])
+
+        self.kassa.fail_next(3)
+        with self.assertRaises(KassaError) as context:
+            self.client.get_payment(payment['id'])
+        self.assertEqual(context.exception.status, 503)
+
+    def test_unreachable(self):
+        with FakeKassa() as stopped:
+            url = stopped.url
+        with self.assertRaises(KassaError) as context:
+            KassaClient(url, SHOP_ID, SECRET_KEY, retries=0).get_payment('a')
+        self.assertIsNone(context.exception.status)
+
+    def test_connection_reuse(self):
+        for i in range(10):
+            self.client.create_payment(Decimal(i + 1))
+        self.assertEqual(len(self.kassa.ports), 1)
+
+
+@skipIf(kassa.requests is None or kassa.asyncio is None,
+        'requests or asyncio is not available')
+class AsyncKassaClientTestCase(SimpleTestCase):
+    def test_concurrent_calls(self):
+        asyncio = kassa.asyncio
+        with FakeKassa() as fake:
+            loop = asyncio.new_event_loop()
+            self.addCleanup(loop.close)
+            client = AsyncKassaClient(
+                KassaClient(fake.url, SHOP_ID, SECRET_KEY, pool_size=4),
+                loop=loop, max_workers=4)
+            self.addCleanup(client.close)
+
+            futures = [client.create_payment(Decimal(i + 1))
+                       for i in range(20)]
+            results = loop.run_until_complete(asyncio.gather(*futures))
+            self.assertEqual(len(set(r['id'] for r in results)), 20)
+            self.assertLessEqual(len(fake.ports), 4)
+            with self.assertRaises(AttributeError):
+                client.missing
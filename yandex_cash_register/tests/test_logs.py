@@ -0,0 +1,182 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+import json
+import logging
+import threading
+from uuid import UUID
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.test import SimpleTestCase, TestCase
+
+from ..logs import JsonFormatter, QueueHandler, SuccessSampler, \
+    setup_queue_logging, teardown_queue_logging, OUTCOME_ERROR, \
+    OUTCOME_SUCCESS
+from ..models import Payment
+from ..views import CheckOrderView
+from .. import conf, metrics
+from .test_views import BaseViewTestCase, notification_conf
+
+
+class CollectingHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.records = []
+        self.threads = []
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.append(threading.current_thread())
+
+
+def make_record(level=logging.INFO, **extra):
+    record = logging.LogRecord('yandex_cash_register.views', level, __file__,
+                               1, 'Payment #%s', ('abcdef',), None)
+    record.__dict__.update(extra)
+    return record
+
+
+class QueueLoggingTestCase(SimpleTestCase):
+    name = 'yandex_cash_register.tests.queued'
+
+    def setUp(self):
+        self.handler = CollectingHandler()
+        self.warnings = CollectingHandler(logging.WARNING)
+        self.logger = logging.getLogger(self.name)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.handlers = [self.handler, self.warnings]
+        self.addCleanup(teardown_queue_logging)
+
+    def test_records_handled_by_listener(self):
+        """Original handlers get records from another thread, with their
+        levels respected
+        """
+        setup_queue_logging(self.name)
+        self.assertIsInstance(self.logger.handlers[0], QueueHandler)
+        self.logger.info('Form data: %s', {'a': 1})
+        self.logger.warning('Failed')
+        teardown_queue_logging()
+
+        self.assertEqual(self.logger.handlers, [self.handler, self.warnings])
+        self.assertEqual([r.getMessage() for r in self.handler.records],
+                         ["Form data: {'a': 1}", 'Failed'])
+        self.assertNotIn(threading.current_thread(), self.handler.threads)
+        self.assertEqual([r.getMessage() for r in self.warnings.records],
+                         ['Failed'])
+
+    def test_fork(self):
+        """A forked process handles its records with a thread of its own"""
+        listener = setup_queue_logging(self.name)
+        inherited = listener.queue
+        with mock.patch('yandex_cash_register.logs.os.getpid',
+                        return_value=-1):
+            self.logger.info('In the worker')
+            self.assertIsNot(listener.queue, inherited)
+            teardown_queue_logging()
+        self.assertEqual([r.getMessage() for r in self.handler.records],
+                         ['In the worker'])
+        self.assertTrue(inherited.empty())
+        # Stop the thread of the "parent"
+        inherited.put(None)
+
+    def test_setup_is_idempotent(self):
+        self.assertIs(setup_queue_logging(self.name),
+                      setup_queue_logging(self.name))
+
+    def test_full_queue(self):
+        """Records are dropped rather than blocking the caller"""
+        handler = QueueHandler(queue.Queue(1))
+        before = metrics.registry.count(metrics.LOGS_DROPPED)
+        handler.handle(make_record())
+        handler.handle(make_record())
+        self.assertEqual(metrics.registry.count(metrics.LOGS_DROPPED),
+                         before + 1)
+
+
+class SuccessSamplerTestCase(SimpleTestCase):
+    def test_rate(self):
+        records = [make_record(order_id='order-{}'.format(i),
+                               outcome=OUTCOME_SUCCESS) for i in range(1000)]
+        self.assertFalse(any(map(SuccessSampler(0).filter, records)))
+        self.assertTrue(all(map(SuccessSampler(1).filter, records)))
+        kept = sum(map(SuccessSampler(0.25).filter, records))
+        self.assertTrue(150 < kept < 350, kept)
+
+    def test_sampled_by_order(self):
+        sampler = SuccessSampler(0.5)
+        for i in range(50):
+            order_id = 'order-{}'.format(i)
+            self.assertEqual(
+                sampler.filter(make_record(order_id=order_id,
+                                           outcome=OUTCOME_SUCCESS)),
+                sampler.filter(make_record(logging.DEBUG, order_id=order_id,
+                                           outcome=OUTCOME_SUCCESS)))
+
+    def test_errors_kept(self):
+        sampler = SuccessSampler(0)
+        self.assertTrue(sampler.filter(make_record(outcome=OUTCOME_ERROR)))
+        self.assertTrue(sampler.filter(make_record()))
+        self.assertTrue(sampler.filter(make_record(logging.WARNING,
+                                                   outcome=OUTCOME_SUCCESS)))
+
+
+class JsonFormatterTestCase(SimpleTestCase):
+    def test_format(self):
+        data = json.loads(JsonFormatter().format(make_record(
+            order_id='abcdef', outcome=OUTCOME_SUCCESS,
+            amount=Decimal('10.5'))))
+        self.assertEqual(data['message'], 'Payment #abcdef')
+        self.assertEqual(data['level'], 'INFO')
+        self.assertEqual(data['order_id'], 'abcdef')
+        self.assertEqual(data['outcome'], OUTCOME_SUCCESS)
+        self.assertEqual(data['amount'], '10.5')
+        self.assertNotIn('args', data)
+
+
+@notification_conf()
+class ViewLoggingTestCase(BaseViewTestCase, TestCase):
+    VIEW_CLASS = CheckOrderView
+    ACTION = CheckOrderView.accepted_action
+    INVOICE_ID = '123456'
+    MD5 = '54B30079ACF352701B9CA83A3AC7F640'
+
+    def _get_url(self):
+        return '/{}/order-check/'.format(conf.LOCAL_URL)
+
+    def setUp(self):
+        self.payment = Payment.objects.create(
+            order_sum=Decimal(1000.0), order_id='abcdef',
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY,
+            customer_id=UUID('0c3c745b-8c7b-4813-8b28-c0a2b037f19c')
+        )
+        self.handler = CollectingHandler()
+        logger = logging.getLogger('yandex_cash_register.views')
+        logger.addHandler(self.handler)
+        self.addCleanup(logger.removeHandler, self.handler)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.INFO)
+
+    def test_success(self):
+        self._req(self._get_data())
+        self.assertTrue(self.handler.records)
+        for record in self.handler.records:
+            self.assertEqual(record.order_id, 'abcdef')
+            self.assertEqual(record.view, 'CheckOrderView')
+            self.assertEqual(record.outcome, OUTCOME_SUCCESS)
+
+    def test_error(self):
+        self._req(self._get_data(md5='0' * 32))
+        self.assertTrue(self.handler.records)
+        for record in self.handler.records:
+            self.assertEqual(record.outcome, OUTCOME_ERROR)
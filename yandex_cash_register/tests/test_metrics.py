@@ -0,0 +1,169 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.test import TestCase, RequestFactory
+
+from ..forms import get_locked_payment
+from ..metrics import Registry, registry, LOCK_WAIT, REQUEST_DURATION, \
+    RESPONSES, TRANSITIONS
+from ..models import Payment
+from ..views import MetricsView
+from .. import conf
+
+
+class RegistryTestCase(TestCase):
+    def setUp(self):
+        self.registry = Registry(buckets=(0.1, 1.0))
+
+    def test_counters(self):
+        self.registry.inc(RESPONSES, view='CheckOrderView', code=0)
+        self.registry.inc(RESPONSES, view='CheckOrderView', code=0)
+        self.registry.inc(RESPONSES, view='CheckOrderView', code=1)
+
+        self.assertEqual(
+            self.registry.count(RESPONSES, view='CheckOrderView', code=0), 2)
+        self.assertEqual(
+            self.registry.count(RESPONSES, view='CheckOrderView', code=1), 1)
+        self.assertEqual(
+            self.registry.count(RESPONSES, view='CheckOrderView', code=100), 0)
+
+    def test_render(self):
+        self.registry.inc(RESPONSES, view='CheckOrderView', code=100)
+        self.registry.observe(REQUEST_DURATION, 0.05, view='CheckOrderView')
+        self.registry.observe(REQUEST_DURATION, 0.5, view='CheckOrderView')
+        self.registry.observe(REQUEST_DURATION, 5, view='CheckOrderView')
+
+        lines = self.registry.render().splitlines()
+        self.assertIn('# TYPE {} counter'.format(RESPONSES), lines)
+        self.assertIn('{}{{code="100",view="CheckOrderView"}} 1'
+                      .format(RESPONSES), lines)
+        self.assertIn('# TYPE {} histogram'.format(REQUEST_DURATION), lines)
+        self.assertIn('{}_bucket{{view="CheckOrderView",le="0.1"}} 1'
+                      .format(REQUEST_DURATION), lines)
+        self.assertIn('{}_bucket{{view="CheckOrderView",le="1.0"}} 2'
+                      .format(REQUEST_DURATION), lines)
+        self.assertIn('{}_bucket{{view="CheckOrderView",le="+Inf"}} 3'
+                      .format(REQUEST_DURATION), lines)
+        self.assertIn('{}_count{{view="CheckOrderView"}} 3'
+                      .format(REQUEST_DURATION), lines)
+
+    def test_multiprocess_aggregation(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        self.registry = Registry(directory=directory, flush_interval=0,
+                                 buckets=(0.1, 1.0))
+        self.registry.inc(TRANSITIONS, state='success', payment_type='PC')
+        self.registry.observe(LOCK_WAIT, 0.01, source='ShopIdForm')
+        self.assertEqual(len(glob.glob(os.path.join(
+            directory, '{}-*.json'.format(os.getpid())))), 1)
+
+        # Pretend another worker has already dumped its values
+        other = Registry(buckets=(0.1, 1.0))
+        other.inc(TRANSITIONS, 2, state='success', payment_type='PC')
+        other.observe(LOCK_WAIT, 0.5, source='ShopIdForm')
+        with open(os.path.join(directory, 'other.json'), 'w') as fp:
+            json.dump(other.snapshot(), fp)
+
+        lines = self.registry.render().splitlines()
+        self.assertIn('{}{{payment_type="PC",state="success"}} 3'
+                      .format(TRANSITIONS), lines)
+        self.assertIn('{}_bucket{{source="ShopIdForm",le="0.1"}} 1'
+                      .format(LOCK_WAIT), lines)
+        self.assertIn('{}_count{{source="ShopIdForm"}} 2'
+                      .format(LOCK_WAIT), lines)
+
+
+    def test_stale_files(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.registry = Registry(directory=directory, flush_interval=0)
+        self.registry.inc(RESPONSES, view='view')
+
+        def dump(name, value, mtime=None):
+            other = Registry()
+            other.inc(RESPONSES, value, view='view')
+            path = os.path.join(directory, name)
+            with open(path, 'w') as fp:
+                json.dump(other.snapshot(), fp)
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+            return path
+
+        dead = subprocess.Popen([sys.executable, '-c', ''])
+        dead.wait()
+        live = os.getppid()
+        dead_path = dump('{}-dead.json'.format(dead.pid), 10)
+        # Previous process with the same PID as this one or another live one
+        own_path = dump('{}-old.json'.format(os.getpid()), 20)
+        old_path = dump('{}-old.json'.format(live), 40, time.time() - 60)
+        dump('{}-new.json'.format(live), 2)
+
+        self.assertIn('{}{{view="view"}} 3'.format(RESPONSES),
+                      self.registry.render().splitlines())
+        for path in (dead_path, own_path, old_path):
+            self.assertFalse(os.path.exists(path), path)
+
+    def test_fork(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.registry = Registry(directory=directory, flush_interval=0)
+        self.registry.inc(RESPONSES, view='view')
+        parent_path = self.registry._path()
+
+        with mock.patch('yandex_cash_register.metrics.os.getpid',
+                        return_value=os.getpid() + 100000):
+            # The child counts only what happens in it
+            self.assertEqual(self.registry.count(RESPONSES, view='view'), 0)
+            self.registry.inc(RESPONSES, view='view')
+            self.assertEqual(self.registry.count(RESPONSES, view='view'), 1)
+            self.assertNotEqual(self.registry._path(), parent_path)
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.payment = Payment.objects.create(
+            order_sum=Decimal(1000.0), order_id='abcdef',
+            cps_email='test@test.com', cps_phone='79991234567',
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY
+        )
+        registry.reset()
+
+    def test_transitions(self):
+        self.payment.process()
+        self.payment.complete()
+
+        self.assertEqual(registry.count(TRANSITIONS, state='processed',
+                                        payment_type='PC'), 1)
+        self.assertEqual(registry.count(TRANSITIONS, state='success',
+                                        payment_type='PC'), 1)
+
+    def test_lock_wait(self):
+        self.assertEqual(get_locked_payment('abcdef', 'test'), self.payment)
+        self.assertIsNone(get_locked_payment('unknown', 'test'))
+        self.assertEqual(registry.count(LOCK_WAIT, source='test'), 2)
+
+    def test_view(self):
+        self.payment.fail()
+
+        response = MetricsView.as_view()(RequestFactory().get('/metrics/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('{}{{payment_type="PC",state="fail"}} 1'
+                      .format(TRANSITIONS),
+                      response.content.decode('utf-8').splitlines())
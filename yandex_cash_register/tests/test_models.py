@@ -8,10 +8,11 @@ try:
 except ImportError:
     import mock
 
+from django.db import connection
 from django.test import TestCase
 
 from ..forms import PaymentForm
-from ..models import Payment
+from ..models import Payment, _supports_upsert
 from ..signals import payment_fail, payment_process, payment_success
 from .. import conf
 
@@ -143,3 +144,46 @@ class PaymentTestCase(TestCase):
         self.assertEqual(process_mock.call_count, 0)
         self.assertEqual(success_mock.call_count, 0)
         self.assertEqual(fail_mock.call_count, 1)
+
+    def test_refunded_not_failed(self):
+        self.test_states_success()
+        self.payment.refund()
+
+        with self.assertRaises(RuntimeError):
+            self.payment.fail()
+        self.assertEqual(self.payment.state, Payment.STATE_REFUNDED)
+        self.assertTrue(self.payment.is_completed)
+        self.assertEqual(fail_mock.call_count, 0)
+
+
+class GetOrCreateForOrderTestCase(TestCase):
+    def _check(self):
+        payment, created = Payment.objects.get_or_create_for_order(
+            'abcdef', order_sum=Decimal(100), cps_email='test@test.com')
+        self.assertTrue(created)
+        self.assertIsNotNone(payment.pk)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).cps_email,
+                         'test@test.com')
+
+        again, created = Payment.objects.get_or_create_for_order(
+            'abcdef', order_sum=Decimal(200))
+        self.assertFalse(created)
+        self.assertEqual(again.pk, payment.pk)
+        self.assertEqual(again.order_sum, Decimal(100))
+        self.assertEqual(
+            Payment.objects.filter(order_id='abcdef').count(), 1)
+
+    def test_upsert(self):
+        if not _supports_upsert(connection):
+            self.skipTest('ON CONFLICT is not supported')
+        with self.assertNumQueries(1):
+            payment, _ = Payment.objects.get_or_create_for_order(
+                'other', order_sum=Decimal(100))
+        self.assertEqual(payment.state, Payment.STATE_CREATED)
+        self.assertIsNotNone(payment.created)
+        self._check()
+
+    def test_fallback(self):
+        with mock.patch('yandex_cash_register.models._supports_upsert',
+                        return_value=False):
+            self._check()
@@ -0,0 +1,192 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from contextlib import contextmanager
+from decimal import Decimal
+import time
+from uuid import UUID
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.test import TestCase, Client
+
+from ..cache import get_cache
+from ..forms import FinalPaymentStateForm
+from ..metrics import registry, LOCK_WAIT
+from ..models import Payment
+from .. import conf
+from .test_views import TEST_SHOP_ID, notification_conf
+
+
+# Wall-clock budget for a single request. It is generous on purpose: the
+# goal is to catch accidental slow paths (network calls, N+1 loops), not to
+# benchmark the machine running the tests
+REQUEST_BUDGET = 0.5
+
+
+class BudgetMixin(object):
+    """Pins number of SQL queries, payment row locks and time spent for every
+    request path. If a change legitimately alters one of the numbers, update
+    the budget together with the change.
+
+    Tests run inside a transaction, so every block that locks a payment
+    costs two extra SAVEPOINT/RELEASE queries here
+    """
+
+    @contextmanager
+    def assertBudget(self, queries, locks, seconds=REQUEST_BUDGET):
+        registry.reset()
+        started = time.time()
+        with self.assertNumQueries(queries):
+            yield
+        elapsed = time.time() - started
+        self.assertEqual(self._lock_count(), locks)
+        self.assertLess(elapsed, seconds)
+
+    @staticmethod
+    def _lock_count():
+        return sum(registry.count(LOCK_WAIT, source=source) for source in
+                   ('PaymentProcessingForm', 'FinalPaymentStateForm'))
+
+    def _post(self, url, data):
+        return Client().post(url, data)
+
+
+@notification_conf()
+class NotificationBudgetTestCase(BudgetMixin, TestCase):
+    CHECK_MD5 = '54B30079ACF352701B9CA83A3AC7F640'
+    AVISO_MD5 = 'A436AD4F03575E9FD6167EC3750110D9'
+
+    def setUp(self):
+        self.payment = Payment.objects.create(
+            order_sum=Decimal(1000.0), order_id='abcdef',
+            cps_email='test@test.com', cps_phone='79991234567',
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY,
+            customer_id=UUID('0c3c745b-8c7b-4813-8b28-c0a2b037f19c')
+        )
+
+    def _data(self, action, **kwargs):
+        data = {
+            'shopId': TEST_SHOP_ID, 'orderNumber': self.payment.order_id,
+            'customerNumber': self.payment.customer_id,
+            'paymentType': conf.PAYMENT_TYPE_YANDEX_MONEY,
+            'action': action,
+            'invoiceId': '123456', 'orderSumAmount': '1000.0',
+            'orderSumCurrencyPaycash': '643',
+            'orderSumBankPaycash': '643', 'shopSumAmount': '975.3',
+            'shopSumCurrencyPaycash': '643',
+            'paymentPayerCode': '12345678901234567890'
+        }
+        data.update(kwargs)
+        return data
+
+    def _check(self, **kwargs):
+        kwargs.setdefault('md5', self.CHECK_MD5)
+        return self._post('/{}/order-check/'.format(conf.LOCAL_URL),
+                          self._data('checkOrder', **kwargs))
+
+    def _aviso(self, **kwargs):
+        kwargs.setdefault('md5', self.AVISO_MD5)
+        return self._post('/{}/payment-aviso/'.format(conf.LOCAL_URL),
+                          self._data('paymentAviso', **kwargs))
+
+    def test_check_order(self):
+        with self.assertBudget(queries=5, locks=1):
+            self._check()
+
+    def test_check_order_twice(self):
+        self._check()
+        with self.assertBudget(queries=5, locks=1):
+            self._check()
+
+    def test_check_order_completed(self):
+        self.payment.process()
+        self.payment.complete()
+        with self.assertBudget(queries=5, locks=1):
+            self._check()
+
+    def test_check_order_unknown(self):
+        with self.assertBudget(queries=1, locks=0):
+            self._check(orderNumber='unknown')
+
+    def test_check_order_invalid_signature(self):
+        with self.assertBudget(queries=0, locks=0):
+            self._check(md5='A' * 32)
+
+    def test_payment_aviso(self):
+        self.payment.process()
+        with self.assertBudget(queries=5, locks=1):
+            self._aviso()
+
+    def test_payment_aviso_completed(self):
+        self.payment.process()
+        self.payment.complete()
+        with self.assertBudget(queries=5, locks=1):
+            self._aviso()
+
+    def test_payment_aviso_invalid_signature(self):
+        self.payment.process()
+        with self.assertBudget(queries=0, locks=0):
+            self._aviso(md5='A' * 32)
+
+
+class FinishBudgetTestCase(BudgetMixin, TestCase):
+    def setUp(self):
+        patcher = mock.patch('yandex_cash_register.views.apps')
+        m_apps = patcher.start()
+        self.addCleanup(patcher.stop)
+        m_order = m_apps.get_model.return_value.get_by_order_id.return_value
+        m_order.get_absolute_url.return_value = '/order/'
+        m_order.get_payment_complete_url.return_value = '/order/complete/'
+
+        self.payment = Payment.objects.create(
+            order_sum=Decimal(1000.0), order_id='abcdef',
+            cps_email='test@test.com', cps_phone='79991234567',
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY,
+        )
+        get_cache().clear()
+
+    def _finish(self, action=FinalPaymentStateForm.ACTION_CONFIRM,
+                **kwargs):
+        data = {'cr_order_number': self.payment.order_id,
+                'cr_action': action}
+        data.update(kwargs)
+        return self._post('/{}/finish/'.format(conf.LOCAL_URL), data)
+
+    def test_not_started(self):
+        with self.assertBudget(queries=1, locks=0):
+            self._finish()
+
+    def test_processed_success(self):
+        self.payment.process()
+        with self.assertBudget(queries=1, locks=0):
+            self._finish()
+
+    def test_processed_fail(self):
+        self.payment.process()
+        with self.assertBudget(queries=5, locks=1):
+            self._finish(FinalPaymentStateForm.ACTION_FAIL)
+
+    def test_completed(self):
+        self.payment.process()
+        self.payment.complete()
+        with self.assertBudget(queries=1, locks=0):
+            self._finish()
+
+    def test_completed_repeated(self):
+        self.payment.process()
+        self.payment.complete()
+        self._finish()
+        with self.assertBudget(queries=0, locks=0):
+            self._finish()
+
+    def test_unknown_payment(self):
+        with self.assertBudget(queries=1, locks=0):
+            self._finish(cr_order_number='unknown')
+
+    def test_invalid_form(self):
+        with self.assertBudget(queries=1, locks=0):
+            self._finish(cr_action='unknown', cr_order_number='')
@@ -0,0 +1,205 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+import json
+import threading
+import time
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.core.urlresolvers import NoReverseMatch, reverse
+from django.test import TestCase, TransactionTestCase, RequestFactory
+
+from ..cache import get_cache
+from ..models import Payment
+from ..pubsub import CachePubSub, InMemoryPubSub, get_pubsub
+from ..views import PaymentWaitView
+from .. import conf
+
+
+def publish_later(pubsub, channel, message, delay=0.05):
+    thread = threading.Timer(delay, pubsub.publish, (channel, message))
+    thread.start()
+    return thread
+
+
+class PubSubTestMixin(object):
+    def _get_pubsub(self):
+        raise NotImplementedError()
+
+    def test_wait_for_message(self):
+        pubsub = self._get_pubsub()
+        with pubsub.subscribe('abcdef') as subscription:
+            publish_later(pubsub, 'abcdef', {'state': 'success'}).join()
+            self.assertEqual(subscription.wait(1), {'state': 'success'})
+
+    def test_timeout(self):
+        pubsub = self._get_pubsub()
+        with pubsub.subscribe('abcdef') as subscription:
+            pubsub.publish('other', {'state': 'success'})
+            started = time.time()
+            self.assertIsNone(subscription.wait(0.1))
+            self.assertGreaterEqual(time.time() - started, 0.09)
+
+    def test_published_before_subscription(self):
+        pubsub = self._get_pubsub()
+        pubsub.publish('abcdef', {'state': 'success'})
+        with pubsub.subscribe('abcdef') as subscription:
+            self.assertIsNone(subscription.wait(0.05))
+
+
+class InMemoryPubSubTestCase(PubSubTestMixin, TestCase):
+    def _get_pubsub(self):
+        return InMemoryPubSub()
+
+    def test_unsubscribe(self):
+        pubsub = self._get_pubsub()
+        with pubsub.subscribe('abcdef'):
+            pass
+        self.assertEqual(pubsub._subscriptions, {})
+
+
+class CachePubSubTestCase(PubSubTestMixin, TestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    def _get_pubsub(self):
+        return CachePubSub(interval=0.01)
+
+
+    def test_shared_poller(self):
+        """One thread polls for all subscribers of the process and stops
+        when nobody waits
+        """
+        pubsub = self._get_pubsub()
+        with pubsub.subscribe('a') as first, pubsub.subscribe('b') as second:
+            thread = pubsub._thread
+            pubsub.publish('a', 1)
+            pubsub.publish('b', 2)
+            self.assertEqual(first.wait(1), 1)
+            self.assertEqual(second.wait(1), 2)
+            self.assertIs(pubsub._thread, thread)
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(pubsub._thread)
+
+    def test_fork(self):
+        """A forked process starts a poller of its own"""
+        pubsub = self._get_pubsub()
+        with pubsub.subscribe('a'):
+            thread = pubsub._thread
+            with mock.patch('yandex_cash_register.pubsub.os.getpid',
+                            return_value=-1):
+                with pubsub.subscribe('b') as subscription:
+                    self.assertIsNot(pubsub._thread, thread)
+                    self.assertEqual(list(pubsub._subscriptions),
+                                     [subscription.key])
+
+
+class PaymentWaitViewTestCase(TestCase):
+    def setUp(self):
+        self.payment = Payment.objects.create(
+            order_sum=Decimal(1000.0), order_id='abcdef',
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY,
+        )
+        get_cache().clear()
+
+    def _get(self, **kwargs):
+        params = {'order_id': self.payment.order_id,
+                  'customer_id': str(self.payment.customer_id)}
+        params.update(kwargs)
+        response = PaymentWaitView.as_view()(
+            RequestFactory().get('/wait/', params))
+        return response, json.loads(response.content.decode('utf-8'))
+
+    def test_completed(self):
+        """Completed payment status is returned right away"""
+        self.payment.fail()
+        get_cache().clear()
+
+        started = time.time()
+        response, data = self._get(timeout=5)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(data['state'], Payment.STATE_FAIL)
+        self.assertTrue(data['is_completed'])
+
+    def test_refunded(self):
+        self.payment.process()
+        self.payment.complete()
+        self.payment.refund()
+        get_cache().clear()
+
+        started = time.time()
+        response, data = self._get(timeout=5)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(data['state'], Payment.STATE_REFUNDED)
+        self.assertTrue(data['is_completed'])
+        self.assertFalse(data['is_payed'])
+
+    def test_authorized(self):
+        """Authorized payment status is returned right away too"""
+        self.payment.process()
+        self.payment.authorize()
+        get_cache().clear()
+
+        started = time.time()
+        response, data = self._get(timeout=5)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(data['state'], Payment.STATE_AUTHORIZED)
+        self.assertFalse(data['is_completed'])
+
+    def test_timeout(self):
+        """Not completed payment status is returned after timeout"""
+        response, data = self._get(timeout=0.05)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['state'], Payment.STATE_CREATED)
+
+    def test_wake_up(self):
+        """Waiting request is answered as soon as payment completes"""
+        status = dict(self.payment.get_status(), state=Payment.STATE_SUCCESS)
+        publish_later(get_pubsub(), self.payment.order_id, status)
+
+        started = time.time()
+        response, data = self._get(timeout=5)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(data['state'], Payment.STATE_SUCCESS)
+        self.assertTrue(data['is_payed'])
+
+    def test_unknown_customer(self):
+        response, data = self._get(
+            customer_id='0c3c745b-8c7b-4813-8b28-c0a2b037f19d')
+        self.assertEqual(response.status_code, 404)
+
+    def test_opt_in(self):
+        """The endpoint is routed only with YANDEX_CR_WAIT"""
+        with self.assertRaises(NoReverseMatch):
+            reverse('yandex_cash_register:money_payment_wait')
+
+
+class SignalsTestCase(TransactionTestCase):
+    def test_transitions_publish_status(self):
+        payment = Payment.objects.create(
+            order_sum=Decimal(1000.0), order_id='abcdef',
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY,
+        )
+        payment.process()
+
+        with get_pubsub().subscribe(payment.order_id) as subscription:
+            payment.authorize()
+            status = subscription.wait(2)
+        self.assertEqual(status['state'], Payment.STATE_AUTHORIZED)
+
+        with get_pubsub().subscribe(payment.order_id) as subscription:
+            payment.complete()
+            status = subscription.wait(2)
+        self.assertEqual(status['state'], Payment.STATE_SUCCESS)
+        self.assertEqual(status['order_id'], payment.order_id)
+
+        with get_pubsub().subscribe(payment.order_id) as subscription:
+            payment.refund()
+            status = subscription.wait(2)
+        self.assertEqual(status['state'], Payment.STATE_REFUNDED)
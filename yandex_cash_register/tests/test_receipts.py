@@ -0,0 +1,118 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+import json
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.test import SimpleTestCase, TestCase
+
+from ..models import Payment
+from ..receipts import ReceiptSerializer, get_receipt
+from .. import cache
+
+
+ITEMS = [
+    {'text': 'Зеленый чай "Юн Ву", кг', 'quantity': Decimal('1.154'),
+     'price': Decimal('300.23'), 'tax': 3},
+    {'text': 'Доставка', 'quantity': 1, 'price': Decimal(100),
+     'paymentSubjectType': 'service'},
+]
+
+
+class Order(object):
+    def __init__(self, items=ITEMS, version=1):
+        self.items = items
+        self.version = version
+        self.calls = 0
+
+    def get_receipt_items(self):
+        self.calls += 1
+        return self.items
+
+    def get_receipt_version(self):
+        return self.version
+
+
+class ReceiptSerializerTestCase(SimpleTestCase):
+    def test_serialize(self):
+        receipt = ReceiptSerializer(tax=1).serialize(ITEMS,
+                                                     'test@test.com')
+        self.assertEqual(json.loads(receipt), {
+            'customerContact': 'test@test.com',
+            'items': [
+                {'text': 'Зеленый чай "Юн Ву", кг', 'quantity': 1.154,
+                 'price': {'amount': 300.23}, 'tax': 3},
+                {'text': 'Доставка', 'quantity': 1.0,
+                 'price': {'amount': 100.0}, 'tax': 1,
+                 'paymentSubjectType': 'service'},
+            ],
+        })
+        # Compact, not escaped
+        self.assertTrue(receipt.startswith(
+            '{"customerContact":"test@test.com","items":[{'))
+        self.assertIn('Доставка', receipt)
+
+    def test_tax_system(self):
+        receipt = ReceiptSerializer(tax_system=2).serialize(ITEMS, '7999')
+        self.assertEqual(json.loads(receipt)['taxSystem'], 2)
+
+    def test_invalid_item(self):
+        with self.assertRaises(ValueError):
+            ReceiptSerializer().serialize([{'text': 'No price',
+                                            'quantity': 1}], '7999')
+        receipt = ReceiptSerializer().serialize(
+            [{'text': 'x' * 200, 'quantity': 1, 'price': 1}], '7999')
+        self.assertEqual(len(json.loads(receipt)['items'][0]['text']), 128)
+
+
+class ReceiptTestCase(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.payment = Payment.objects.create(
+            order_sum=Decimal('446.46'), order_id='abcdef',
+            cps_email='test@test.com')
+
+    def test_cached_by_version(self):
+        order = Order()
+        receipt = get_receipt(self.payment, order)
+        self.assertEqual(get_receipt(self.payment, order), receipt)
+        self.assertEqual(order.calls, 1)
+
+        order.version = 2
+        order.items = ITEMS[:1]
+        self.assertNotEqual(get_receipt(self.payment, order), receipt)
+        self.assertEqual(order.calls, 2)
+
+    def test_not_cached_without_version(self):
+        order = Order(version=None)
+        get_receipt(self.payment, order)
+        get_receipt(self.payment, order)
+        self.assertEqual(order.calls, 2)
+
+    def test_no_receipt(self):
+        self.assertIsNone(get_receipt(self.payment, object()))
+        self.assertIsNone(get_receipt(self.payment, Order(items=[])))
+        self.payment.cps_email = ''
+        with self.assertRaises(ValueError):
+            get_receipt(self.payment, Order())
+
+    def test_form(self):
+        self.assertNotIn('ym_merchant_receipt', self.payment.form().fields)
+
+        form = self.payment.form(Order())
+        self.assertEqual(form['ym_merchant_receipt'].value(),
+                         get_receipt(self.payment, Order()))
+
+        model = mock.Mock()
+        model.get_by_order_id.return_value = Order()
+        with mock.patch('yandex_cash_register.models.conf.RECEIPTS', True), \
+                mock.patch('yandex_cash_register.models.apps.get_model',
+                           return_value=model):
+            form = self.payment.form()
+        model.get_by_order_id.assert_called_once_with('abcdef')
+        self.assertIn('ym_merchant_receipt', form.fields)
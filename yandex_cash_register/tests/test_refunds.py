@@ -0,0 +1,211 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+import json
+import threading
+import time
+from unittest import skipIf
+
+from django.core.management import call_command
+from django.test import Client, SimpleTestCase, TestCase
+from django.utils.six import StringIO
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ..concurrency import RateLimiter
+from ..kassa import KassaClient
+from ..models import Payment, Refund
+from ..refunds import apply_refund, create_refunds, record_results, \
+    submit_refunds
+from .. import conf, kassa
+from .kassa_server import FakeKassa, SECRET_KEY, SHOP_ID
+from .test_webhooks import KASSA_IP
+
+
+class RateLimiterTestCase(SimpleTestCase):
+    def test_rate(self):
+        limiter = RateLimiter(100, burst=5)
+        started = time.time()
+        threads = [threading.Thread(target=limiter.wait) for _ in range(25)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 5 calls at once, the other 20 at 100 per second
+        self.assertGreaterEqual(time.time() - started, 0.18)
+
+    def test_burst(self):
+        limiter = RateLimiter(1, burst=3)
+        self.assertEqual([limiter.wait() for _ in range(3)], [0, 0, 0])
+
+
+class RefundTestMixin(object):
+    def _payment(self, order_id, state=Payment.STATE_SUCCESS,
+                 order_sum=Decimal(100)):
+        remote = self.kassa.add_payment(
+            'succeeded' if state == Payment.STATE_SUCCESS else 'pending',
+            amount='{:.2f}'.format(order_sum))
+        return Payment.objects.create(order_id=order_id, order_sum=order_sum,
+                                      state=state, external_id=remote['id'])
+
+
+@skipIf(kassa.requests is None, 'requests is not installed')
+class RefundsTestCase(RefundTestMixin, TestCase):
+    def setUp(self):
+        self.kassa = FakeKassa().start()
+        self.addCleanup(self.kassa.stop)
+        self.client = KassaClient(self.kassa.url, SHOP_ID, SECRET_KEY)
+        self.addCleanup(self.client.close)
+
+    def test_create_refunds(self):
+        self._payment('a')
+        self._payment('b')
+        self._payment('c', state=Payment.STATE_FAIL)
+        self.assertEqual(create_refunds(['a', 'b', 'c', 'unknown'],
+                                        description='Event cancelled'), 2)
+        self.assertEqual(
+            sorted(Refund.objects.values_list('order_id', 'amount')),
+            [('a', Decimal(100)), ('b', Decimal(100))])
+        # Repeated run doesn't create more refunds
+        self.assertEqual(create_refunds(['a', 'b']), 0)
+
+    def test_submit_refunds(self):
+        order_ids = ['order-{}'.format(i) for i in range(30)]
+        for order_id in order_ids:
+            self._payment(order_id)
+        unknown = Payment.objects.create(order_id='unknown',
+                                         order_sum=Decimal(100),
+                                         state=Payment.STATE_SUCCESS)
+        create_refunds(order_ids + ['unknown'], batch_size=7)
+
+        counts = submit_refunds(workers=4, rate=1000, client=self.client,
+                                batch_size=7)
+        self.assertEqual(counts, {'succeeded': 30, 'pending': 0,
+                                  'canceled': 0, 'error': 1})
+        self.assertEqual(len(self.kassa.refunds), 30)
+        self.assertEqual(
+            Payment.objects.filter(state=Payment.STATE_REFUNDED).count(), 30)
+        refund = Refund.objects.get(order_id='order-0')
+        self.assertIn(refund.external_id, self.kassa.refunds)
+        error = Refund.objects.get(payment=unknown)
+        self.assertEqual(error.status, Refund.STATUS_ERROR)
+        self.assertEqual(error.error, 'Payment is unknown to the Kassa API')
+
+        # Nothing left to submit, errors only with retry_errors
+        self.assertEqual(sum(submit_refunds(client=self.client).values()), 0)
+        self.assertEqual(submit_refunds(client=self.client,
+                                        retry_errors=True)['error'], 1)
+
+    def test_resubmit_is_idempotent(self):
+        """Refund submitted before its result was saved is not repeated"""
+        self._payment('a')
+        create_refunds(['a'])
+        submit_refunds(client=self.client)
+        Refund.objects.update(status=Refund.STATUS_NEW, external_id=None)
+        Payment.objects.update(state=Payment.STATE_SUCCESS)
+        submit_refunds(client=self.client)
+        self.assertEqual(len(self.kassa.refunds), 1)
+        self.assertEqual(Refund.objects.get().status,
+                         Refund.STATUS_SUCCEEDED)
+
+    def test_pending_and_partial(self):
+        self.kassa.refund_status = 'pending'
+        self._payment('a')
+        self._payment('b')
+        create_refunds(['a'])
+        create_refunds(['b'], amount=Decimal(40))
+        self.assertEqual(submit_refunds(client=self.client)['pending'], 2)
+        self.assertEqual(Payment.objects.filter(
+            state=Payment.STATE_SUCCESS).count(), 2)
+
+        # Notifications complete them, partial refund keeps the payment
+        for data in self.kassa.refunds.values():
+            apply_refund(dict(data, status='succeeded'))
+        self.assertEqual(Payment.objects.get(order_id='a').state,
+                         Payment.STATE_REFUNDED)
+        self.assertEqual(Payment.objects.get(order_id='b').state,
+                         Payment.STATE_SUCCESS)
+
+    def test_unknown_status(self):
+        self.kassa.refund_status = 'unexpected'
+        self._payment('a')
+        create_refunds(['a'])
+        self.assertEqual(submit_refunds(client=self.client)['error'], 1)
+        self.assertEqual(Refund.objects.get().status, 'unexpected')
+
+    def test_record_results(self):
+        self._payment('a')
+        self._payment('b')
+        create_refunds(['a', 'b'])
+        first, second = Refund.objects.order_by('pk')
+        with self.assertNumQueries(1):
+            record_results(Refund.objects.all(), {
+                first.pk: {'status': 'succeeded', 'external_id': 'x'},
+                second.pk: {'status': 'error', 'error': 'Failed'},
+            })
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.status, first.external_id, first.error),
+                         ('succeeded', 'x', ''))
+        self.assertEqual((second.status, second.external_id, second.error),
+                         ('error', None, 'Failed'))
+
+    def test_record_results_after_notification(self):
+        """A pending API response doesn't overwrite a refund finished by a
+        notification in the meantime
+        """
+        self._payment('a')
+        create_refunds(['a'])
+        refund = Refund.objects.get()
+        Refund.objects.update(status=Refund.STATUS_SUCCEEDED,
+                              external_id='x')
+        record_results(Refund.objects.all(), {
+            refund.pk: {'status': 'pending', 'external_id': 'x'},
+        })
+        refund.refresh_from_db()
+        self.assertEqual(refund.status, Refund.STATUS_SUCCEEDED)
+
+    def test_command(self):
+        self._payment('a')
+        self._payment('b')
+        out = StringIO()
+        with mock.patch('yandex_cash_register.refunds.kassa.get_client',
+                        return_value=self.client):
+            call_command('refund_payments', 'a', 'b', '--rate=100',
+                         stdout=out)
+        self.assertIn('Refunds created: 2', out.getvalue())
+        self.assertIn('succeeded: 2', out.getvalue())
+
+
+@skipIf(kassa.requests is None, 'requests is not installed')
+class RefundWebhookTestCase(RefundTestMixin, TestCase):
+    def setUp(self):
+        self.kassa = FakeKassa()
+
+    def _post(self, obj, code=200):
+        response = Client(REMOTE_ADDR=KASSA_IP).post(
+            '/{}/webhook/'.format(conf.LOCAL_URL),
+            json.dumps({'type': 'notification', 'event': 'refund.succeeded',
+                        'object': obj}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, code)
+
+    def test_refund_from_dashboard(self):
+        payment = self._payment('a')
+        obj = {'id': 'refund-1', 'payment_id': payment.external_id,
+               'status': 'succeeded',
+               'amount': {'value': '100.00', 'currency': 'RUB'}}
+        self._post(obj)
+        self._post(obj)
+        refund = Refund.objects.get()
+        self.assertEqual(refund.external_id, 'refund-1')
+        self.assertEqual(refund.status, Refund.STATUS_SUCCEEDED)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).state,
+                         Payment.STATE_REFUNDED)
+
+        self._post(dict(obj, id='refund-2', payment_id='unknown'), code=404)
+        self._post({'id': 'refund-3'}, code=400)
@@ -0,0 +1,197 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+
+from django.contrib.admin import AdminSite
+from django.contrib.auth.models import User
+from django.test import TestCase, RequestFactory, override_settings
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ..admin import PaymentAdmin, ShardListFilter
+from ..cache import get_cache
+from ..forms import PaymentProcessingForm, get_payment, make_md5
+from ..models import Payment
+from ..routers import ReplicaRouter, get_shards, pin_primary, read_db, \
+    shard_for
+from ..views import CheckOrderView, PaymentAvisoView
+from .. import conf
+
+
+@mock.patch('yandex_cash_register.routers.conf.REPLICA_DB', 'replica')
+class ReplicaRoutingTestCase(TestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    def test_read_db(self):
+        self.assertEqual(read_db(), 'replica')
+        self.assertEqual(read_db('abcdef'), 'replica')
+        self.assertEqual(Payment.objects.for_read().db, 'replica')
+
+    def test_pinned(self):
+        with pin_primary():
+            with pin_primary():
+                self.assertEqual(read_db(), 'default')
+            self.assertEqual(Payment.objects.for_read().db, 'default')
+        self.assertEqual(read_db(), 'replica')
+
+    def test_read_your_writes(self):
+        payment = Payment.objects.create(order_id='abcdef',
+                                         order_sum=Decimal('100.00'))
+        self.assertEqual(read_db('abcdef'), 'default')
+        self.assertEqual(read_db('other'), 'replica')
+
+        get_cache().clear()
+        self.assertEqual(read_db('abcdef'), 'replica')
+        payment.process()
+        self.assertEqual(read_db('abcdef'), 'default')
+
+    def test_router(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Payment), 'default')
+        self.assertEqual(router.db_for_write(Payment), 'default')
+        self.assertIsNone(router.db_for_read(User))
+
+        payment = Payment(order_id='abcdef')
+        payment._state.db = 'replica'
+        self.assertEqual(router.db_for_write(Payment, instance=payment),
+                         'default')
+        user = User()
+        user._state.db = 'default'
+        self.assertTrue(router.allow_relation(payment, user))
+
+        self.assertFalse(router.allow_migrate('replica',
+                                              'yandex_cash_register'))
+        self.assertIsNone(router.allow_migrate('default',
+                                               'yandex_cash_register'))
+        self.assertIsNone(router.allow_migrate('replica', 'auth'))
+
+    def test_admin_changelist(self):
+        model_admin = PaymentAdmin(Payment, AdminSite())
+        request = RequestFactory().get('/')
+        request.resolver_match = mock.Mock(
+            url_name='yandex_cash_register_payment_changelist')
+        self.assertEqual(model_admin.get_queryset(request).db, 'replica')
+
+        request.resolver_match = mock.Mock(
+            url_name='yandex_cash_register_payment_change')
+        self.assertEqual(model_admin.get_queryset(request).db, 'default')
+
+
+class NoReplicaTestCase(TestCase):
+    def test_read_db(self):
+        self.assertEqual(read_db(), 'default')
+        self.assertEqual(Payment.objects.for_read('abcdef').db, 'default')
+
+
+SHARDS = ['default', 'shard2']
+
+
+def order_id_on(shard):
+    for i in range(100):
+        order_id = 'order-{}'.format(i)
+        if shard_for(order_id) == shard:
+            return order_id
+
+
+@override_settings(
+    DATABASE_ROUTERS=['yandex_cash_register.routers.ShardRouter'])
+@mock.patch('yandex_cash_register.routers.conf.SHARDS', SHARDS)
+class ShardingTestCase(TestCase):
+    multi_db = True
+
+    def _create(self, shard):
+        return Payment.objects.create(
+            order_id=order_id_on(shard), order_sum=Decimal('1000.00'),
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY)
+
+    def test_shard_for(self):
+        self.assertEqual(get_shards(), SHARDS)
+        self.assertEqual(shard_for('order-0'), shard_for('order-0'))
+        used = set(shard_for('order-{}'.format(i)) for i in range(100))
+        self.assertEqual(used, set(SHARDS))
+        self.assertEqual(Payment.objects.for_order('abcdef').db,
+                         shard_for('abcdef'))
+
+    def test_save_to_shard(self):
+        for shard in SHARDS:
+            payment = self._create(shard)
+            self.assertEqual(payment._state.db, shard)
+            self.assertTrue(Payment.objects.using(shard).filter(
+                order_id=payment.order_id).exists())
+            self.assertEqual(get_payment(payment.order_id), payment)
+
+        counts = [qs.count() for qs in Payment.objects.fan_out()]
+        self.assertEqual(counts, [1, 1])
+
+    def test_notifications(self):
+        payment = self._create('shard2')
+        for view, action in ((CheckOrderView, 'checkOrder'),
+                             (PaymentAvisoView, 'paymentAviso')):
+            data = {
+                'shopId': conf.SHOP_ID, 'orderNumber': payment.order_id,
+                'customerNumber': payment.customer_id, 'action': action,
+                'paymentType': conf.PAYMENT_TYPE_YANDEX_MONEY,
+                'invoiceId': '123456', 'orderSumAmount': '1000.00',
+                'orderSumCurrencyPaycash': '643',
+                'orderSumBankPaycash': '643', 'shopSumAmount': '975.30',
+                'shopSumCurrencyPaycash': '643',
+            }
+            data['md5'] = make_md5(data, PaymentProcessingForm.MD5_KEY_ORDER)
+            response = view.as_view()(RequestFactory().post('/', data))
+            self.assertIn(b'code="0"', response.content)
+
+        payment = Payment.objects.using('shard2').get(pk=payment.pk)
+        self.assertEqual(payment.state, Payment.STATE_SUCCESS)
+        self.assertEqual(payment.shop_sum, Decimal('975.30'))
+
+    def test_admin_shard(self):
+        model_admin = PaymentAdmin(Payment, AdminSite())
+        request = RequestFactory().get('/', {'shard': 'shard2'})
+        self.assertEqual(model_admin.get_queryset(request).db, 'shard2')
+
+        request = RequestFactory().get(
+            '/', {'_changelist_filters': 'shard=shard2'})
+        self.assertEqual(model_admin.get_queryset(request).db, 'shard2')
+
+        request = RequestFactory().get('/', {'shard': 'unknown'})
+        self.assertEqual(model_admin.get_queryset(request).db, 'default')
+
+    def test_admin_search(self):
+        """Searching for an order ID browses the shard of the order"""
+        model_admin = PaymentAdmin(Payment, AdminSite())
+        order_id = order_id_on('shard2')
+        for params in ({'q': order_id},
+                       {'q': order_id, 'shard': 'default'},
+                       {'_changelist_filters': 'q=' + order_id}):
+            request = RequestFactory().get('/', params)
+            self.assertEqual(model_admin.get_queryset(request).db, 'shard2')
+
+    def test_admin_filter_choices(self):
+        model_admin = PaymentAdmin(Payment, AdminSite())
+        changelist = mock.Mock()
+        changelist.get_query_string.return_value = '?'
+        for params, selected in (({}, 'default'),
+                                 ({'shard': 'shard2'}, 'shard2'),
+                                 ({'q': order_id_on('shard2')}, 'shard2')):
+            request = RequestFactory().get('/', params)
+            list_filter = ShardListFilter(request, dict(params.items()),
+                                          Payment, model_admin)
+            choices = list(list_filter.choices(changelist))
+            self.assertEqual([choice['display'] for choice in choices],
+                             SHARDS)
+            self.assertEqual([choice['display'] for choice in choices
+                              if choice['selected']], [selected])
+
+    def test_user_on_other_shard(self):
+        """Users exist in the default database only"""
+        user = User.objects.create(username='shopper')
+        payment = Payment.objects.using('shard2').create(
+            order_id=order_id_on('shard2'), order_sum=Decimal('1.00'),
+            user_id=user.pk)
+        self.assertFalse(Payment._meta.get_field('user').db_constraint)
+        self.assertEqual(payment.user_id, user.pk)
@@ -0,0 +1,217 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+from decimal import Decimal
+from unittest import skipIf
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.utils.six import StringIO
+from django.utils.timezone import now
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ..kassa import KassaClient, update_payment
+from ..models import Payment, Subscription
+from ..subscriptions import add_months, charge_subscriptions, subscribe
+from .. import conf, kassa
+from .kassa_server import FakeKassa, SECRET_KEY, SHOP_ID
+
+
+class AddMonthsTestCase(SimpleTestCase):
+    def test_add_months(self):
+        self.assertEqual(add_months(datetime.datetime(2017, 1, 15), 1),
+                         datetime.datetime(2017, 2, 15))
+        self.assertEqual(add_months(datetime.datetime(2017, 1, 31), 1),
+                         datetime.datetime(2017, 2, 28))
+        self.assertEqual(add_months(datetime.datetime(2016, 11, 30), 3),
+                         datetime.datetime(2017, 2, 28))
+        self.assertEqual(add_months(datetime.datetime(2017, 12, 1), 12),
+                         datetime.datetime(2018, 12, 1))
+
+
+class SubscribeTestCase(TestCase):
+    def test_token_saved(self):
+        payment = Payment(order_id='abcdef', order_sum=Decimal(100))
+        update_payment(payment, {'id': 'ext', 'payment_method': {
+            'type': 'bank_card', 'id': 'method', 'saved': False}})
+        self.assertEqual(payment.payment_method_id, '')
+        update_payment(payment, {'id': 'ext', 'payment_method': {
+            'type': 'bank_card', 'id': 'method', 'saved': True}})
+        self.assertEqual(payment.payment_method_id, 'method')
+
+    def test_subscribe(self):
+        payment = Payment.objects.create(
+            order_id='abcdef', order_sum=Decimal(100),
+            state=Payment.STATE_SUCCESS, completed=now())
+        with self.assertRaises(ValueError):
+            subscribe(payment)
+
+        payment.payment_method_id = 'method'
+        subscription = subscribe(payment, description='Monthly plan')
+        self.assertEqual(subscription.payment_method_id, 'method')
+        self.assertEqual(subscription.amount, Decimal(100))
+        self.assertEqual(subscription.next_charge,
+                         add_months(payment.completed, 1))
+        self.assertEqual(subscribe(payment, 3).pk, subscription.pk)
+
+
+@skipIf(kassa.requests is None, 'requests is not installed')
+class ChargeSubscriptionsTestCase(TestCase):
+    def setUp(self):
+        self.kassa = FakeKassa().start()
+        self.addCleanup(self.kassa.stop)
+        self.client = KassaClient(self.kassa.url, SHOP_ID, SECRET_KEY)
+        self.addCleanup(self.client.close)
+        self.due = now() - datetime.timedelta(hours=1)
+
+    def _subscription(self, order_id, method=None, **kwargs):
+        payment = Payment.objects.create(
+            order_id=order_id, order_sum=Decimal(100),
+            state=Payment.STATE_SUCCESS,
+            payment_method_id=method or 'method-' + order_id)
+        kwargs.setdefault('start', self.due)
+        return subscribe(payment, **kwargs)
+
+    def _charge(self, **kwargs):
+        kwargs.setdefault('client', self.client)
+        kwargs.setdefault('rate', 1000)
+        return charge_subscriptions(**kwargs)
+
+    def test_charge(self):
+        for i in range(20):
+            self._subscription('order-{}'.format(i))
+        self._subscription('declined', method='bad')
+        self._subscription('later', start=now() + datetime.timedelta(days=1))
+        self.kassa.declined_methods.add('bad')
+
+        counts = self._charge(workers=4, batch_size=6)
+        self.assertEqual(counts, {'charged': 20, 'pending': 0,
+                                  'declined': 1, 'errors': 0,
+                                  'suspended': 0, 'retries': 0})
+        self.assertEqual(len(self.kassa.payments), 21)
+
+        charges = Payment.objects.filter(parent_order_id='order-0')
+        self.assertEqual(len(charges), 1)
+        self.assertEqual(charges[0].state, Payment.STATE_SUCCESS)
+        self.assertEqual(charges[0].order_sum, Decimal(100))
+        subscription = Subscription.objects.get(order_id='order-0')
+        self.assertEqual(subscription.next_charge, add_months(self.due, 1))
+        self.assertIsNotNone(subscription.last_charged)
+
+        declined = Subscription.objects.get(order_id='declined')
+        self.assertEqual(declined.failures, 1)
+        self.assertEqual(declined.last_error, 'insufficient_funds')
+        self.assertEqual(declined.next_charge, self.due)
+        self.assertEqual(Payment.objects.get(
+            parent_order_id='declined').state, Payment.STATE_FAIL)
+
+        # Nothing is due until the retry
+        self.assertEqual(sum(self._charge().values()), 0)
+
+    def test_retries_and_suspend(self):
+        self._subscription('declined', method='bad')
+        self.kassa.declined_methods.add('bad')
+        at = now()
+        for attempt in range(conf.SUBSCRIPTION_MAX_FAILURES):
+            counts = self._charge(at=at)
+            self.assertEqual(counts['retries'], 1 if attempt else 0)
+            at += datetime.timedelta(seconds=conf.SUBSCRIPTION_RETRY_DELAY)
+        self.assertEqual(counts['suspended'], 1)
+        subscription = Subscription.objects.get()
+        self.assertEqual(subscription.state, Subscription.STATE_SUSPENDED)
+        # Each attempt is a payment of its own
+        self.assertEqual(Payment.objects.filter(
+            parent_order_id='declined').count(),
+            conf.SUBSCRIPTION_MAX_FAILURES)
+
+        self.kassa.declined_methods.clear()
+        Subscription.objects.update(state=Subscription.STATE_ACTIVE)
+        self.assertEqual(self._charge(at=at)['charged'], 1)
+        self.assertEqual(Subscription.objects.get().failures, 0)
+
+    def test_rerun_is_idempotent(self):
+        """Charges made by a run that stopped before saving the schedule
+        are not made again
+        """
+        self._subscription('a')
+        self._subscription('b')
+        self._charge()
+        Subscription.objects.update(next_charge=self.due, last_charged=None)
+        self.assertEqual(self._charge()['charged'], 2)
+        self.assertEqual(len(self.kassa.payments), 2)
+        self.assertEqual(Payment.objects.filter(
+            parent_order_id='a').count(), 1)
+
+    def test_pending(self):
+        """The schedule moves on only once a pending charge settles"""
+        self._subscription('a', method='slow-a')
+        self._subscription('b', method='slow-b')
+        self.kassa.pending_methods.update(['slow-a', 'slow-b'])
+        self.assertEqual(self._charge()['pending'], 2)
+        subscription = Subscription.objects.get(order_id='a')
+        self.assertEqual(subscription.next_charge, self.due)
+        self.assertEqual(subscription.failures, 0)
+        self.assertIsNone(subscription.last_charged)
+        self.assertIsNotNone(subscription.retry_at)
+        retry_at = subscription.retry_at
+
+        # Still pending on the next look
+        self.assertEqual(self._charge(at=retry_at)['pending'], 2)
+
+        Payment.objects.get(parent_order_id='a').complete()
+        Payment.objects.get(parent_order_id='b').fail()
+        retry_at = Subscription.objects.get(order_id='a').retry_at
+        counts = self._charge(at=retry_at)
+        self.assertEqual((counts['charged'], counts['declined']), (1, 1))
+        self.assertEqual(len(self.kassa.payments), 2)
+        subscription = Subscription.objects.get(order_id='a')
+        self.assertEqual(subscription.next_charge, add_months(self.due, 1))
+        self.assertIsNone(subscription.retry_at)
+        declined = Subscription.objects.get(order_id='b')
+        self.assertEqual(declined.next_charge, self.due)
+        self.assertEqual(declined.failures, 1)
+
+    def test_authorized(self):
+        """An authorized charge is pending, not an error"""
+        self._subscription('a', method='slow-a')
+        self.kassa.pending_methods.add('slow-a')
+        self._charge()
+        Payment.objects.filter(parent_order_id='a').update(
+            state=Payment.STATE_AUTHORIZED)
+        retry_at = Subscription.objects.get().retry_at
+        counts = self._charge(at=retry_at)
+        self.assertEqual((counts['pending'], counts['errors']), (1, 0))
+        subscription = Subscription.objects.get()
+        self.assertEqual(subscription.next_charge, self.due)
+        self.assertEqual(subscription.last_error, '')
+        self.assertEqual(len(self.kassa.payments), 1)
+
+    def test_api_error(self):
+        self._subscription('a')
+        self.kassa.fail_next(status=400)
+        counts = self._charge()
+        self.assertEqual(counts['errors'], 1)
+        subscription = Subscription.objects.get()
+        self.assertEqual(subscription.failures, 0)
+        self.assertIsNotNone(subscription.retry_at)
+        charge = Payment.objects.get(parent_order_id='a')
+        self.assertEqual(charge.state, Payment.STATE_CREATED)
+
+        # Retried with the same payment
+        self.assertEqual(self._charge(at=subscription.retry_at)['charged'], 1)
+        self.assertEqual(Payment.objects.get(pk=charge.pk).state,
+                         Payment.STATE_SUCCESS)
+
+    def test_command(self):
+        self._subscription('a')
+        out = StringIO()
+        with mock.patch('yandex_cash_register.subscriptions.kassa.get_client',
+                        return_value=self.client):
+            call_command('charge_subscriptions', '--rate=100', stdout=out)
+        self.assertIn('charged: 1', out.getvalue())
+        self.assertIn('per second', out.getvalue())
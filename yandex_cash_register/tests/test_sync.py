@@ -0,0 +1,227 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+from decimal import Decimal
+import threading
+import time
+from unittest import skipIf
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.utils.six import StringIO
+from django.utils.timezone import now
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ..concurrency import run_bounded
+from ..kassa import KassaClient
+from ..models import Payment
+from ..sync import apply_status, stale_payments, sync_payments
+from .. import kassa
+from .kassa_server import FakeKassa, SECRET_KEY, SHOP_ID
+
+
+class RunBoundedTestCase(SimpleTestCase):
+    def test_results(self):
+        def func(item):
+            if item == 3:
+                raise ValueError(item)
+            return item * 2
+
+        results = dict((item, (result, exc_info))
+                       for item, result, exc_info in
+                       run_bounded(func, range(10), workers=3))
+        self.assertEqual(sorted(results), list(range(10)))
+        self.assertEqual(results[4], (8, None))
+        self.assertIsNone(results[3][0])
+        self.assertIs(results[3][1][0], ValueError)
+
+    def test_bounded(self):
+        """No more than ``workers`` calls run at once, and items are not
+        taken from the iterable much ahead of the workers
+        """
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0, 'taken': 0}
+
+        def func(item):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'],
+                                           state['running'])
+            time.sleep(0.005)
+            with lock:
+                state['running'] -= 1
+
+        def items():
+            for i in range(40):
+                state['taken'] += 1
+                yield i
+
+        results = run_bounded(func, items(), workers=4, backlog=4)
+        next(results)
+        self.assertLessEqual(state['taken'], 4 + 4 + 1)
+        self.assertEqual(len(list(results)), 39)
+        self.assertLessEqual(state['max_running'], 4)
+
+    def test_stopped_early(self):
+        results = run_bounded(lambda item: item, range(1000), workers=2)
+        next(results)
+        results.close()
+        time.sleep(0.05)
+        self.assertFalse([thread for thread in threading.enumerate()
+                          if thread.name == 'yandex-cr-worker'])
+
+
+@skipIf(kassa.requests is None, 'requests is not installed')
+class SyncPaymentsTestCase(TestCase):
+    def setUp(self):
+        self.kassa = FakeKassa().start()
+        self.addCleanup(self.kassa.stop)
+        self.client = KassaClient(self.kassa.url, SHOP_ID, SECRET_KEY)
+        self.addCleanup(self.client.close)
+
+    def _payment(self, status, performed=None, state=Payment.STATE_PROCESSED,
+                 **kwargs):
+        remote = self.kassa.add_payment(status)
+        return Payment.objects.create(
+            order_id=remote['id'][:20], order_sum=Decimal(100), state=state,
+            performed=performed or now() - datetime.timedelta(hours=2),
+            external_id=remote['id'], **kwargs)
+
+    def test_sync(self):
+        payments = dict(
+            (status, [self._payment(status) for _ in range(10)])
+            for status in ('succeeded', 'canceled', 'pending'))
+        fresh = self._payment('succeeded', performed=now())
+        completed = self._payment('canceled', state=Payment.STATE_SUCCESS)
+        unknown = Payment.objects.create(
+            order_id='unknown', order_sum=Decimal(100), external_id='missing',
+            state=Payment.STATE_PROCESSED,
+            performed=now() - datetime.timedelta(hours=2))
+
+        counts = sync_payments(min_age=60 * 60, batch_size=4, workers=3,
+                               client=self.client)
+        self.assertEqual(counts, {'checked': 31, 'completed': 10,
+                                  'failed': 10, 'authorized': 0,
+                                  'pending': 10, 'skipped': 0, 'errors': 1,
+                                  'legacy': 0, 'expired': 0})
+
+        expected = {'succeeded': Payment.STATE_SUCCESS,
+                    'canceled': Payment.STATE_FAIL,
+                    'pending': Payment.STATE_PROCESSED}
+        for status, state in expected.items():
+            self.assertEqual(
+                set(Payment.objects.filter(
+                    pk__in=[p.pk for p in payments[status]]).values_list(
+                    'state', flat=True)), {state})
+        for payment in (fresh, unknown):
+            payment.refresh_from_db()
+            self.assertEqual(payment.state, Payment.STATE_PROCESSED)
+        completed.refresh_from_db()
+        self.assertEqual(completed.state, Payment.STATE_SUCCESS)
+
+        # Nothing changes on a second run
+        counts = sync_payments(min_age=60 * 60, batch_size=4, workers=3,
+                               client=self.client)
+        self.assertEqual(counts['checked'], 11)
+        self.assertEqual(counts['completed'] + counts['failed'], 0)
+
+    def test_created(self):
+        """API payments whose notifications were lost are synced too"""
+        old = now() - datetime.timedelta(hours=2)
+        payments = dict(
+            (status, self._payment(status, state=Payment.STATE_CREATED))
+            for status in ('succeeded', 'canceled', 'waiting_for_capture',
+                           'pending'))
+        fresh = self._payment('succeeded', state=Payment.STATE_CREATED)
+        Payment.objects.exclude(pk=fresh.pk).update(created=old)
+        # Legacy payment, unknown to the API
+        Payment.objects.create(order_id='legacy', order_sum=Decimal(100))
+        Payment.objects.filter(order_id='legacy').update(created=old)
+
+        counts = sync_payments(min_age=60 * 60, client=self.client)
+        self.assertEqual(counts, {'checked': 4, 'completed': 1,
+                                  'failed': 1, 'authorized': 1,
+                                  'pending': 1, 'skipped': 0, 'errors': 0,
+                                  'legacy': 0, 'expired': 0})
+        expected = {'succeeded': Payment.STATE_SUCCESS,
+                    'canceled': Payment.STATE_FAIL,
+                    'waiting_for_capture': Payment.STATE_AUTHORIZED,
+                    'pending': Payment.STATE_CREATED}
+        for status, state in expected.items():
+            payments[status].refresh_from_db()
+            self.assertEqual(payments[status].state, state)
+        self.assertIsNotNone(payments['succeeded'].performed)
+        fresh.refresh_from_db()
+        self.assertEqual(fresh.state, Payment.STATE_CREATED)
+
+    def test_legacy(self):
+        """Processed payments of the HTTP protocol can't be checked, they
+        are listed and failed once too old
+        """
+        def legacy(order_id, age):
+            return Payment.objects.create(
+                order_id=order_id, order_sum=Decimal(100),
+                state=Payment.STATE_PROCESSED, invoice_id='1234',
+                performed=now() - datetime.timedelta(seconds=age))
+
+        fresh = legacy('fresh', 60)
+        waiting = legacy('waiting', 2 * 60 * 60)
+        old = legacy('old', 8 * 24 * 60 * 60)
+        with mock.patch('yandex_cash_register.sync.conf.SYNC_LEGACY_EXPIRE',
+                        0):
+            counts = sync_payments(min_age=60 * 60, client=self.client)
+        self.assertEqual((counts['legacy'], counts['expired']), (2, 0))
+        self.assertEqual(Payment.objects.get(pk=old.pk).state,
+                         Payment.STATE_PROCESSED)
+
+        counts = sync_payments(min_age=60 * 60, client=self.client,
+                               legacy_expire=7 * 24 * 60 * 60)
+        self.assertEqual((counts['checked'], counts['legacy'],
+                          counts['expired']), (0, 1, 1))
+        self.assertEqual(Payment.objects.get(pk=old.pk).state,
+                         Payment.STATE_FAIL)
+        for payment in (fresh, waiting):
+            self.assertEqual(Payment.objects.get(pk=payment.pk).state,
+                             Payment.STATE_PROCESSED)
+
+    def test_apply_status_idempotent(self):
+        payment = self._payment('succeeded')
+        self.assertEqual(apply_status(payment.pk, 'succeeded'),
+                         Payment.STATE_SUCCESS)
+        self.assertIsNone(apply_status(payment.pk, 'succeeded'))
+        self.assertIsNone(apply_status(payment.pk, 'canceled'))
+        self.assertIsNone(apply_status(payment.pk, 'pending'))
+
+    def test_apply_status_authorized(self):
+        payment = self._payment('waiting_for_capture')
+        self.assertEqual(apply_status(payment.pk, 'waiting_for_capture'),
+                         Payment.STATE_AUTHORIZED)
+        self.assertIsNone(apply_status(payment.pk, 'waiting_for_capture'))
+
+    def test_stale_payments_batches(self):
+        performed = now() - datetime.timedelta(hours=2)
+        payments = [self._payment('pending', performed=performed)
+                    for _ in range(5)]
+        rows = list(stale_payments(Payment.objects.all(), now(), 2))
+        self.assertEqual([row[0] for row in rows],
+                         sorted(payment.pk for payment in payments))
+
+    def test_create_payment_for(self):
+        payment = Payment.objects.create(order_id='abcdef',
+                                         order_sum=Decimal(100))
+        result = self.client.create_payment_for(payment)
+        payment.refresh_from_db()
+        self.assertEqual(payment.external_id, result['id'])
+
+    def test_command(self):
+        self._payment('succeeded')
+        out = StringIO()
+        with mock.patch('yandex_cash_register.sync.kassa.get_client',
+                        return_value=self.client):
+            call_command('sync_payments', '--workers=2', stdout=out)
+        self.assertIn('completed: 1', out.getvalue())
@@ -0,0 +1,136 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from decimal import Decimal
+from uuid import UUID
+
+from django.test import TestCase, RequestFactory
+
+from ..forms import PaymentProcessingForm
+from ..models import Payment
+from ..validators import NotificationValidator
+from ..views import CheckOrderView
+from .. import conf
+
+
+TEST_SHOP_ID = 12345
+
+test_conf = mock.MagicMock(SHOP_PASSWORD='123456', SHOP_ID=TEST_SHOP_ID)
+
+
+@mock.patch('yandex_cash_register.forms.conf', new=test_conf)
+@mock.patch('yandex_cash_register.validators.conf', new=test_conf)
+class NotificationValidatorTestCase(TestCase):
+    def setUp(self):
+        self.payment = Payment.objects.create(
+            order_sum=Decimal(1000.0), order_id='abcdef',
+            cps_email='test@test.com', cps_phone='79991234567',
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY,
+            customer_id=UUID('0c3c745b-8c7b-4813-8b28-c0a2b037f19c')
+        )
+
+    def _get_data(self, empty_fields=None, **kwargs):
+        data = {
+            'shopId': str(TEST_SHOP_ID), 'orderNumber': self.payment.order_id,
+            'customerNumber': str(self.payment.customer_id),
+            'paymentType': conf.PAYMENT_TYPE_YANDEX_MONEY,
+            'action': PaymentProcessingForm.ACTION_CHECK,
+            'md5': 'D3DFFF43EC59431056C6B1B63290CF63',
+            'invoiceId': '123456', 'orderSumAmount': '1000.0',
+            'orderSumCurrencyPaycash': '1',
+            'orderSumBankPaycash': '1', 'shopSumAmount': '975.3',
+            'shopSumCurrencyPaycash': '1'
+        }
+        data.update(kwargs)
+        for field in empty_fields or ():
+            del data[field]
+        return data
+
+    def _assert_same(self, data):
+        form = PaymentProcessingForm(data)
+        validator = NotificationValidator(data)
+
+        self.assertEqual(validator.is_valid(), form.is_valid(), data)
+        self.assertEqual(validator.error_code, form.error_code, data)
+        self.assertEqual(validator.error_message, form.error_message, data)
+        self.assertEqual(sorted(validator.errors.keys()),
+                         sorted(form.errors.keys()), data)
+        self.assertEqual(validator.cleaned_data, form.cleaned_data, data)
+        self.assertEqual(validator.payment_obj, form.payment_obj, data)
+        return validator
+
+    def test_correct(self):
+        validator = self._assert_same(self._get_data())
+        self.assertTrue(validator.is_valid())
+        self.assertEqual(validator.payment_obj, self.payment)
+        self.assertEqual(validator.cleaned_data['orderSumAmount'],
+                         Decimal('1000.0'))
+        self.assertIsNone(validator.cleaned_data['shopArticleId'])
+
+        self.payment.payment_type = ''
+        self.payment.save()
+        self.assertTrue(self._assert_same(self._get_data()).is_valid())
+
+    def test_same_errors_as_form(self):
+        cases = [
+            {'md5': 'A' * 32},
+            {'md5': 'A' * 31},
+            {'empty_fields': ['md5']},
+            {'orderNumber': 'asd'},
+            {'empty_fields': ['orderNumber']},
+            {'empty_fields': ['customerNumber']},
+            {'customerNumber': '-----'},
+            {'paymentType': conf.PAYMENT_TYPE_ALFA_CLICK},
+            {'shopId': str(TEST_SHOP_ID + 1)},
+            {'shopId': 'abc'},
+            {'invoiceId': '0'},
+            {'orderSumAmount': '1000.001'},
+            {'orderSumAmount': '-1'},
+            {'orderSumAmount': 'NaN'},
+            {'action': 'cancelOrder'},
+            {'orderSumAmount': '994.99',
+             'md5': 'D844D2AE1A250D356A3F46146302F0AE'},
+            {'orderSumAmount': '999.99',
+             'md5': 'DE51FC39AAFB023A4AA8984083BCAE03'},
+            {'paymentPayerCode': '1' * 34},
+            {'shopArticleId': '12'},
+        ]
+        for field in ('orderSumAmount', 'invoiceId', 'orderSumCurrencyPaycash',
+                      'orderSumBankPaycash', 'shopSumAmount',
+                      'shopSumCurrencyPaycash', 'shopId', 'action',
+                      'paymentType'):
+            cases.append({'empty_fields': [field]})
+
+        for case in cases:
+            self._assert_same(self._get_data(**case))
+
+    def test_invalid_signature_skips_database(self):
+        validator = NotificationValidator(self._get_data(md5='A' * 32))
+        with self.assertNumQueries(0):
+            self.assertFalse(validator.is_valid())
+            self.assertIsNone(validator.payment_obj)
+        self.assertEqual(validator.error_code,
+                         NotificationValidator.ERROR_CODE_MD5)
+
+    def test_unbound(self):
+        self.assertFalse(NotificationValidator().is_valid())
+
+    @mock.patch('yandex_cash_register.views.conf',
+                new=mock.MagicMock(SHOP_ID=TEST_SHOP_ID))
+    def test_view(self):
+        view = CheckOrderView.as_view(form_class=NotificationValidator)
+        response = view(RequestFactory().post('/', self._get_data()))
+
+        payment = Payment.objects.get(pk=self.payment.pk)
+        self.assertEqual(payment.state, Payment.STATE_PROCESSED)
+        self.assertEqual(payment.invoice_id, '123456')
+        self.assertIn(b'code="0"', response.content)
+
+        response = view(RequestFactory().post('/', self._get_data(
+            md5='A' * 32)))
+        self.assertIn(b'code="1"', response.content)
@@ -2,6 +2,7 @@
 from __future__ import absolute_import, unicode_literals
 
 from decimal import Decimal
+import json
 from uuid import UUID
 
 try:
@@ -9,11 +10,16 @@ try:
 except ImportError:
     import mock
 
-from django.test import TestCase, Client, override_settings
+from django.test import TestCase, TransactionTestCase, Client, \
+    override_settings
+from django.utils.timezone import now
 
+from ..cache import get_cache, get_final_redirect
 from ..forms import FinalPaymentStateForm
 from ..models import Payment
-from ..views import CheckOrderView, PaymentAvisoView, PaymentFinishView
+from ..views import CheckOrderView, PaymentAvisoView, PaymentFinishView, \
+    PaymentStatusView
+from ..validators import NotificationValidator
 from ..signals import payment_fail, payment_process, payment_success
 from .. import conf
 
@@ -29,6 +35,26 @@ payment_process.connect(process_mock)
 TEST_SHOP_ID = 12345
 
 
+def notification_conf(fast_validation=False):
+    """Class decorator patching settings used by checkOrder and paymentAviso
+    views, with ``NotificationValidator`` chosen if ``fast_validation``
+    """
+    def decorate(cls):
+        for target, new in (
+                ('forms.conf', mock.MagicMock(SHOP_PASSWORD='123456',
+                                              SHOP_ID=TEST_SHOP_ID)),
+                ('validators.conf', mock.MagicMock(SHOP_ID=TEST_SHOP_ID)),
+                ('views.conf', mock.MagicMock(
+                    SHOP_ID=TEST_SHOP_ID, FAST_VALIDATION=fast_validation))):
+            cls = mock.patch('yandex_cash_register.' + target, new=new)(cls)
+        return cls
+    return decorate
+
+
+def _json(response):
+    return json.loads(response.content.decode('utf-8'))
+
+
 class BaseClientMixin(object):
     VIEW_CLASS = NotImplemented
 
@@ -86,11 +112,7 @@ class BaseViewTestCase(BaseClientMixin):
                              getattr(self.payment, f.name))
 
 
-@mock.patch('yandex_cash_register.forms.conf',
-            new=mock.MagicMock(SHOP_PASSWORD='123456', SHOP_ID=TEST_SHOP_ID))
-@mock.patch('yandex_cash_register.views.conf',
-            new=mock.MagicMock(SHOP_ID=TEST_SHOP_ID))
-class CheckOrderViewTestCase(BaseViewTestCase, TestCase):
+class CheckOrderViewTests(BaseViewTestCase):
     VIEW_CLASS = CheckOrderView
     ACTION = CheckOrderView.accepted_action
     INVOICE_ID = '123456'
@@ -201,15 +223,16 @@ class CheckOrderViewTestCase(BaseViewTestCase, TestCase):
         self._check_signals(1, 0, 0)
 
     def test_invalid_form(self):
-        """Invalid checkOrder request fails payment and returns error response
+        """checkOrder request with wrong signature returns error response
+        without touching the payment
         """
         response = self._req(self._get_data(md5='A' * 32))
 
         payment = Payment.objects.get(pk=self.payment.id)
 
-        self.assertIsNotNone(payment.completed)
-        self.assertTrue(payment.is_completed)
-        self.assertFalse(payment.is_payed)
+        self.assertEqual(payment.state, Payment.STATE_CREATED)
+        self.assertIsNone(payment.completed)
+        self.assertFalse(payment.is_completed)
 
         expected_content = '<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n' \
                            '<checkOrderResponse code="1" ' \
@@ -217,7 +240,7 @@ class CheckOrderViewTestCase(BaseViewTestCase, TestCase):
         self.assertEqual(response.content, expected_content.encode('utf-8'))
 
         # Проверяем что отправились правильные сигналы
-        self._check_signals(0, 0, 1)
+        self._check_signals(0, 0, 0)
 
     def test_wrong_action_in_process(self):
         """Invalid checkOrder request fails payment and returns error response
@@ -291,11 +314,7 @@ class CheckOrderViewTestCase(BaseViewTestCase, TestCase):
         self._check_signals(1, 1, 0)
 
 
-@mock.patch('yandex_cash_register.forms.conf',
-            new=mock.MagicMock(SHOP_PASSWORD='123456', SHOP_ID=TEST_SHOP_ID))
-@mock.patch('yandex_cash_register.views.conf',
-            new=mock.MagicMock(SHOP_ID=TEST_SHOP_ID))
-class PaymentAvisoViewTestCase(BaseViewTestCase, TestCase):
+class PaymentAvisoViewTests(BaseViewTestCase):
     VIEW_CLASS = PaymentAvisoView
     ACTION = PaymentAvisoView.accepted_action
     INVOICE_ID = '123456'
@@ -379,18 +398,19 @@ class PaymentAvisoViewTestCase(BaseViewTestCase, TestCase):
         self._test_already_completed(Payment.STATE_SUCCESS)
 
     def test_double_fail(self):
-        self.test_invalid_form()
+        self.test_wrong_action_in_process()
         fail_mock.reset_mock()
 
         self._test_already_completed(Payment.STATE_FAIL)
 
     def test_invalid_form(self):
-        """Invalid PaymentAviso request fails payment"""
+        """PaymentAviso request with wrong signature doesn't change payment"""
         response = self._req(self._get_data(md5='A' * 32))
 
         payment = Payment.objects.get(pk=self.payment.id)
 
-        self.assertTrue(payment.completed)
+        self.assertEqual(payment.state, Payment.STATE_PROCESSED)
+        self.assertIsNone(payment.completed)
         self.assertFalse(payment.is_payed)
 
         expected_content = '<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n' \
@@ -399,7 +419,7 @@ class PaymentAvisoViewTestCase(BaseViewTestCase, TestCase):
         self.assertEqual(response.content, expected_content.encode('utf-8'))
 
         # Проверяем что отправились правильные сигналы
-        self._check_signals(0, 0, 1)
+        self._check_signals(0, 0, 0)
 
     def test_wrong_action_in_process(self):
         """PaymentAviso request with wrong action fails payment"""
@@ -422,6 +442,28 @@ class PaymentAvisoViewTestCase(BaseViewTestCase, TestCase):
         self._check_signals(0, 0, 1)
 
 
+@notification_conf()
+class CheckOrderViewTestCase(CheckOrderViewTests, TestCase):
+    pass
+
+
+@notification_conf(fast_validation=True)
+class FastCheckOrderViewTestCase(CheckOrderViewTests, TestCase):
+    def test_form_class(self):
+        self.assertIs(CheckOrderView().get_form_class(),
+                      NotificationValidator)
+
+
+@notification_conf()
+class PaymentAvisoViewTestCase(PaymentAvisoViewTests, TestCase):
+    pass
+
+
+@notification_conf(fast_validation=True)
+class FastPaymentAvisoViewTestCase(PaymentAvisoViewTests, TestCase):
+    pass
+
+
 class PaymentFinishViewTestCase(BaseClientMixin, TestCase):
     ACTION_SUCCESS = FinalPaymentStateForm.ACTION_CONFIRM
     ACTION_FAIL = FinalPaymentStateForm.ACTION_FAIL
@@ -437,6 +479,7 @@ class PaymentFinishViewTestCase(BaseClientMixin, TestCase):
             payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY,
             customer_id=UUID('0c3c745b-8c7b-4813-8b28-c0a2b037f19c')
         )
+        get_cache().clear()
         success_mock.reset_mock()
         fail_mock.reset_mock()
         process_mock.reset_mock()
@@ -713,6 +756,35 @@ class PaymentFinishViewTestCase(BaseClientMixin, TestCase):
         # Проверяем что отправились правильные сигналы
         self._check_signals(0, 0, 0)
 
+    @mock.patch('yandex_cash_register.views.apps')
+    def test_failreq_authorized(self, m_apps):
+        """Fail request doesn't fail an authorized payment: the money stays
+        held until the hold is captured or cancelled
+        """
+        m_order = mock.MagicMock()
+        m_order.get_payment_complete_url.return_value = '/success/'
+        m_model = mock.MagicMock()
+        m_model.get_by_order_id.return_value = m_order
+        m_apps.get_model.return_value = m_model
+
+        self.payment.process()
+        self.payment.authorize()
+        process_mock.reset_mock()
+
+        response = self._req(self._get_data(cr_action=self.ACTION_FAIL),
+                             code=302)
+        if response['Location'].startswith('http://testserver'):
+            response['Location'] = response['Location'][17:]
+        self.assertEqual(response['Location'], '/success/')
+        m_order.get_payment_complete_url.assert_called_once_with(True)
+
+        payment = Payment.objects.get(pk=self.payment.id)
+        self.assertEqual(payment.state, Payment.STATE_AUTHORIZED)
+        self.assertIsNone(get_final_redirect(payment.order_id))
+
+        # Проверяем что отправились правильные сигналы
+        self._check_signals(0, 0, 0)
+
     @mock.patch('yandex_cash_register.views.apps')
     def test_successrec_already_fail(self, m_apps):
         """Success request is valid if payment is failed. Payment state
@@ -789,3 +861,164 @@ class PaymentFinishViewTestCase(BaseClientMixin, TestCase):
 
         # Проверяем что отправились правильные сигналы
         self._check_signals(0, 0, 0)
+
+    @mock.patch('yandex_cash_register.views.apps')
+    def test_completed_served_from_cache(self, m_apps):
+        """Repeated requests for a paid payment don't touch the database
+        or the order model
+        """
+        m_order = mock.MagicMock()
+        m_order.get_absolute_url.return_value = '/order/url/'
+        m_model = mock.MagicMock()
+        m_model.get_by_order_id.return_value = m_order
+        m_apps.get_model.return_value = m_model
+
+        self.payment.process()
+        self.payment.complete()
+
+        self._req(self._get_data(), code=302)
+        self.assertEqual(m_model.get_by_order_id.call_count, 1)
+
+        for data in (self._get_data(),
+                     self._get_data(cr_action=self.ACTION_FAIL),
+                     self._get_data(empty_fields=['cr_action'])):
+            with self.assertNumQueries(0):
+                response = self._req(data, code=302)
+            self.assertTrue(response['Location'].endswith('/order/url/'))
+        self.assertEqual(m_model.get_by_order_id.call_count, 1)
+
+    @mock.patch('yandex_cash_register.views.apps')
+    def test_cache_invalidated_on_state_change(self, m_apps):
+        """Cached response is dropped when state of a completed payment is
+        changed
+        """
+        m_order = mock.MagicMock()
+        m_order.get_absolute_url.return_value = '/order/url/'
+        m_model = mock.MagicMock()
+        m_model.get_by_order_id.return_value = m_order
+        m_apps.get_model.return_value = m_model
+
+        self.payment.process()
+        self.payment.complete()
+        self._req(self._get_data(), code=302)
+
+        payment = Payment.objects.get(pk=self.payment.pk)
+        payment.state = Payment.STATE_FAIL
+        payment.save()
+
+        self._req(self._get_data(), code=302)
+        self.assertEqual(m_model.get_by_order_id.call_count, 2)
+
+    @mock.patch('yandex_cash_register.views.apps')
+    def test_failed_not_cached(self, m_apps):
+        """A failed payment may still succeed, so it is read every time"""
+        m_order = m_apps.get_model.return_value.get_by_order_id.return_value
+        m_order.get_absolute_url.return_value = '/order/url/'
+
+        self.payment.process()
+        self.payment.fail()
+        self._req(self._get_data(), code=302)
+        self.assertIsNone(get_final_redirect(self.payment.order_id))
+
+        # Late paymentAviso
+        Payment.objects.get(pk=self.payment.pk).complete()
+        self._req(self._get_data(), code=302)
+        self.assertEqual(get_final_redirect(self.payment.order_id)[0],
+                         Payment.STATE_SUCCESS)
+
+
+class PaymentStatusViewTestCase(BaseClientMixin, TestCase):
+    VIEW_CLASS = PaymentStatusView
+
+    def _get_url(self):
+        return '/{}/status/?order_id={}&customer_id={}'.format(
+            conf.LOCAL_URL, self.payment.order_id, self.customer_id)
+
+    def setUp(self):
+        self.payment = Payment.objects.create(
+            order_sum=Decimal(1000.0), order_id='abcdef',
+            cps_email='test@test.com', cps_phone='79991234567',
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY,
+            customer_id=UUID('0c3c745b-8c7b-4813-8b28-c0a2b037f19c')
+        )
+        self.customer_id = self.payment.customer_id
+        get_cache().clear()
+
+    def test_status(self):
+        """Status is read from database once and then served from cache"""
+        response = self._req()
+        self.assertEqual(_json(response)['state'], Payment.STATE_CREATED)
+        self.assertFalse(_json(response)['is_completed'])
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+
+        with self.assertNumQueries(0):
+            self._req()
+
+    def test_unknown_customer(self):
+        """Wrong customer ID is treated as a missing payment"""
+        self.customer_id = '0c3c745b-8c7b-4813-8b28-c0a2b037f19d'
+        self._req(code=404)
+        self.customer_id = 'not-an-uuid'
+        self._req(code=404)
+
+    def test_unknown_order(self):
+        self.payment.order_id = 'unknown'
+        self._req(code=404)
+
+    def test_not_modified(self):
+        """Conditional requests get 304 until state changes"""
+        response = self._req()
+
+        self._req(headers={'HTTP_IF_NONE_MATCH': response['ETag']},
+                  code=304)
+        self._req(headers={'HTTP_IF_MODIFIED_SINCE':
+                           response['Last-Modified']}, code=304)
+
+        self.payment.process()
+        # Transitions write through to cache only on commit, which never
+        # happens inside a test case
+        get_cache().clear()
+        response = self._req(headers={'HTTP_IF_NONE_MATCH':
+                                      response['ETag']})
+        self.assertEqual(_json(response)['state'], Payment.STATE_PROCESSED)
+
+
+class PaymentStatusWriteThroughTestCase(TransactionTestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    def test_transitions_update_cache(self):
+        payment = Payment.objects.create(
+            order_sum=Decimal(1000.0), order_id='abcdef',
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY,
+        )
+        url = '/{}/status/?order_id={}&customer_id={}'.format(
+            conf.LOCAL_URL, payment.order_id, payment.customer_id)
+
+        for transition, state in ((payment.process, Payment.STATE_PROCESSED),
+                                  (payment.complete, Payment.STATE_SUCCESS)):
+            transition()
+            with self.assertNumQueries(0):
+                response = Client().get(url)
+            self.assertEqual(_json(response)['state'], state)
+
+    def test_save_updates_cache(self):
+        """Saves other than transitions, e.g. in the admin, replace the
+        cached status too
+        """
+        payment = Payment.objects.create(
+            order_sum=Decimal(1000.0), order_id='abcdef',
+            payment_type=conf.PAYMENT_TYPE_YANDEX_MONEY,
+        )
+        url = '/{}/status/?order_id={}&customer_id={}'.format(
+            conf.LOCAL_URL, payment.order_id, payment.customer_id)
+        etag = Client().get(url)['ETag']
+
+        payment.state = Payment.STATE_FAIL
+        payment.completed = now()
+        payment.save()
+        with self.assertNumQueries(0):
+            response = Client().get(url)
+        self.assertEqual(_json(response)['state'], Payment.STATE_FAIL)
+        self.assertNotEqual(response['ETag'], etag)
@@ -0,0 +1,23 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.test import SimpleTestCase
+
+from .. import warmup
+
+
+class WarmUpTestCase(SimpleTestCase):
+    def test_warm_up(self):
+        with mock.patch.object(warmup.logger, 'warning') as warning:
+            timings = warmup.warm_up()
+        self.assertEqual(sorted(timings),
+                         sorted(name for name, _ in warmup.STEPS))
+        # The order model of the test settings doesn't exist, the other
+        # steps still run
+        self.assertEqual(warning.call_count, 1)
+        self.assertEqual(warning.call_args[0][1], 'order_model')
@@ -0,0 +1,216 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+from decimal import Decimal
+import json
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.conf import settings
+from django.test import Client, SimpleTestCase, TestCase, RequestFactory
+from django.utils.timezone import make_naive, utc
+
+from ..models import Payment
+from .. import conf, webhooks
+from .test_views import fail_mock, process_mock, success_mock
+
+
+KASSA_IP = '185.71.76.10'
+
+
+def make_object(payment_id='2419a771-000f-5000-9000-1edaf29243f2',
+                status='succeeded', order_id='abcdef', **kwargs):
+    obj = {
+        'id': payment_id,
+        'status': status,
+        'paid': status == 'succeeded',
+        'amount': {'value': '1000.00', 'currency': 'RUB'},
+        'income_amount': {'value': '975.30', 'currency': 'RUB'},
+        'payment_method': {'type': 'bank_card', 'id': payment_id},
+        'metadata': {'orderNumber': order_id} if order_id else {},
+    }
+    obj.update(kwargs)
+    return obj
+
+
+class WebhookViewTestCase(TestCase):
+    def setUp(self):
+        self.payment = Payment.objects.create(
+            order_id='abcdef', order_sum=Decimal(1000),
+            external_id=make_object()['id'])
+        self.client = Client(REMOTE_ADDR=KASSA_IP)
+        for signal_mock in (success_mock, fail_mock, process_mock):
+            signal_mock.reset_mock()
+
+    def _post(self, event, obj, code=200, **extra):
+        response = self.client.post(
+            '/{}/webhook/'.format(conf.LOCAL_URL),
+            json.dumps({'type': 'notification', 'event': event,
+                        'object': obj}),
+            content_type='application/json', **extra)
+        self.assertEqual(response.status_code, code)
+        return response
+
+    def test_succeeded(self):
+        self._post('payment.succeeded', make_object())
+        payment = Payment.objects.get(pk=self.payment.pk)
+        self.assertEqual(payment.state, Payment.STATE_SUCCESS)
+        self.assertEqual(payment.external_id, make_object()['id'])
+        self.assertEqual(payment.shop_sum, Decimal('975.30'))
+        self.assertEqual(payment.payment_type, conf.PAYMENT_TYPE_CARD)
+        self.assertIsNotNone(payment.performed)
+        self.assertEqual(process_mock.call_count, 1)
+        self.assertEqual(success_mock.call_count, 1)
+
+        # Repeated notification changes nothing
+        self._post('payment.succeeded', make_object())
+        self.assertEqual(success_mock.call_count, 1)
+
+    def test_canceled(self):
+        self._post('payment.canceled', make_object(status='canceled'))
+        payment = Payment.objects.get(pk=self.payment.pk)
+        self.assertEqual(payment.state, Payment.STATE_FAIL)
+        self.assertEqual(fail_mock.call_count, 1)
+
+        # Money taken after all wins over the local fail
+        self._post('payment.succeeded', make_object())
+        self._post('payment.canceled', make_object(status='canceled'))
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).state,
+                         Payment.STATE_SUCCESS)
+
+    def test_found_by_external_id(self):
+        Payment.objects.filter(pk=self.payment.pk).update(external_id='ext')
+        self._post('payment.succeeded',
+                   make_object(payment_id='ext', order_id=None))
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).state,
+                         Payment.STATE_SUCCESS)
+
+    def test_wrong_payment(self):
+        Payment.objects.filter(pk=self.payment.pk).update(external_id='ext')
+        self._post('payment.succeeded', make_object(), code=400)
+        self._post('payment.succeeded', make_object(order_id='unknown'),
+                   code=404)
+        self._post('payment.succeeded',
+                   make_object(payment_id='other', order_id=None), code=404)
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).state,
+                         Payment.STATE_CREATED)
+
+    def test_external_id_not_stored(self):
+        Payment.objects.filter(pk=self.payment.pk).update(external_id=None)
+        self._post('payment.succeeded', make_object(), code=400)
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).state,
+                         Payment.STATE_CREATED)
+
+    def test_wrong_amount(self):
+        for amount in ({'value': '1.00', 'currency': 'RUB'},
+                       {'value': '1000.00', 'currency': 'USD'},
+                       {'value': '1000.01', 'currency': 'RUB'},
+                       {'value': 'junk', 'currency': 'RUB'}, None):
+            self._post('payment.succeeded', make_object(amount=amount),
+                       code=400)
+            self._post('payment.waiting_for_capture',
+                       make_object(status='waiting_for_capture',
+                                   amount=amount), code=400)
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).state,
+                         Payment.STATE_CREATED)
+        self.assertEqual(success_mock.call_count, 0)
+
+    def test_partial_capture(self):
+        self._post('payment.waiting_for_capture',
+                   make_object(status='waiting_for_capture'))
+        self._post('payment.succeeded',
+                   make_object(amount={'value': '1.00', 'currency': 'USD'}),
+                   code=400)
+        self._post('payment.succeeded',
+                   make_object(amount={'value': '400.00', 'currency': 'RUB'}))
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).state,
+                         Payment.STATE_SUCCESS)
+
+    def test_forbidden_address(self):
+        with self.assertNumQueries(0):
+            self._post('payment.succeeded', make_object(), code=403,
+                       REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).state,
+                         Payment.STATE_CREATED)
+
+    def test_bad_request(self):
+        response = self.client.post('/{}/webhook/'.format(conf.LOCAL_URL),
+                                    '{"event":',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self._post('payment.succeeded', {'status': 'succeeded'}, code=400)
+
+    def test_waiting_for_capture(self):
+        obj = make_object(status='waiting_for_capture',
+                          expires_at='2017-11-10T05:54:42.563Z')
+        self._post('payment.waiting_for_capture', obj)
+        payment = Payment.objects.get(pk=self.payment.pk)
+        self.assertEqual(payment.state, Payment.STATE_AUTHORIZED)
+        expires = datetime.datetime(2017, 11, 10, 5, 54, 42, 563000, utc)
+        if not settings.USE_TZ:
+            expires = make_naive(expires)
+        self.assertEqual(payment.hold_expires, expires)
+        self.assertEqual(process_mock.call_count, 1)
+        self.assertEqual(success_mock.call_count, 0)
+        self._post('payment.waiting_for_capture', obj)
+
+        # Captured in the dashboard
+        self._post('payment.succeeded', make_object())
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).state,
+                         Payment.STATE_SUCCESS)
+        self.assertEqual(success_mock.call_count, 1)
+
+    def test_other_events(self):
+        self._post('payment.pending', make_object())
+        self._post('refund.succeeded', {'id': 'refund',
+                                        'payment_id': 'payment'}, code=404)
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).state,
+                         Payment.STATE_CREATED)
+
+    def test_get(self):
+        response = self.client.get('/{}/webhook/'.format(conf.LOCAL_URL))
+        self.assertEqual(response.status_code, 405)
+
+
+class SourceCheckTestCase(SimpleTestCase):
+    def _request(self, **meta):
+        return RequestFactory().post('/', **meta)
+
+    def test_allowed(self):
+        for address in ('185.71.76.1', '77.75.156.11', '2a02:5180::1'):
+            self.assertTrue(webhooks.is_allowed(
+                self._request(REMOTE_ADDR=address)), address)
+        for address in ('185.71.76.32', '77.75.156.12', '', 'junk'):
+            self.assertFalse(webhooks.is_allowed(
+                self._request(REMOTE_ADDR=address)), address)
+
+    def test_proxy_header(self):
+        request = self._request(REMOTE_ADDR='127.0.0.1',
+                                HTTP_X_FORWARDED_FOR='10.0.0.1, 185.71.76.1')
+        self.assertFalse(webhooks.is_allowed(request))
+        with mock.patch('yandex_cash_register.webhooks.conf'
+                        '.WEBHOOK_IP_HEADER', 'HTTP_X_FORWARDED_FOR'):
+            self.assertTrue(webhooks.is_allowed(request))
+
+    def test_disabled(self):
+        with mock.patch('yandex_cash_register.webhooks.conf'
+                        '.WEBHOOK_ALLOWED_IPS', None):
+            self.assertTrue(webhooks.is_allowed(
+                self._request(REMOTE_ADDR='10.0.0.1')))
+        with mock.patch('yandex_cash_register.webhooks.conf'
+                        '.WEBHOOK_ALLOWED_IPS', ['10.0.0.0/8']):
+            self.assertTrue(webhooks.is_allowed(
+                self._request(REMOTE_ADDR='10.0.0.1')))
+
+    def test_loads(self):
+        body = json.dumps({'event': 'payment.succeeded'}).encode('utf-8')
+        self.assertEqual(webhooks.loads(body), {'event': 'payment.succeeded'})
+        with mock.patch('yandex_cash_register.webhooks.fast_json', None):
+            self.assertEqual(webhooks.loads(body),
+                             {'event': 'payment.succeeded'})
+            with self.assertRaises(ValueError):
+                webhooks.loads(b'{')
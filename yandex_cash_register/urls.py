@@ -3,13 +3,28 @@ from __future__ import absolute_import, unicode_literals
 
 from django.conf.urls import url
 
-from . import views
+from . import conf, views
 
 urlpatterns = [
     url(r'^order-check/$', views.CheckOrderView.as_view(),
         name='money_check_order'),
     url(r'^payment-aviso/$', views.PaymentAvisoView.as_view(),
         name='money_payment_aviso'),
+    url(r'^webhook/$', views.WebhookView.as_view(),
+        name='money_webhook'),
     url(r'^finish/$', views.PaymentFinishView.as_view(),
         name='money_payment_finish'),
+    url(r'^status/$', views.PaymentStatusView.as_view(),
+        name='money_payment_status'),
 ]
+
+if conf.WAIT:
+    urlpatterns.append(
+        url(r'^wait/$', views.PaymentWaitView.as_view(),
+            name='money_payment_wait')
+    )
+
+if conf.METRICS:
+    urlpatterns.append(
+        url(r'^metrics/$', views.MetricsView.as_view(), name='money_metrics')
+    )
@@ -0,0 +1,204 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal, InvalidOperation
+import re
+
+from django.utils import six
+from django.utils.crypto import constant_time_compare
+from django.utils.translation import ugettext as _
+
+from .forms import NotificationErrorsMixin, PaymentLookupMixin, \
+    PaymentProcessingForm, make_md5
+from . import conf
+
+
+REQUIRED = 'This field is required.'
+
+_integer_tail = re.compile(r'\.0*$')
+
+
+class Invalid(Exception):
+    pass
+
+
+def string(min_length=None, max_length=None):
+    def convert(value):
+        if min_length is not None and len(value) < min_length:
+            raise Invalid('Ensure this value has at least {} characters.'
+                          .format(min_length))
+        if max_length is not None and len(value) > max_length:
+            raise Invalid('Ensure this value has at most {} characters.'
+                          .format(max_length))
+        return value
+    return convert
+
+
+def integer(min_value=None):
+    def convert(value):
+        try:
+            value = int(_integer_tail.sub('', value))
+        except ValueError:
+            raise Invalid('Enter a whole number.')
+        if min_value is not None and value < min_value:
+            raise Invalid('Ensure this value is greater than or equal to {}.'
+                          .format(min_value))
+        return value
+    return convert
+
+
+def decimal(min_value=None, decimal_places=None):
+    def convert(value):
+        try:
+            value = Decimal(value)
+        except (InvalidOperation, ValueError):
+            raise Invalid('Enter a number.')
+        if not value.is_finite():
+            raise Invalid('Enter a number.')
+        if min_value is not None and value < min_value:
+            raise Invalid('Ensure this value is greater than or equal to {}.'
+                          .format(min_value))
+        if decimal_places is not None and \
+                -value.as_tuple().exponent > decimal_places:
+            raise Invalid('Ensure that there are no more than {} decimal '
+                          'places.'.format(decimal_places))
+        return value
+    return convert
+
+
+def choice(choices):
+    choices = frozenset(choices)
+
+    def convert(value):
+        if value not in choices:
+            raise Invalid('Select a valid choice. {} is not one of the '
+                          'available choices.'.format(value))
+        return value
+    return convert
+
+
+def compile_schema(fields):
+    """Turn field declarations into a tuple of ``(name, converter, required,
+    empty value)`` ready to be applied to request data
+
+    :param fields: iterable of ``(name, converter)`` or
+        ``(name, converter, empty value)`` for optional fields
+    """
+    schema = []
+    for field in fields:
+        if len(field) == 2:
+            schema.append((field[0], field[1], True, None))
+        else:
+            schema.append((field[0], field[1], False, field[2]))
+    return tuple(schema)
+
+
+class NotificationValidator(NotificationErrorsMixin, PaymentLookupMixin):
+    """Validates checkOrder and paymentAviso notifications just like
+    ``PaymentProcessingForm`` does, producing the same error codes and
+    messages, but without the forms machinery. Views accept it as their
+    ``form_class``
+    """
+    order_number_field = 'orderNumber'
+
+    MD5_KEY_ORDER = PaymentProcessingForm.MD5_KEY_ORDER
+    ACTION_CHECK = PaymentProcessingForm.ACTION_CHECK
+    ACTION_CPAYMENT = PaymentProcessingForm.ACTION_CPAYMENT
+
+    schema = compile_schema((
+        ('shopId', integer()),
+        ('orderNumber', string(1, 64)),
+        ('customerNumber', string(1, 64)),
+        ('paymentType', string(2, 2)),
+        ('md5', string(32, 32)),
+        ('invoiceId', integer(min_value=1)),
+        ('orderSumAmount', decimal(min_value=0, decimal_places=2)),
+        ('orderSumCurrencyPaycash', integer()),
+        ('orderSumBankPaycash', integer()),
+        ('shopSumAmount', decimal(min_value=0, decimal_places=2)),
+        ('shopSumCurrencyPaycash', integer()),
+        ('shopArticleId', integer(), None),
+        ('paymentPayerCode', string(max_length=33), ''),
+        ('action', choice((ACTION_CHECK, ACTION_CPAYMENT))),
+    ))
+
+    def __init__(self, data=None, files=None, **kwargs):
+        self.data = data
+        self.cleaned_data = {}
+        self._errors = None
+        self._signature_verified = False
+
+    def can_access_payment(self):
+        return self._signature_verified
+
+    @property
+    def errors(self):
+        if self._errors is None:
+            self._errors = {}
+            self._clean()
+        return self._errors
+
+    def is_valid(self):
+        return self.data is not None and not self.errors
+
+    def _add_error(self, name, message):
+        self._errors.setdefault(name, []).append(message)
+        self.cleaned_data.pop(name, None)
+
+    def _clean_fields(self):
+        data = self.data
+        cleaned = self.cleaned_data
+        for name, convert, required, empty in self.schema:
+            value = data.get(name)
+            if value is not None:
+                if not isinstance(value, six.string_types):
+                    value = six.text_type(value)
+                value = value.strip()
+            if not value:
+                if required:
+                    self._errors[name] = [REQUIRED]
+                else:
+                    cleaned[name] = empty
+                continue
+            try:
+                cleaned[name] = convert(value)
+            except Invalid as e:
+                self._errors[name] = [e.args[0]]
+
+    def _clean(self):
+        if self.data is None:
+            return
+        self._clean_fields()
+        cleaned = self.cleaned_data
+        if 'shopId' in cleaned and cleaned['shopId'] != int(conf.SHOP_ID):
+            self._add_error('shopId', 'Unknown shop ID')
+        if self._errors:
+            return self._set_field_error()
+
+        if not constant_time_compare(make_md5(cleaned, self.MD5_KEY_ORDER),
+                                     cleaned['md5']):
+            self.set_error(self.ERROR_CODE_MD5, _('MD5 is incorrect'))
+            self._errors['__all__'] = [self.error_message]
+            return
+
+        self._signature_verified = True
+        payment = self.payment_obj
+        if payment is None:
+            self._add_error('orderNumber',
+                            'Cannot find payment with order ID {}'
+                            .format(cleaned['orderNumber']))
+            return self._set_field_error()
+        if cleaned['customerNumber'] != str(payment.customer_id):
+            self._add_error('customerNumber', 'Unknown customer ID')
+        if payment.payment_type and \
+                cleaned['paymentType'] != str(payment.payment_type):
+            self._add_error('paymentType',
+                            'Unknown or unsupported payment method')
+        if self._errors:
+            return self._set_field_error()
+
+        if self._round(payment.order_sum) != \
+                self._round(cleaned['orderSumAmount']):
+            self.set_error(self.ERROR_CODE_UNKNOWN_ORDER,
+                           _("Sum doesn't match"))
+            self._errors['__all__'] = [self.error_message]
@@ -4,43 +4,92 @@ from __future__ import absolute_import, unicode_literals
 from decimal import Decimal
 
 from collections import OrderedDict
+from contextlib import contextmanager
 import logging
+import time
+from uuid import UUID
 
 from django.apps import apps
 from django.conf import settings
 from django.db import transaction
 from django.shortcuts import redirect
-from django.http import HttpResponse, HttpResponseNotAllowed
+from django.http import HttpResponse, HttpResponseNotAllowed, \
+    HttpResponseNotModified, JsonResponse
+from django.utils.cache import patch_cache_control
+from django.utils.crypto import constant_time_compare
 from django.utils.decorators import method_decorator
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
 from django.utils.timezone import now
 from django.views.decorators.csrf import csrf_exempt
-from django.views.generic import FormView
+from django.views.generic import FormView, View
 from lxml import etree
 from lxml.builder import E
 
-from .forms import PaymentProcessingForm, FinalPaymentStateForm
+from .forms import PaymentProcessingForm, FinalPaymentStateForm, \
+    get_locked_payment
 from .models import Payment
-from . import conf
+from .validators import NotificationValidator
+from . import cache, conf, journal, kassa, logs, metrics, pubsub, routers, \
+    webhooks
 
 
 logger = logging.getLogger(__name__)
 
 
+@contextmanager
+def locked_transaction(source, using=None):
+    """Transaction in which payment rows get locked and changed. Keep
+    everything that doesn't need the lock (parsing, logging, building
+    responses) out of it
+
+    :param source: name of the caller, used to label lock hold metrics
+    :param using: database alias, see ``PaymentLookupMixin.payment_db``
+    """
+    with metrics.registry.timer(metrics.LOCK_HOLD, source=source):
+        with transaction.atomic(using=using):
+            yield
+
+
 class BaseFormView(FormView):
-    form_class = PaymentProcessingForm
+    # Chosen by YANDEX_CR_FAST_VALIDATION unless set, see get_form_class()
+    form_class = None
     accepted_action = None
 
+    response_code = None
+    order_id = None
+
     @method_decorator(csrf_exempt)
-    @method_decorator(transaction.atomic)
     def dispatch(self, request, *args, **kwargs):
-        return super(BaseFormView, self).dispatch(request, *args, **kwargs)
+        started = time.time()
+        with metrics.registry.timer(metrics.REQUEST_DURATION,
+                                    view=self.__class__.__name__), \
+                routers.pin_primary():
+            response = super(BaseFormView, self).dispatch(request, *args,
+                                                          **kwargs)
+        if request.method == 'POST':
+            journal.record_notification(request, response,
+                                        time.time() - started,
+                                        self.response_code)
+        return response
 
     def get(self, request, *args, **kwargs):
         return HttpResponseNotAllowed(['POST'])
 
+    def get_form_class(self):
+        if self.form_class is not None:
+            return self.form_class
+        # NotificationValidator gives the same results at a fraction of the
+        # cost
+        if conf.FAST_VALIDATION:
+            return NotificationValidator
+        return PaymentProcessingForm
+
     def get_response(self, params):
         if 'code' not in params:
             params['code'] = 0
+        self.response_code = params['code']
+        metrics.registry.inc(metrics.RESPONSES, view=self.__class__.__name__,
+                             code=params['code'])
 
         for key in params:
             try:
@@ -53,24 +102,39 @@ class BaseFormView(FormView):
             content.attrib[key] = value
         data = etree.tostring(content, xml_declaration=True, encoding='UTF-8',
                               method='xml')
-        logger.info('Response: %r', data)
+        logger.info('Response: %r', data, extra=self.log_extra(
+            logs.OUTCOME_SUCCESS if str(self.response_code) == '0'
+            else logs.OUTCOME_ERROR))
         return HttpResponse(data, content_type='application/xml')
 
+    def log_extra(self, outcome):
+        """Structured fields of log records about the current notification,
+        see ``yandex_cash_register.logs``
+        """
+        return {'view': self.__class__.__name__, 'order_id': self.order_id,
+                'outcome': outcome}
+
     def form_invalid(self, form):
         """
         :type form: yandex_cash_register.forms.PaymentProcessingForm
         """
-        logger.info('Error when validating payment form')
-        logger.info('Form data: %s', dict(form.cleaned_data))
+        self.order_id = form.cleaned_data.get('orderNumber', self.order_id)
+        # Arguments are formatted lazily, possibly by the log listener thread
+        extra = self.log_extra(logs.OUTCOME_ERROR)
+        logger.info('Error when validating payment form, data: %s',
+                    form.cleaned_data, extra=extra)
         if form.errors:
-            logger.info('%s', dict(form.errors))
+            logger.info('%s', dict(form.errors), extra=extra)
 
         # Устанавливаем статус в FAIL
         payment = form.payment_obj
-        if payment is not None:
+        if payment is not None and not payment.is_completed:
             try:
-                if not payment.is_completed:
-                    payment.fail()
+                with locked_transaction(self.__class__.__name__,
+                                        form.payment_db()):
+                    payment = form.lock_payment()
+                    if payment is not None and not payment.is_completed:
+                        payment.fail()
             except Exception:
                 logger.exception('Error when saving payment form')
 
@@ -83,8 +147,10 @@ class BaseFormView(FormView):
         """
         :type form: yandex_cash_register.forms.PaymentProcessingForm
         """
-        logger.info('Payment form validated correctly')
-        logger.info('Form data: %s', dict(form.cleaned_data))
+        self.order_id = form.cleaned_data.get('orderNumber')
+        logger.info('Payment form validated correctly, data: %s',
+                    form.cleaned_data,
+                    extra=self.log_extra(logs.OUTCOME_SUCCESS))
 
         action = form.cleaned_data['action']
         if action != self.accepted_action:
@@ -94,13 +160,16 @@ class BaseFormView(FormView):
 
         order_num = form.cleaned_data['customerNumber']
 
-        payment = form.payment_obj
         try:
-            if payment.is_completed:
-                raise RuntimeError('Payment is already completed')
-            self.process(payment, form.cleaned_data)
+            with locked_transaction(self.__class__.__name__,
+                                    form.payment_db()):
+                payment = form.lock_payment()
+                if payment.is_completed:
+                    raise RuntimeError('Payment is already completed')
+                self.process(payment, form.cleaned_data)
 
-            logger.info('Successful request to payment #%s', payment.order_id)
+            logger.info('Successful request to payment #%s', payment.order_id,
+                        extra=self.log_extra(logs.OUTCOME_SUCCESS))
 
             # Key order is important, they say
             response_dict = OrderedDict()
@@ -114,8 +183,9 @@ class BaseFormView(FormView):
             response_dict['invoiceId'] = payment.invoice_id
             response_dict['shopId'] = conf.SHOP_ID
         except Exception:
-            msg = 'Error when processing payment #%s' % order_num
-            logger.warn(msg, exc_info=True)
+            logger.warn('Error when processing payment #%s', order_num,
+                        exc_info=True,
+                        extra=self.log_extra(logs.OUTCOME_ERROR))
             form.set_error(PaymentProcessingForm.ERROR_CODE_INTERNAL,
                            'Ошибка обработки заказа')
             return self.form_invalid(form)
@@ -138,7 +208,8 @@ class CheckOrderView(BaseFormView):
         :type payment: yandex_cash_register.models.Payment
         :type data: dict[str]
         """
-        logger.info('Request to check payment #%s', payment.order_id)
+        logger.info('Request to check payment #%s', payment.order_id,
+                    extra=self.log_extra(logs.OUTCOME_SUCCESS))
         if payment.state in (Payment.STATE_CREATED, Payment.STATE_PROCESSED,):
             payment.payer_code = data.get('paymentPayerCode', '')
             payment.order_currency = data['orderSumCurrencyPaycash']
@@ -161,20 +232,174 @@ class PaymentAvisoView(BaseFormView):
         :type payment: yandex_cash_register.models.Payment
         :type data: dict[str]
         """
-        logger.info('Request to confirm payment #%s', payment.order_id)
+        logger.info('Request to confirm payment #%s', payment.order_id,
+                    extra=self.log_extra(logs.OUTCOME_SUCCESS))
         if payment.state != Payment.STATE_SUCCESS:
             payment.complete()
 
 
+class WebhookView(View):
+    """Notifications of the Yandex.Kassa REST API (protocol v3).
+
+    The sender address is checked and the body is parsed before any database
+    access, and the payment row is locked only for the state transition
+    itself. Kassa repeats a notification until it gets 200, so transitions
+    are idempotent.
+    """
+    events = {
+        'payment.waiting_for_capture': 'payment_waiting_for_capture',
+        'payment.succeeded': 'payment_succeeded',
+        'payment.canceled': 'payment_canceled',
+        'refund.succeeded': 'refund_succeeded',
+    }
+
+    event = None
+    order_id = None
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        started = time.time()
+        with metrics.registry.timer(metrics.REQUEST_DURATION,
+                                    view=self.__class__.__name__), \
+                routers.pin_primary():
+            response = super(WebhookView, self).dispatch(request, *args,
+                                                         **kwargs)
+        metrics.registry.inc(metrics.RESPONSES, view=self.__class__.__name__,
+                             code=response.status_code)
+        if request.method == 'POST':
+            journal.record_notification(request, response,
+                                        time.time() - started,
+                                        action=self.event,
+                                        order_id=self.order_id)
+        return response
+
+    def post(self, request, *args, **kwargs):
+        if not webhooks.is_allowed(request):
+            logger.warning('Notification from a forbidden address %s',
+                           webhooks.get_client_ip(request))
+            return JsonResponse({'error': 'forbidden'}, status=403)
+        try:
+            data = webhooks.loads(request.body)
+            self.event = data['event']
+            obj = data['object']
+            obj['id']
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({'error': 'bad_request'}, status=400)
+
+        handler = self.events.get(self.event)
+        if handler is None:
+            logger.info('Ignoring notification %s', self.event)
+            return HttpResponse()
+        try:
+            return getattr(self, handler)(obj)
+        except Exception:
+            logger.exception('Error when processing notification %s for '
+                             'payment #%s', self.event, self.order_id)
+            # Kassa will repeat the notification
+            return JsonResponse({'error': 'internal'}, status=500)
+
+    @staticmethod
+    def _find_order_id(external_id, metadata):
+        order_id = (metadata or {}).get('orderNumber')
+        if order_id:
+            return order_id
+        for queryset in Payment.objects.fan_out():
+            order_id = queryset.filter(external_id=external_id).values_list(
+                'order_id', flat=True).first()
+            if order_id:
+                return order_id
+        return None
+
+    def change_payment(self, obj, change):
+        """Lock the local payment of API payment object ``obj`` and call
+        ``change(payment)``
+        """
+        self.order_id = self._find_order_id(obj['id'], obj.get('metadata'))
+        if self.order_id is None:
+            return JsonResponse({'error': 'not_found'}, status=404)
+
+        source = self.__class__.__name__
+        with locked_transaction(source, routers.shard_for(self.order_id)):
+            payment = get_locked_payment(self.order_id, source)
+            if payment is None:
+                return JsonResponse({'error': 'not_found'}, status=404)
+            if payment.external_id != obj['id']:
+                # Not stored yet too, while the API call creating the
+                # payment has not returned: Kassa repeats the notification
+                logger.warning('Notification %s for payment #%s has a wrong '
+                               'payment ID %s', self.event, self.order_id,
+                               obj['id'])
+                return JsonResponse({'error': 'wrong_payment'}, status=400)
+            partial = payment.state in (Payment.STATE_AUTHORIZED,
+                                        Payment.STATE_SUCCESS,
+                                        Payment.STATE_REFUNDED)
+            if not kassa.amount_matches(obj.get('amount'), payment, partial):
+                logger.warning('Notification %s for payment #%s has a wrong '
+                               'amount %s', self.event, self.order_id,
+                               obj.get('amount'))
+                return JsonResponse({'error': 'wrong_amount'}, status=400)
+            change(payment)
+        return HttpResponse()
+
+    def payment_waiting_for_capture(self, obj):
+        def change(payment):
+            if payment.state not in (Payment.STATE_CREATED,
+                                     Payment.STATE_PROCESSED):
+                return
+            kassa.update_payment(payment, obj)
+            if payment.state == Payment.STATE_CREATED:
+                payment.process()
+            payment.authorize()
+        return self.change_payment(obj, change)
+
+    def payment_succeeded(self, obj):
+        def change(payment):
+            if payment.state in (Payment.STATE_SUCCESS,
+                                 Payment.STATE_REFUNDED):
+                return
+            kassa.update_payment(payment, obj)
+            if payment.state == Payment.STATE_CREATED:
+                payment.process()
+            elif payment.performed is None:
+                # Failed locally (e.g. customer came back from Kassa
+                # with a fail URL) before the money was actually taken
+                payment.performed = now()
+            payment.complete()
+        return self.change_payment(obj, change)
+
+    def payment_canceled(self, obj):
+        def change(payment):
+            if payment.is_completed:
+                return
+            kassa.update_payment(payment, obj)
+            payment.fail()
+        return self.change_payment(obj, change)
+
+    def refund_succeeded(self, obj):
+        from .refunds import apply_refund
+
+        if 'payment_id' not in obj:
+            return JsonResponse({'error': 'bad_request'}, status=400)
+        refund = apply_refund(obj)
+        if refund is None:
+            return JsonResponse({'error': 'not_found'}, status=404)
+        self.order_id = refund.order_id
+        logger.info('Refund %s of payment #%s succeeded', obj['id'],
+                    refund.order_id)
+        return HttpResponse()
+
+
 class PaymentFinishView(FormView):
     form_class = FinalPaymentStateForm
     template_name = 'yandex_cash_register/finish_payment.html'
 
     @method_decorator(csrf_exempt)
-    @method_decorator(transaction.atomic)
     def dispatch(self, request, *args, **kwargs):
-        return super(PaymentFinishView, self).dispatch(request, *args,
-                                                       **kwargs)
+        with metrics.registry.timer(metrics.REQUEST_DURATION,
+                                    view=self.__class__.__name__), \
+                routers.pin_primary():
+            return super(PaymentFinishView, self).dispatch(request, *args,
+                                                           **kwargs)
 
     def get(self, request, *args, **kwargs):
         if not request.META.get(
@@ -194,11 +419,6 @@ class PaymentFinishView(FormView):
         :type payment: yandex_cash_register.models.Payment
         :type success: bool
         """
-        # If success is defined as False and payment is not completed - fail it
-        if success is not None and not success and not payment.is_completed:
-            logger.info('Setting state to fail, order #%s', payment.order_id)
-            payment.fail()
-
         model = apps.get_model(*conf.MODEL)
         order = model.get_by_order_id(payment.order_id)
 
@@ -208,13 +428,33 @@ class PaymentFinishView(FormView):
             url = order.get_absolute_url()
         else:
             url = order.get_payment_complete_url(success)
+        if payment.state in (Payment.STATE_SUCCESS, Payment.STATE_REFUNDED):
+            # The payment was read without a lock, and a failed one may still
+            # succeed on a late paymentAviso, so only paid ones are cached
+            cache.set_final_redirect(payment.order_id, payment.state, url)
         return redirect(url)
 
+    @staticmethod
+    def _cached_response(order_number):
+        """Redirect for a completed payment served without touching the
+        database
+        """
+        cached = cache.get_final_redirect(order_number)
+        if cached is None:
+            return None
+        logger.info('Payment #%s is completed with state %s, redirecting '
+                    'from cache', order_number, cached[0])
+        return redirect(cached[1])
+
     def form_valid(self, form):
         """
         :type form: yandex_cash_register.forms.FinalPaymentStateForm
         """
         logger.info('Form is valid: %s', dict(form.cleaned_data))
+        response = self._cached_response(form.cleaned_data['cr_order_number'])
+        if response is not None:
+            return response
+
         action = form.cleaned_data['cr_action']
         payment = form.payment_obj
         if payment is None:
@@ -222,19 +462,169 @@ class PaymentFinishView(FormView):
 
         if not payment.is_started:
             return self._generate_response(payment)
-        if payment.state in (Payment.STATE_SUCCESS, Payment.STATE_FAIL):
-            success = payment.state == Payment.STATE_SUCCESS
+        if payment.is_completed:
+            success = payment.state != Payment.STATE_FAIL
+        elif payment.state == Payment.STATE_AUTHORIZED:
+            # The money is held and stays so whatever the customer's
+            # browser says, only holds.cancel() releases it
+            success = True
         else:
             if action == form.ACTION_CONFIRM:
                 success = True
             else:
                 success = False
+                payment = self._fail(form)
         return self._generate_response(payment, success)
 
+    def _fail(self, form):
+        """Fail payment unless it was completed or authorized in the meantime
+
+        :type form: yandex_cash_register.forms.FinalPaymentStateForm
+        :rtype: yandex_cash_register.models.Payment
+        """
+        with locked_transaction(self.__class__.__name__,
+                                form.payment_db()):
+            payment = form.lock_payment()
+            if not payment.is_completed and \
+                    payment.state != Payment.STATE_AUTHORIZED:
+                logger.info('Setting state to fail, order #%s',
+                            payment.order_id)
+                payment.fail()
+        return payment
+
     def form_invalid(self, form):
         logger.info('Form is invalid: %s', dict(form.cleaned_data))
+        if form.cleaned_data.get('cr_order_number'):
+            response = self._cached_response(
+                form.cleaned_data['cr_order_number'])
+            if response is not None:
+                return response
+
         payment = form.payment_obj
         if payment is not None:
             return self._generate_response(payment)
         else:
             return redirect('/')
+
+
+class MetricsView(View):
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.registry.render(),
+                            content_type='text/plain; version=0.0.4')
+
+
+class PaymentStatusView(View):
+    """Read-only payment state for frontends waiting for a payment result.
+
+    Requires both ``order_id`` and ``customer_id`` GET parameters. State is
+    served from cache kept up to date by payment transitions, falling back to
+    a plain (non-locking) read of the payment. Responses carry ``ETag`` and
+    ``Last-Modified``, so polling clients mostly get ``304 Not Modified``.
+    """
+
+    def get(self, request, *args, **kwargs):
+        status = self._get_status(request.GET.get('order_id', ''))
+        if not self._check_customer(request, status):
+            return JsonResponse({'error': 'not_found'}, status=404)
+
+        etag = quote_etag('{}-{:.6f}'.format(status['state'],
+                                            status['updated']))
+        last_modified = int(status['updated'])
+        if self._not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            response = JsonResponse(self._payload(status))
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    @staticmethod
+    def _payload(status):
+        return {
+            'order_id': status['order_id'],
+            'state': status['state'],
+            'is_payed': status['state'] == Payment.STATE_SUCCESS,
+            'is_completed': status['state'] in Payment.COMPLETED_STATES,
+            'updated': status['updated'],
+        }
+
+    @staticmethod
+    def _check_customer(request, status):
+        try:
+            customer_id = str(UUID(request.GET.get('customer_id', '')))
+        except ValueError:
+            customer_id = ''
+        return status is not None and constant_time_compare(
+            status['customer_id'], customer_id)
+
+    @staticmethod
+    def _get_status(order_id):
+        if not order_id:
+            return None
+        status = cache.get_status(order_id)
+        if status is not None:
+            return status
+
+        try:
+            payment = Payment.objects.for_read(order_id).only(
+                'order_id', 'customer_id', 'state', 'created', 'performed',
+                'completed').get(order_id=order_id)
+        except Payment.DoesNotExist:
+            return None
+        status = payment.get_status()
+        # Transitions always overwrite the cache, so never replace what they
+        # have written with a possibly stale read
+        cache.set_status(status, overwrite=False)
+        return status
+
+    @staticmethod
+    def _not_modified(request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            # Weak comparison, as RFC 7232 requires for If-None-Match
+            etags = set(value.strip().replace('W/', '', 1).strip('"')
+                        for value in if_none_match.split(','))
+            return '*' in etags or etag.strip('"') in etags
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        return if_modified_since is not None and \
+            last_modified <= if_modified_since
+
+
+class PaymentWaitView(PaymentStatusView):
+    """Long-poll version of ``PaymentStatusView``: if payment is not
+    completed yet, the response is held until it completes or ``timeout``
+    seconds (``conf.WAIT_TIMEOUT`` at most) pass. Either way the current
+    status is returned and the client is free to ask again.
+
+    A waiting request occupies a worker thread, so the view is only routed
+    with ``YANDEX_CR_WAIT`` and should be served by threaded or gevent
+    workers, not by the sync ones handling notifications.
+    """
+    # An authorized payment waits for the shop, not for the customer
+    final_states = Payment.COMPLETED_STATES + (Payment.STATE_AUTHORIZED,)
+
+    def get(self, request, *args, **kwargs):
+        order_id = request.GET.get('order_id', '')
+        if not order_id:
+            return JsonResponse({'error': 'not_found'}, status=404)
+        try:
+            timeout = min(float(request.GET.get('timeout',
+                                                conf.WAIT_TIMEOUT)),
+                          conf.WAIT_TIMEOUT)
+        except ValueError:
+            timeout = conf.WAIT_TIMEOUT
+
+        # Subscribe before reading the status, so that completion happening
+        # in between is not missed
+        with pubsub.get_pubsub().subscribe(order_id) as subscription:
+            status = self._get_status(order_id)
+            if not self._check_customer(request, status):
+                return JsonResponse({'error': 'not_found'}, status=404)
+            if status['state'] not in self.final_states and timeout > 0:
+                status = subscription.wait(timeout) or status
+
+        response = JsonResponse(self._payload(status))
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
@@ -0,0 +1,94 @@
+# coding=utf-8
+"""Per-process warm-up, run from ``YandexMoneyConfig.ready()`` when
+``YANDEX_CR_WARMUP`` is set.
+
+Without it the first notification and the first checkout served by a fresh
+worker pay for loading the URL resolver, translation catalogs, lxml and the
+compiled ``finish_payment.html``. With a preforking server that loads the
+application before forking (e.g. ``gunicorn --preload``) this is done once
+in the master process and inherited by every worker.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.template.loader import get_template
+from django.utils import translation
+from django.utils.encoding import force_text
+
+from . import conf
+
+
+logger = logging.getLogger(__name__)
+
+URL_NAMES = ('money_check_order', 'money_payment_aviso', 'money_webhook',
+             'money_payment_finish', 'money_payment_status')
+
+
+def warm_urls():
+    # Builds the resolver of ROOT_URLCONF with all its reverse lookups
+    names = URL_NAMES + ('money_payment_wait',) if conf.WAIT else URL_NAMES
+    for name in names:
+        reverse('yandex_cash_register:{}'.format(name))
+
+
+def warm_translations():
+    from .models import Payment
+
+    with translation.override(settings.LANGUAGE_CODE):
+        for choices in (conf.PAYMENT_TYPE_CHOICES, Payment.STATE_CHOICES):
+            for _, label in choices:
+                force_text(label)
+
+
+def warm_order_model():
+    apps.get_model(*conf.MODEL)
+
+
+def warm_lxml():
+    # Imports lxml and runs its serializer once, as get_response() does
+    from .views import E, etree
+
+    etree.tostring(E.checkOrderResponse(code='0'), xml_declaration=True,
+                   encoding='UTF-8', method='xml')
+
+
+def warm_templates():
+    from .views import PaymentFinishView
+
+    get_template(PaymentFinishView.template_name)
+
+
+STEPS = (
+    ('urls', warm_urls),
+    ('translations', warm_translations),
+    ('order_model', warm_order_model),
+    ('lxml', warm_lxml),
+    ('templates', warm_templates),
+)
+
+
+def warm_up():
+    """Run every warm-up step. A failing step is logged and skipped, so a
+    misconfiguration never stops the process from starting
+
+    :return: seconds spent on each step
+    :rtype: dict
+    """
+    timings = {}
+    started = time.time()
+    for name, step in STEPS:
+        step_started = time.time()
+        try:
+            step()
+        except Exception:
+            logger.warning('Warm-up step %s failed', name, exc_info=True)
+        timings[name] = time.time() - step_started
+    logger.info('Warmed up in %.1f ms (%s)', 1000 * (time.time() - started),
+                ', '.join('{} {:.1f} ms'.format(name, 1000 * timings[name])
+                          for name, _ in STEPS))
+    return timings